@@ -31,6 +31,8 @@ from os import path, environ
 import logging as logger
 from flask_mail import Mail
 from flask_login import current_user
+from app.jobs import JobRunner
+from app.cache import ResultCache
 
 
 app = Flask('STEM Data Dashboard', instance_relative_config=True,
@@ -52,6 +54,8 @@ else:
 db = SQLAlchemy(app)
 jwt_manager = JWTManager()
 mail = Mail()
+job_runner = JobRunner()
+result_cache = ResultCache()
 login_manager = LoginManager(app)
 login_manager.login_view = 'routes.login'
 
@@ -68,6 +72,11 @@ def init_app() -> Flask:
         # from app.models import User, Student, ClassData
         db.create_all()
 
+        # Add the columns and indexes that older databases are missing.
+        from app.models import upgrade_schema, DataVersion
+        upgrade_schema()
+        DataVersion.seed()
+
     jwt_manager.init_app(app)
 
     login_manager.login_view = 'auth.login'
@@ -76,6 +85,17 @@ def init_app() -> Flask:
     # Set up the SMTP connection for Gmail.
     mail.init_app(app)
 
+    # Start the thread pool that runs uploads in the background.
+    job_runner.init_app(app)
+
+    # Size the cache that holds the analytics results.
+    result_cache.init_app(app)
+
+    # Register the `flask` commands.
+    from app.commands import data_cli, terms_cli
+    app.cli.add_command(data_cli)
+    app.cli.add_command(terms_cli)
+
     return app
     
 
@@ -20,45 +20,603 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
-from datetime import datetime
 from werkzeug.datastructures import FileStorage
+from tempfile import mkstemp
+import csv
+from os import remove, path, cpu_count
+from hashlib import sha256
 import pandas as pd
-from pandas import DataFrame
-from app.models import Student, ClassData, Course, ClassEnum, InvalidClassException
-from app import db, app
+from pandas import DataFrame, Series
+from app.models import Student, UploadedFile, IngestionRecord, DataVersion
+from app.blueprints.dashboard.validation import (InvalidDataException,
+    validate_students, validate_class_data, validate_mcas_scores)
+from app.blueprints.dashboard.staging import (StagingArea, StagedRows,
+    delete_terms)
+from app.jobs import Job
+from app import db, app, job_runner
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from threading import Lock
+from operator import attrgetter
+from openpyxl import load_workbook
+from gzip import GzipFile
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile, ZipInfo, BadZipFile
+import zlib
 import re
+import json
+import logging as logger
+from datetime import datetime
+
+# The number of rows sent to the database in each batched INSERT.
+DEFAULT_BATCH_SIZE = 5000
+
+# The number of csv rows read, validated and inserted at a time.
+DEFAULT_CHUNK_SIZE = 50000
+
+# Only one upload promotes its staged rows at a time, so two uploads never
+# create the same course or hold competing write transactions.
+write_lock = Lock()
+
+# The most values sent in a single `IN (...)` clause, kept below SQLite's limit
+# on the number of parameters in one statement.
+IN_CLAUSE_CHUNK_SIZE = 900
+
+# The number of errors returned in full. The rest are only counted in the
+# summary and written to the error file.
+DEFAULT_ERROR_LIMIT = 1000
+
+# The number of bytes read at a time while hashing an uploaded file.
+HASH_BLOCK_SIZE = 1 << 20
+
+# The extensions of the files that can be read, used to find the data files in
+# a folder.
+DATA_FILE_EXTENSIONS = ('.csv', '.xlsx', '.gz', '.zip')
+
+# The type of every column of an upload, in the order of the sample data.
+# Codes with only a few distinct values are read as categories, so each value
+# is only stored once.
+UPLOAD_SCHEMA = {
+    'Unique_ID': 'string',
+    'Admit_Year': 'Int64',
+    'Admit_Term': 'category',
+    'Admit_Type': 'category',
+    'Term': 'category',
+    'Numeric_Term_Code': 'Int64',
+    'Program_Level': 'category',
+    'Subprogram_Code': 'category',
+    'Major1_Code': 'category',
+    'Major1_Desc': 'category',
+    'Major2_Code': 'category',
+    'Major2_Desc': 'category',
+    'Minor1_Code': 'category',
+    'Minor1_Desc': 'category',
+    'Concentration_Code': 'category',
+    'Concentration_Desc': 'category',
+    'Class': 'category',
+    'City': 'string',
+    'State': 'category',
+    'Postal_Code': 'string',
+    'Country_Code': 'category',
+    'Race-Ethnicity': 'category',
+    'Sex': 'category',
+    'GPA_Cum': 'float64',
+    'SAT_Math': 'Int64',
+    'SAT_Total': 'Int64',
+    'ACT_Score': 'Int64',
+    'Math_Placement': 'Int64',
+    'HS_GPA': 'float64',
+    'HS_CEEB': 'Int64',
+    'HS_Name': 'string',
+    'HS_City': 'string',
+    'HS_State': 'category',
+    'Course_Number': 'category',
+    'Course_Grade': 'category',
+    'Cohort': 'string'
+}
 
-error_list = []
-has_errors = False
+UPLOAD_COLUMNS = list(UPLOAD_SCHEMA)
+
+# The type of every column of an MCAS score upload.
+MCAS_SCHEMA = {
+    'Unique_ID': 'string',
+    'English_Raw': 'Int64',
+    'English_Scaled': 'Int64',
+    'English_Achievement_Level': 'category',
+    'Math_Raw': 'Int64',
+    'Math_Scaled': 'Int64',
+    'Math_Achievement_Level': 'category',
+    'STEM_Raw': 'Int64',
+    'STEM_Scaled': 'Int64',
+    'STEM_Achievement_Level': 'category'
+}
+
+# The kinds of data that can be uploaded, along with the schema of each.
+DATA_TYPES = {
+    'class_data': UPLOAD_SCHEMA,
+    'mcas_scores': MCAS_SCHEMA
+}
+
+# The only values read as missing. Anything else, e.g. `None` or `NA` as a
+# code, is kept as it is.
+NA_VALUES = ['', 'NaN', 'nan', 'NULL', 'null', 'N/A']
+
+# Notes added to the headers of the sample workbook, e.g. ` (REQUIRED)`.
+HEADER_NOTE = re.compile(r'\s*\(.*\)\s*$')
+
+# Maps each csv column to the column of the `students` table it is stored in.
+STUDENT_COLUMNS = {
+    'Unique_ID': 'id',
+    'Admit_Year': 'admit_year',
+    'Admit_Term': 'admit_term',
+    'Admit_Type': 'admit_type',
+    'Major1_Code': 'major_1',
+    'Major1_Desc': 'major_1_desc',
+    'Major2_Code': 'major_2',
+    'Major2_Desc': 'major_2_desc',
+    'Minor1_Code': 'minor_1',
+    'Minor1_Desc': 'minor_1_desc',
+    'Concentration_Code': 'concentration_code',
+    'Concentration_Desc': 'concentration_desc',
+    'Class': 'class_year',
+    'City': 'city',
+    'State': 'state',
+    'Country_Code': 'country',
+    'Postal_Code': 'postal_code',
+    'Math_Placement': 'math_placement_score',
+    'Race-Ethnicity': 'race_ethnicity',
+    'Sex': 'gender',
+    'GPA_Cum': 'gpa_cumulative',
+    'HS_GPA': 'high_school_gpa',
+    'SAT_Math': 'sat_math',
+    'SAT_Total': 'sat_total',
+    'ACT_Score': 'act_score',
+    'HS_Name': 'high_school_name',
+    'HS_City': 'high_school_city',
+    'HS_State': 'high_school_state',
+    'HS_CEEB': 'high_school_ceeb',
+    'Cohort': 'cohort'
+}
+
+# Maps each csv column to the column of the `class_data` table it is stored in.
+CLASS_DATA_COLUMNS = {
+    'Unique_ID': 'student_id',
+    'Program_Level': 'program_level',
+    'Subprogram_Code': 'subprogram_code',
+    'Course_Grade': 'grade'
+}
+
+# Maps each csv column to the column of the `mcas_scores` table it is stored
+# in.
+MCAS_COLUMNS = {col: col.lower().replace('unique_id', 'student_id')
+    for col in MCAS_SCHEMA}
+
+# The columns of a staged Class Data row that make up its fingerprint.
+FINGERPRINT_COLUMNS = ['student_id', 'term_code', 'course_num', 'semester',
+    'year', 'program_level', 'subprogram_code', 'grade']
+
+class UnreadableFileException(Exception):
+    '''
+    An exception to represent a file that could not be read.
+    '''
+    pass
 
-# A list of IDs for students that had an error.
-failed_students = []
 
-class InvalidDataException(Exception):
+class ErrorReport:
     '''
-    An exception to hold an invalid data entry.
+    Keeps a bounded report of the errors found in an upload. Only the first
+    `error_limit` errors are kept in full. Every error is counted in a summary
+    for its message, column and sheet, and is written to a csv file if one is
+    wanted, so a file with millions of errors never holds them all in memory.
 
     param:
-        `message`: The error message.
-        `line_num`: The line number the error occured on.
-        `col_num`: The column number the error occured on.
+        `error_limit`: The number of errors to keep in full.
+        `write_file`: Whether every error should be written to a csv file.
     '''
-    def __init__(self, message, line_num, col_num):
-        super().__init__(message)
-        self.message = message
-        self.line_num = line_num
-        self.col_num = col_num
-    
+    def __init__(self, error_limit: int, write_file: bool=False):
+        self.error_limit = error_limit
+        self.write_file = write_file
+        self.errors = []
+        self.count = 0
+        self.summary = {}
+        self.file_path = None
+        self.__file = None
+        self.__writer = None
+
+    def add(self, errors: list[InvalidDataException]):
+        '''
+        Adds the errors to the report.
+
+        param:
+            `errors`: A `list` of `InvalidDataException` objects.
+        '''
+        self.count += len(errors)
+        self.errors.extend(errors[:max(0, self.error_limit - len(self.errors))])
+
+        for error in errors:
+            key = (error.message, error.col_num, error.sheet)
+            rule = self.summary.get(key)
+            if (rule is None):
+                self.summary[key] = [1, error.line_num, error.line_num]
+            else:
+                rule[0] += 1
+                rule[2] = error.line_num
+
+        if (self.write_file and len(errors) > 0):
+            self.__write(errors)
+
+    def merge(self, report, label: str):
+        '''
+        Adds the errors of a report made by a worker process, which only holds
+        its first errors in full along with the summary of every rule. The
+        rows of its error file are copied into this report's file, and its
+        file is removed.
+
+        param:
+            `report`: The closed `ErrorReport` to add.
+            `label`: The name of the file the errors were found in, which is
+                put in front of the name of their sheet.
+        '''
+        def relabel(sheet: str) -> str:
+            return label if sheet is None else f'{label}: {sheet}'
+
+        for error in report.errors:
+            error.sheet = relabel(error.sheet)
+        self.count += report.count
+        self.errors.extend(report.errors[:max(0,
+            self.error_limit - len(self.errors))])
+
+        for (message, col_num, sheet), (count, first_line,
+            last_line) in report.summary.items():
+            rule = self.summary.get((message, col_num, relabel(sheet)))
+            if (rule is None):
+                self.summary[(message, col_num, relabel(sheet))] = [count,
+                    first_line, last_line]
+            else:
+                rule[0] += count
+                rule[2] = last_line
+
+        if (report.file_path is not None):
+            if (self.write_file):
+                with open(report.file_path, newline='') as error_file:
+                    rows = csv.reader(error_file)
+                    next(rows)
+                    for row in rows:
+                        self.__write_rows([(*row[:3], relabel(row[3] or None))])
+            report.remove_file()
+
+    def close(self):
+        '''
+        Closes the error file, if one was written.
+        '''
+        if (self.__file is not None):
+            self.__file.close()
+            self.__file = None
+            self.__writer = None
+
+    def remove_file(self):
+        '''
+        Closes and removes the error file, if one was written.
+        '''
+        self.close()
+        if (self.file_path is not None):
+            remove(self.file_path)
+            self.file_path = None
+
+    def to_dict(self) -> dict:
+        '''
+        Returns the report in a JSON-like format.
+
+        return:
+            A `dict` holding the errors that were kept in full, the total
+            number of errors, and the summary of each rule.
+        '''
+        return {
+            'errors': [self.__error_dict(error.sheet,
+                error_message=error.message,
+                line_num=error.line_num, col_num=error.col_num)
+                for error in self.errors],
+            'error_count': self.count,
+            'errors_truncated': self.count > len(self.errors),
+            'error_summary': [self.__error_dict(sheet, error_message=message,
+                col_num=col_num, count=count, first_line=first_line,
+                last_line=last_line) for (message, col_num, sheet),
+                (count, first_line, last_line) in self.summary.items()]
+        }
+
+    @staticmethod
+    def __error_dict(sheet: str, **fields) -> dict:
+        '''
+        Formats an error, or the summary of a rule, in a JSON-like format.
+
+        param:
+            `sheet`: The name of the sheet the errors were found on.
+            `fields`: The fields of the error.
+        return:
+            A `dict` holding the fields, with the sheet added if the errors
+            came from a workbook.
+        '''
+        if (sheet is not None):
+            fields['sheet'] = sheet
+        return fields
+
+    def __write(self, errors: list[InvalidDataException]):
+        '''
+        Writes the errors to the error file, creating it the first time.
+
+        param:
+            `errors`: A `list` of `InvalidDataException` objects.
+        '''
+        self.__write_rows([(error.message, error.line_num, error.col_num,
+            error.sheet) for error in errors])
+
+    def __write_rows(self, rows: list[tuple]):
+        '''
+        Writes the rows to the error file, creating it the first time.
+
+        param:
+            `rows`: A `list` of `(message, line_num, col_num, sheet)` tuples.
+        '''
+        if (self.__file is None):
+            handle, self.file_path = mkstemp(suffix='.errors.csv')
+            self.__file = open(handle, 'w', newline='')
+            self.__writer = csv.writer(self.__file)
+            self.__writer.writerow(['error_message', 'line_num', 'col_num',
+                'sheet'])
+        self.__writer.writerows(rows)
 
-    def __repr__(self) -> str:
-        return f'{super().__repr__()} at line num: {self.line_num}'
 
-def upload_csv_file(data: FileStorage):
+class UploadContext:
     '''
-    Parses the specified csv file and inserts it into the database.
+    Holds the state of a single upload: its settings, the errors that were
+    found, the students it has seen and the area its rows are staged in. Each
+    upload gets its own context, so uploads running at the same time never
+    share any state.
+
+    param:
+        `batch_size`: The number of rows to insert at a time. Defaults to the
+            `UPLOAD_BATCH_SIZE` config value.
+        `chunk_size`: The number of rows to read at a time. Defaults to the
+            `UPLOAD_CHUNK_SIZE` config value.
+        `job`: The `Job` to report the phase and number of rows processed to.
+        `dry_run`: Whether the data should only be validated, without writing
+            anything to the database.
+        `max_errors`: The number of errors to stop reading the file after.
+            Every error is kept when this is `None`.
+        `error_limit`: The number of errors to return in full. Defaults to the
+            `UPLOAD_ERROR_LIMIT` config value.
+        `error_file`: Whether every error should be written to a csv file.
+        `update_students`: Whether students that already exist should be
+            validated and updated, rather than skipped.
+        `replace_terms`: Whether the terms in the file should replace the
+            stored ones.
+        `user`: The email of the user that made the upload, if any.
+        `data_type`: The kind of data being uploaded, one of `DATA_TYPES`.
+    '''
+    def __init__(self, batch_size: int=None, chunk_size: int=None,
+        job: Job=None, dry_run: bool=False, max_errors: int=None,
+        error_limit: int=None, error_file: bool=False,
+        update_students: bool=False, replace_terms: bool=False,
+        user: str=None, data_type: str='class_data'):
+        self.batch_size = batch_size or app.config.get('UPLOAD_BATCH_SIZE',
+            DEFAULT_BATCH_SIZE)
+        self.chunk_size = chunk_size or app.config.get('UPLOAD_CHUNK_SIZE',
+            DEFAULT_CHUNK_SIZE)
+        self.job = job if job is not None else Job()
+        self.dry_run = dry_run
+        self.max_errors = max_errors
+        self.update_students = update_students
+        self.replace_terms = replace_terms
+        self.user = user
+        self.data_type = data_type
+        self.started_at = datetime.utcnow()
+        self.errors = ErrorReport(error_limit or app.config.get(
+            'UPLOAD_ERROR_LIMIT', DEFAULT_ERROR_LIMIT), error_file)
+        self.staging = None
+
+        # The students that were found earlier in the file, along with the ones
+        # that already exist unless they are being updated.
+        self.known_students = set()
+
+    def add_errors(self, errors: list[InvalidDataException]):
+        '''
+        Adds the errors to the errors found in this upload.
+
+        param:
+            `errors`: A `list` of `InvalidDataException` objects.
+        '''
+        if (self.max_errors is not None):
+            errors = errors[:max(0, self.max_errors - self.errors.count)]
+        self.errors.add(errors)
+
+    def merge_errors(self, report: ErrorReport, label: str):
+        '''
+        Adds the errors a worker process found in a file of a batch. When
+        `max_errors` is set the worker keeps each of its errors, so the ones
+        past the limit can be dropped like in `add_errors`.
+
+        param:
+            `report`: The `ErrorReport` of the worker.
+            `label`: The name of the file the errors were found in.
+        '''
+        if (self.max_errors is None):
+            self.errors.merge(report, label)
+        else:
+            for error in report.errors:
+                error.sheet = (label if error.sheet is None
+                    else f'{label}: {error.sheet}')
+            self.add_errors(report.errors)
+            report.remove_file()
+
+    def error_limit_reached(self) -> bool:
+        '''
+        Returns whether or not `max_errors` errors have been found, meaning the
+        rest of the file does not need to be read.
+
+        return:
+            A `bool` representing if the error limit was reached.
+        '''
+        return (self.max_errors is not None and
+            self.errors.count >= self.max_errors)
+
+    def has_errors(self) -> bool:
+        '''
+        Returns whether or not any errors have been found in this upload.
+
+        return:
+            A `bool` representing if there were errors.
+        '''
+        return self.errors.count > 0
+
+    def get_staging(self) -> StagingArea:
+        '''
+        Returns the area the rows of this upload are staged in, creating it the
+        first time.
+
+        return:
+            The `StagingArea` of this upload.
+        '''
+        if (self.staging is None):
+            self.staging = StagingArea(self.batch_size)
+        return self.staging
+
+    def close(self):
+        '''
+        Drops the staged rows and closes the error report.
+        '''
+        self.errors.close()
+        if (self.staging is not None):
+            self.staging.close()
+            self.staging = None
+
+
+def start_upload(data: FileStorage, max_errors: int=None,
+    update_students: bool=False, replace_terms: bool=False,
+    user: str=None, data_type: str='class_data') -> Job:
+    '''
+    Saves the uploaded file to a temporary file and queues it to be inserted by
+    a background job, so the request can return right away.
+
+    param:
+        data: The `FileStorage` object containing the csv file.
+        max_errors: The number of errors to stop reading the file after.
+        update_students: Whether students that already exist should be
+            updated.
+        replace_terms: Whether the terms in the file should replace the stored
+            ones.
+        user: The email of the user that made the upload.
+        data_type: The kind of data in the file, one of `DATA_TYPES`.
+    return:
+        The `Job` that will insert the file.
+    '''
+    # The request's copy of the file is closed once the request ends.
+    handle, file_path = mkstemp(suffix='.upload')
+    with open(handle, 'wb') as temp_file:
+        data.save(temp_file)
+
+    return job_runner.submit(__run_upload, file_path, data.filename,
+        max_errors, update_students, replace_terms, user, data_type)
+
+
+def __run_upload(job: Job, file_path: str, filename: str,
+    max_errors: int=None, update_students: bool=False,
+    replace_terms: bool=False, user: str=None, data_type: str='class_data'):
+    '''
+    Inserts the saved upload from a background job, then removes it.
+
+    param:
+        job: The `Job` to report progress to.
+        file_path: The path to the saved file.
+        filename: The name of the uploaded file.
+        max_errors: The number of errors to stop reading the file after.
+        update_students: Whether students that already exist should be
+            updated.
+        replace_terms: Whether the terms in the file should replace the stored
+            ones.
+        user: The email of the user that made the upload.
+        data_type: The kind of data in the file, one of `DATA_TYPES`.
+    return:
+        The result of `upload_csv_file`.
+    '''
+    try:
+        return upload_file(job, file_path, filename, max_errors=max_errors,
+            update_students=update_students, replace_terms=replace_terms,
+            user=user, data_type=data_type)
+    finally:
+        remove(file_path)
+
+
+def upload_file(job: Job, file_path: str, filename: str=None,
+    dry_run: bool=False, max_errors: int=None, update_students: bool=False,
+    replace_terms: bool=False, user: str=None, data_type: str='class_data'):
+    '''
+    Inserts a file that is already on disk, so it never has to be buffered by a
+    request. Every error is written to the job's `errors` file.
+
+    param:
+        job: The `Job` to report progress to.
+        file_path: The path to the file.
+        filename: The name of the file. Defaults to the name in `file_path`.
+        dry_run: Whether the file should only be validated.
+        max_errors: The number of errors to stop reading the file after.
+        update_students: Whether students that already exist should be
+            updated.
+        replace_terms: Whether the terms in the file should replace the stored
+            ones.
+        user: The email of the user that made the upload, if any.
+        data_type: The kind of data in the file, one of `DATA_TYPES`.
+    return:
+        The result of `upload_csv_file`.
+    '''
+    with open(file_path, 'rb') as file:
+        return upload_csv_file(FileStorage(file,
+            filename or path.basename(file_path)), job=job, dry_run=dry_run,
+            max_errors=max_errors, error_file=True,
+            update_students=update_students, replace_terms=replace_terms,
+            user=user, data_type=data_type)
+
+
+def upload_csv_file(data: FileStorage, batch_size: int=None,
+    chunk_size: int=None, job: Job=None, dry_run: bool=False,
+    max_errors: int=None, error_limit: int=None, error_file: bool=False,
+    update_students: bool=False, replace_terms: bool=False, user: str=None,
+    data_type: str='class_data'):
+    '''
+    Parses the specified csv file and inserts it into the database. The file is
+    streamed in chunks of rows, so only one chunk is held in memory at a time.
+    The valid rows of each chunk are staged in temporary tables, and once the
+    whole file is known to be valid they are promoted to the live tables in one
+    short transaction. A file that has already been uploaded is skipped, and
+    only the Class Data rows that are not already in the database are added.
+
+    In a dry run the file is only validated. The database is read to find the
+    students that already exist, but nothing is ever written to it other than
+    the upload's `IngestionRecord`, which records how long each stage took.
 
     param: 
         data: The `FileStorage` object containing the csv file.
+        batch_size: The number of rows to insert at a time. Defaults to the
+            `UPLOAD_BATCH_SIZE` config value.
+        chunk_size: The number of rows to read at a time. Defaults to the
+            `UPLOAD_CHUNK_SIZE` config value.
+        job: The `Job` to report the phase and number of rows processed to.
+        dry_run: Whether the file should only be validated.
+        max_errors: The number of errors to stop reading the file after. Only
+            the first `max_errors` errors are returned.
+        error_limit: The number of errors to return in full. The rest are only
+            counted in the summary of their rule. Defaults to the
+            `UPLOAD_ERROR_LIMIT` config value.
+        error_file: Whether every error should be written to a csv file, which
+            is added to the job's files as `errors`.
+        update_students: Whether students that already exist should be
+            validated and updated with the values in the file. Otherwise they
+            are skipped.
+        replace_terms: Whether the Class Data and courses of every term in the
+            file should be deleted before the file is added, in the same
+            transaction. The file is added even if it was uploaded before.
+        user: The email of the user that made the upload, if any.
+        data_type: The kind of data in the file, one of `DATA_TYPES`. MCAS
+            scores (`mcas_scores`) must belong to students that already exist,
+            and replace the stored scores of their student.
 
     return:
         A `Response` object representing the response to be returned to the API
@@ -67,362 +625,750 @@ def upload_csv_file(data: FileStorage):
     if not data:
         return {'message': 'Unable to read file'}, 400
     else:
-        # Split the sheets.
-        csv_file = pd.read_csv(data)
-        
-        # Replace all nan values with None.
-        csv_file = csv_file.astype(object).where(csv_file.notna(), None)
+        ctx = UploadContext(batch_size, chunk_size, job, dry_run, max_errors,
+            error_limit, error_file, update_students, replace_terms, user,
+            data_type)
+        file_hash = None
+        result = {'message': 'Upload failed.'}, 500
+        try:
+            ctx.job.set_phase('hashing')
+            file_hash = hash_file(data)
+            result = __upload_data(data, file_hash, ctx)
+            return result
+        finally:
+            db.session.rollback()
+            ctx.close()
+            if (ctx.errors.file_path is not None):
+                ctx.job.add_file('errors', ctx.errors.file_path)
+            record_ingestion(ctx, file_hash, data.filename, result)
 
-        __insert_students(csv_file)
-        __insert_class_data(csv_file)
 
-        # If there were no errors, commit the database and return the success msg.
-        if len(error_list) == 0:
-            db.session.commit()
-            return {'message': 'Success.'}, 200
+def __upload_data(data: FileStorage, file_hash: str, ctx: UploadContext):
+    '''
+    Inserts the file for `upload_csv_file`.
+
+    param:
+        data: The `FileStorage` object containing the file.
+        file_hash: The SHA-256 hash of the file.
+        ctx: The `UploadContext` of the upload.
+    return:
+        A `(body, status_code)` tuple.
+    '''
+    try:
+        if (not ctx.dry_run and not ctx.replace_terms):
+            if (db.session.get(UploadedFile, file_hash) is not None):
+                return {'message': 'File has already been uploaded.'}, 200
+
+        __upload_chunks(read_chunks(data, ctx.chunk_size,
+            DATA_TYPES[ctx.data_type]), ctx)
+
+        if (ctx.dry_run and not ctx.has_errors()):
+            return {'message': 'File is valid.'}, 200
+
+        # If there were no errors, promote the staged rows and return the
+        # success msg.
+        if (not ctx.has_errors()):
+            ctx.job.set_phase('committing')
+            with write_lock:
+                counts = ctx.get_staging().promote([{
+                    'file_hash': file_hash, 'filename': data.filename,
+                    'num_rows': ctx.job.rows_processed}],
+                    ctx.update_students, ctx.replace_terms)
+            return {'message': 'Success.', 'rows_written': counts}, 200
         else:
-            # Process the errors into JSON, then clear the list of errors.
-            error_json = __process_errors(error_list)
-            error_list.clear()
             return {'message': 'Errors while parsing data.', 
-                'errors': error_json}, 400
+                **ctx.errors.to_dict()}, 400
+    except UnreadableFileException as e:
+        return {'message': 'Unable to read file', 'error': str(e)}, 400
+    except IntegrityError as e:
+        # A row broke one of the constraints of the live tables.
+        return {'message': 'Data was rejected by the database.',
+            'error': str(e.orig)}, 400
 
 
-def __insert_class_data(csv_file: DataFrame):
+def record_ingestion(ctx: UploadContext, file_hash: str, filename: str,
+    result: tuple):
     '''
-    Inserts all Class Data into the database. Also reports invalid/missing data
-    and inserts the error into the `error_list`.
+    Saves the `IngestionRecord` of a finished upload. An upload never fails
+    because its record could not be saved. Dry runs are not recorded, so they
+    never write to the database or wait on an upload that is being committed.
 
     param:
-        class_data: The `DataFrame` object containing the class_data worksheet.
+        ctx: The `UploadContext` of the upload.
+        file_hash: The SHA-256 hash of the file, if it was read.
+        filename: The name of the file.
+        result: The `(body, status_code)` tuple the upload returned.
     '''
+    if (ctx.dry_run):
+        return
 
-    def __verify_semester(semester: str) -> bool:
-        '''
-        Returns a `bool` representing if the semester is valid or not.
+    body, status_code = result
+    counts = body.get('rows_written', {})
+    record = IngestionRecord(file_hash=file_hash, filename=filename,
+        user=ctx.user, started_at=ctx.started_at,
+        duration_seconds=(datetime.utcnow() - ctx.started_at).total_seconds(),
+        status_code=status_code, message=body.get('message'),
+        rows_in=ctx.job.rows_processed,
+        class_data_written=counts.get('class_data', 0),
+        students_written=counts.get('students', 0),
+        courses_written=counts.get('courses', 0),
+        error_count=ctx.errors.count,
+        stage_seconds=json.dumps(ctx.job.stage_seconds()),
+        peak_memory_mb=round(ctx.job.peak_memory / (1 << 20), 1))
 
-        param:
-            `semester`: The semester to check.
-        return:
-            A `bool` representing if the semester is valid or not.
-        '''
-        return semester in ('FA', 'SP', 'SU', 'WI')
+    try:
+        with write_lock:
+            db.session.add(record)
+            db.session.commit()
+    except SQLAlchemyError:
+        logger.exception('Unable to record the upload of %s.', filename)
+        db.session.rollback()
 
-    def __verify_year(year: str) -> bool:
-        '''
-        Returns a `bool` representing if the year is valid or not.
 
-        param:
-            `year`: The year to verify.
-        return:
-            A `bool` representing if the year is valid or not.
-        '''
-        return (int(year) <= datetime.now().year)
+def upload_batch(job: Job, file_paths: list[str], workers: int=None,
+    dry_run: bool=False, max_errors: int=None, update_students: bool=False,
+    replace_terms: bool=False, user: str=None, data_type: str='class_data'):
+    '''
+    Inserts several files that are already on disk as a single batch. Reading
+    and validating a file does not depend on any other file, so the files, and
+    the members of zip archives, are validated at the same time in a pool of
+    processes. Their valid rows are sent back and staged together, then
+    promoted with the same set-based statements as a single upload, so courses
+    are only ever resolved in one place. Nothing is written unless every file
+    is valid. Every error is written to the job's `errors` file, and each
+    process only sends back as many errors in full as the report keeps.
 
-    def __insert_course(semester: str, year: str, num_term_code: str, 
-        course_id: str) -> int:
-        '''
-        Searches for the course matching the given data. If the course is found,
-        the ID of it is returned. If it does not exist, it is created and the 
-        id is return.
+    param:
+        job: The `Job` to report progress to.
+        file_paths: The paths to the files.
+        workers: The number of processes to validate with. Defaults to the
+            `UPLOAD_WORKERS` config value, or the number of CPUs.
+        dry_run: Whether the files should only be validated.
+        max_errors: The number of errors to stop reading the files after.
+        update_students: Whether students that already exist should be
+            updated.
+        replace_terms: Whether the terms in the files should replace the stored
+            ones.
+        user: The email of the user that made the upload, if any.
+        data_type: The kind of data in the files, one of `DATA_TYPES`.
+    return:
+        A `(body, status_code)` tuple like `upload_csv_file`. The names of the
+        files that had already been uploaded are given as `files_skipped`.
+    '''
+    ctx = UploadContext(job=job, dry_run=dry_run, max_errors=max_errors,
+        error_file=True, update_students=update_students,
+        replace_terms=replace_terms, user=user, data_type=data_type)
+    result = {'message': 'Upload failed.'}, 500
+    try:
+        result = __upload_batch(file_paths, workers, ctx)
+        return result
+    finally:
+        db.session.rollback()
+        ctx.close()
+        if (ctx.errors.file_path is not None):
+            ctx.job.add_file('errors', ctx.errors.file_path)
+        record_ingestion(ctx, None, ', '.join(path.basename(file_path)
+            for file_path in file_paths), result)
 
-        param:
-            `semester`: A `str` holding the semester.
-            `year`: A `str` holding the year.
-            `num_term_code`: A `str` holding the term numeric code.
-            `course_id`: A `str` holding the course ID.
-        return:
-            The ID of the `Course` object.
-        '''
-        course_obj = Course.query.filter(Course.term_code==num_term_code, 
-            Course.course_num==course_id, Course.semester==semester, 
-            Course.year==year).first()
 
-        # If the course already exists, return the ID of it.
-        if (course_obj):
-            return course_obj.id
+def __upload_batch(file_paths: list[str], workers: int, ctx: UploadContext):
+    '''
+    Inserts the files for `upload_batch`.
+
+    param:
+        file_paths: The paths to the files.
+        workers: The number of processes to validate with.
+        ctx: The `UploadContext` of the batch.
+    return:
+        A `(body, status_code)` tuple.
+    '''
+    workers = workers or app.config.get('UPLOAD_WORKERS') or cpu_count()
+    label = None
+    try:
+        ctx.job.set_phase('hashing')
+        files, tasks, skipped = [], [], []
+        for file_path in file_paths:
+            label = path.basename(file_path)
+            with open(file_path, 'rb') as data:
+                file_hash = hash_file(FileStorage(data))
+            if (not ctx.dry_run and not ctx.replace_terms and
+                db.session.get(UploadedFile, file_hash) is not None):
+                skipped.append(label)
+                continue
+
+            file = {'file_hash': file_hash, 'filename': label, 'num_rows': 0,
+                'term_codes': set()}
+            files.append(file)
+            # The members of an archive are read on their own, so a zip of
+            # several terms is spread across the processes too.
+            members = (__zip_members(file_path)
+                if label.lower().endswith('.zip') else [None])
+            tasks.extend((file, file_path, member) for member in members)
+
+        if (len(files) == 0):
+            return {'message': 'Every file has already been uploaded.',
+                'files_skipped': skipped}, 200
+
+        ctx.job.set_phase('validating')
+        with ProcessPoolExecutor(max(1, min(workers, len(tasks)))) as pool:
+            futures = [pool.submit(__validate_file, file_path, member,
+                ctx.chunk_size, ctx.dry_run, ctx.max_errors,
+                ctx.errors.error_limit, ctx.errors.write_file,
+                ctx.update_students, ctx.data_type)
+                for _, file_path, member in tasks]
+
+            # The results are merged in the order of the files, so the errors
+            # are too.
+            try:
+                for (file, _, member), future in zip(tasks, futures):
+                    label = member or file['filename']
+                    num_rows, errors, rows = future.result()
+                    ctx.merge_errors(errors, label)
+                    ctx.job.add_rows(num_rows)
+                    file['num_rows'] += num_rows
+
+                    if (not ctx.has_errors() and not ctx.dry_run):
+                        ctx.job.set_phase('staging')
+                        file['term_codes'] |= rows.term_codes()
+                        rows.stage_into(ctx.get_staging())
+                    if (ctx.error_limit_reached()):
+                        break
+                    ctx.job.set_phase('validating')
+            finally:
+                pool.shutdown(cancel_futures=True)
+                # The error files of the results that were not merged are
+                # removed.
+                for future in futures:
+                    if (not future.cancelled() and future.exception() is None):
+                        future.result()[1].remove_file()
+
+        if (ctx.dry_run and not ctx.has_errors()):
+            return {'message': 'Files are valid.',
+                'files_skipped': skipped}, 200
+
+        if (not ctx.has_errors()):
+            ctx.job.set_phase('committing')
+            with write_lock:
+                counts = ctx.get_staging().promote(files, ctx.update_students,
+                    ctx.replace_terms)
+            return {'message': 'Success.', 'rows_written': counts,
+                'files_skipped': skipped}, 200
         else:
-            # If the course does not exist, create it and add it to the database.
-            new_course = Course(term_code=num_term_code, course_num=course_id,
-                semester=semester, year=year)
-            db.session.add(new_course)
-            db.session.flush()
-            return new_course.id
-        
-    for idx in csv_file.index:
-        current_row = idx + 2
-        found_error = False
-        valid_course_data = True
-
-        student_id = csv_file['Unique_ID'][idx]
-        term = csv_file['Term'][idx]
-        num_term_code = csv_file['Numeric_Term_Code'][idx]
-        program_level = csv_file['Program_Level'][idx]
-        subprogram_code = csv_file['Subprogram_Code'][idx]
-        course_id = csv_file['Course_Number'][idx]
-        grade = csv_file['Course_Grade'][idx]
-
-        if (term is None):
-            error_list.append(InvalidDataException('Missing Term', current_row, 5))
-            found_error = True
-            valid_course_data = False
+            return {'message': 'Errors while parsing data.',
+                **ctx.errors.to_dict()}, 400
+    except (UnreadableFileException, BadZipFile) as e:
+        return {'message': 'Unable to read file', 'file': label,
+            'error': str(e)}, 400
+    except IntegrityError as e:
+        return {'message': 'Data was rejected by the database.',
+            'error': str(e.orig)}, 400
+
+
+def __validate_file(file_path: str, member: str, chunk_size: int,
+    dry_run: bool, max_errors: int, error_limit: int, error_file: bool,
+    update_students: bool, data_type: str) -> tuple:
+    '''
+    Reads and validates a file of a batch in a worker process. The valid rows
+    are kept in memory instead of being staged, since the staging tables only
+    exist on the connection of the batch.
+
+    param:
+        file_path: The path to the file.
+        member: The name of the file to read from the zip archive at
+            `file_path`, or `None` to read the file itself.
+        chunk_size: The number of rows to read at a time.
+        dry_run: Whether the rows should only be validated.
+        max_errors: The number of errors to stop reading the file after.
+        error_limit: The number of errors to keep in full, when `max_errors`
+            is not set.
+        error_file: Whether every error should be written to a csv file, when
+            `max_errors` is not set.
+        update_students: Whether students that already exist should be
+            validated.
+        data_type: The kind of data in the file, one of `DATA_TYPES`.
+    return:
+        A `tuple` of the number of rows read, the `ErrorReport` of the errors
+        that were found and the `StagedRows` holding the valid rows.
+    '''
+    with app.app_context(), open(file_path, 'rb') as file:
+        if (member is None):
+            return __validate_data(FileStorage(file, path.basename(file_path)),
+                chunk_size, dry_run, max_errors, error_limit, error_file,
+                update_students, data_type)
+        with ZipFile(file) as archive, archive.open(member) as member_file:
+            return __validate_data(FileStorage(member_file, member),
+                chunk_size, dry_run, max_errors, error_limit, error_file,
+                update_students, data_type)
+
+
+def __validate_data(data: FileStorage, chunk_size: int, dry_run: bool,
+    max_errors: int, error_limit: int, error_file: bool,
+    update_students: bool, data_type: str) -> tuple:
+    '''
+    Validates the file like an upload, keeping the valid rows and a report of
+    the errors. See `__validate_file`.
+    '''
+    # With `max_errors` set the parent drops the errors past the limit, so the
+    # worker keeps each of the errors it reads.
+    if (max_errors is not None):
+        error_limit, error_file = max_errors, False
+    ctx = UploadContext(chunk_size=chunk_size, dry_run=dry_run,
+        max_errors=max_errors, error_limit=error_limit, error_file=error_file,
+        update_students=update_students, data_type=data_type)
+    ctx.staging = StagedRows()
+    try:
+        __upload_chunks(read_chunks(data, ctx.chunk_size,
+            DATA_TYPES[data_type]), ctx)
+        return ctx.job.rows_processed, ctx.errors, ctx.staging
+    finally:
+        db.session.rollback()
+        ctx.close()
+
+
+def __zip_members(file_path: str) -> list[str]:
+    '''
+    Returns the names of the data files in the zip archive.
+
+    param:
+        file_path: The path to the archive.
+    return:
+        A `list` of the names of the members that are read by `read_zip`.
+    '''
+    with ZipFile(file_path) as archive:
+        return [member.filename for member in archive.infolist()
+            if is_data_member(member)]
+
+
+def __upload_chunks(chunks, ctx: UploadContext):
+    '''
+    Validates each chunk of the data, staging the valid rows until the first
+    error is found. Reading stops once the context's error limit is reached.
+
+    param:
+        chunks: An iterable of `(sheet, DataFrame, errors)` tuples, as returned
+            by `read_chunks`.
+        ctx: The `UploadContext` of the upload.
+    '''
+    ctx.job.set_phase('parsing')
+    for sheet, csv_file, type_errors in chunks:
+        ctx.job.set_phase('validating')
+        if (ctx.data_type == 'mcas_scores'):
+            scores, errors = __validate_mcas_scores(csv_file, ctx)
         else:
-            split_term = term.split(' ')
-            if (len(split_term) != 2):
-                error_list.append(InvalidDataException('Invalid Term', 
-                    current_row, 5))
-                found_error = True
-                valid_course_data = False
+            students, student_errors = __validate_students(csv_file, ctx)
+            class_data, class_errors = validate_class_data(csv_file)
+            errors = student_errors + class_errors
+        errors = type_errors + errors
+
+        # The errors are kept in line order, so an error limit keeps the
+        # first errors in the file.
+        errors = sorted(errors, key=attrgetter('line_num'))
+        for error in errors:
+            error.sheet = sheet
+        ctx.add_errors(errors)
+
+        # Once an error is found nothing will be committed, so the rest of the
+        # file is only validated.
+        if (not ctx.has_errors() and not ctx.dry_run):
+            ctx.job.set_phase('staging')
+            if (ctx.data_type == 'mcas_scores'):
+                __stage_mcas_scores(scores, ctx)
             else:
-                # Verify the semester.
-                if (__verify_semester(split_term[0])):
-                    semester = split_term[0]
-                else:
-                    error_list.append(InvalidDataException('Invalid Semester', 
-                        current_row, 5))
-                    found_error = True
-                    valid_course_data = False
-                
-                # Verify the year.
-                if (__verify_year(split_term[1])):
-                    year = split_term[1]
-                else:
-                    error_list.append(InvalidDataException('Invalid Year', 
-                        current_row, 5))
-                    found_error = True
-                    valid_course_data = False
-
-        if (num_term_code is None): 
-            error_list.append(InvalidDataException('Numeric term missing.', 
-                current_row, 6))
-            found_error = True
-            valid_course_data = False
-
-        if (course_id is None):
-            error_list.append(InvalidDataException('Course number missing.', 
-                current_row, 34))
-            found_error = True 
-            valid_course_data = False
-        elif (len(course_id) < 7 or len(course_id) > 9):
-            error_list.append(InvalidDataException('Invalid Course number.', 
-                current_row, 34))
-            found_error = True 
-            valid_course_data = False
-
-        course = None
-        # If the course data was all valid, get the course ID.
-        if (valid_course_data):
-            course = __insert_course(semester, year, num_term_code, course_id)
-
-        if (program_level is None):
-            error_list.append(InvalidDataException('Missing Program Level', 
-                current_row, 7))
-            found_error = True
-        elif (program_level not in ('UNDG', 'GRAD')):
-            error_list.append(InvalidDataException('Invalid Program Level (Must be either UNDG or GRAD)', 
-                current_row, 7))
-            found_error = True
-
-        if (subprogram_code is None):
-            error_list.append(InvalidDataException('Missing Subprogram Code', 
-                current_row, 8))
-            found_error = True
-
-        if (grade is None):
-            error_list.append(InvalidDataException('Missing Course Grade', 
-                    current_row, 35))
-            found_error = True
-            valid_course_data = False
-        else:
-            valid_grades = ('A', 'A-', 'B+', 'B', 'B-', 'C+', 'C', 'C-', 'D+', 
-                'D', 'D-', 'F', 'W', 'P', 'IP')
-            if (grade not in valid_grades):
-                error_list.append(InvalidDataException('Invalid Course Grade', 
-                    current_row))
-                found_error = True
-                valid_course_data = False
-
-        if (student_id is None):
-            error_list.append(InvalidDataException('Missing Unique_ID', 
-                    current_row, 1))
-            found_error = True
-
-        if (course and not found_error):
-            # Add the new ClassData entry.
-            new_class_data = ClassData(student_id=student_id,
-                program_level=program_level,
-                subprogram_code=subprogram_code,
-                grade=grade,
-                course=course)
-            db.session.add(new_class_data)
-            db.session.flush()
-                    
-
-def __insert_students(csv_file: DataFrame):
-    '''
-    Inserts all students into the database. Also reports invalid/missing data 
-    and inserts the error into the `error_list`.
+                __stage_students(students, ctx)
+                __stage_class_data(class_data, ctx)
+
+        ctx.job.add_rows(len(csv_file))
+        if (ctx.error_limit_reached()):
+            break
+        ctx.job.set_phase('parsing')
+
+
+def read_chunks(data: FileStorage, chunk_size: int,
+    schema: dict=UPLOAD_SCHEMA):
+    '''
+    Reads the uploaded file in chunks of rows, with the columns and types of
+    the schema. Files ending in `.xlsx` are read as workbooks, files
+    ending in `.gz` or `.zip` are decompressed as they are read, and every
+    other file is read as a csv file.
 
     param:
-        csv_file: The `DataFrame` object representing the data.
+        data: The `FileStorage` object containing the file.
+        chunk_size: The number of rows in each chunk.
+        schema: A `dict` mapping each column to its type. Defaults to
+            `UPLOAD_SCHEMA`.
+    return:
+        An iterator of `(sheet, DataFrame, errors)` tuples. The sheet is `None`
+        for csv files, and starts with the name of the file for the files in a
+        zip archive. The index of each chunk carries on from the last one in
+        the same sheet, so the line numbers of the errors match the file. The
+        errors are the `InvalidDataException` objects for the values that do
+        not match the type of their column, which are read as missing.
+    raises:
+        `UnreadableFileException` If the file cannot be decompressed or parsed.
+    '''
+    try:
+        for sheet, chunk in __read_file(data.stream, data.filename or '',
+            chunk_size, schema):
+            # Columns missing from the file are read as empty, and any extra
+            # columns are dropped.
+            chunk = chunk.reindex(columns=list(schema))
+            errors = __convert_numbers(chunk, schema)
+            yield sheet, chunk.astype(schema), errors
+    except (ValueError, TypeError, OSError, EOFError, BadZipFile,
+        zlib.error) as e:
+        raise UnreadableFileException(str(e)) from e
+
+
+def __convert_numbers(chunk: DataFrame,
+    schema: dict) -> list[InvalidDataException]:
+    '''
+    Converts the numeric columns of the chunk in place. Values that are not
+    numbers, and values with a fraction in a column of whole numbers, are
+    replaced with `NaN` and reported.
+
+    param:
+        chunk: The `DataFrame` read from the file.
+        schema: A `dict` mapping each column to its type.
+    return:
+        A `list` of `InvalidDataException` objects.
     '''
-    for idx in csv_file.index:
-        found_error = False
-        current_row = idx + 2
+    errors = []
+    for col_num, (column, dtype) in enumerate(schema.items(), start=1):
+        if (dtype not in ('Int64', 'float64')):
+            continue
 
-        # Check to see if the Student has already been added.
-        unique_id = csv_file['Unique_ID'][idx]
-        if (unique_id is None):
-            error_list.append(InvalidDataException('Unique ID missing.', 
-                current_row))
-            found_error = True
+        values = chunk[column]
+        try:
+            numbers = values.astype('float64')
+        except (ValueError, TypeError):
+            # Only a column holding a bad value is parsed one value at a
+            # time, which is much slower.
+            numbers = pd.to_numeric(values, errors='coerce')
+        invalid = numbers.isna() & values.notna()
+        if (dtype == 'Int64'):
+            invalid |= numbers.notna() & (numbers % 1 != 0)
+            message = f'{column} must be a whole number.'
         else:
-            # If the student exists, move to the next row of the data.
-            if Student.query.get(unique_id):
+            message = f'{column} must be a number.'
+        chunk[column] = numbers.mask(invalid)
+
+        # The first line of the file is the header.
+        errors.extend(InvalidDataException(message, int(row) + 2, col_num)
+            for row in chunk.index[invalid.to_numpy()])
+    return errors
+
+
+def __read_file(file, filename: str, chunk_size: int, schema: dict):
+    '''
+    Reads the file in chunks of rows with the reader that matches its name.
+
+    param:
+        file: The file object to read from.
+        filename: The name of the file.
+        chunk_size: The number of rows in each chunk.
+        schema: A `dict` mapping each column to its type.
+    return:
+        An iterator of `(sheet, DataFrame)` tuples.
+    '''
+    name = filename.lower()
+    if (name.endswith('.zip')):
+        yield from read_zip(file, chunk_size, schema)
+    elif (name.endswith('.gz')):
+        # The file is inflated as it is parsed, never all at once.
+        with GzipFile(fileobj=file) as inflated:
+            yield from __read_file(inflated, filename[:-3], chunk_size, schema)
+    elif (name.endswith('.xlsx')):
+        yield from read_xlsx(file, chunk_size)
+    else:
+        # Only the columns of the schema are read. Numbers are read as text
+        # and converted afterwards, so a value that is not a number is
+        # reported on its own line instead of failing the whole file.
+        parse_dtypes = {col: object if dtype in ('Int64', 'float64')
+            else dtype for col, dtype in schema.items()}
+        yield from ((None, chunk) for chunk in pd.read_csv(file,
+            chunksize=chunk_size, usecols=lambda col: col in schema,
+            dtype=parse_dtypes, keep_default_na=False, na_values=NA_VALUES))
+
+
+def read_zip(file, chunk_size: int, schema: dict=UPLOAD_SCHEMA):
+    '''
+    Reads every csv file and workbook in the zip archive in chunks of rows,
+    so an archive of several terms is uploaded as a single file. Each member is
+    inflated as it is read. Only the members kept by `is_data_member` are
+    read.
+
+    param:
+        file: The file object containing the archive.
+        chunk_size: The number of rows in each chunk.
+        schema: A `dict` mapping each column to its type.
+    return:
+        An iterator of `(sheet, DataFrame)` tuples, where the sheet is the name
+        of the member, followed by the name of the sheet for workbooks.
+    '''
+    with ZipFile(file) as archive:
+        for member in archive.infolist():
+            if (not is_data_member(member)):
                 continue
-        admit_year = csv_file['Admit_Year'][idx]
-        admit_term = csv_file['Admit_Term'][idx]
-        admit_type = csv_file['Admit_Type'][idx]
-        major_1_code = csv_file['Major1_Code'][idx]
-        major_1_desc = csv_file['Major1_Desc'][idx]
-        major_2_code = csv_file['Major2_Code'][idx]
-        major_2_desc = csv_file['Major2_Desc'][idx]
-        minor_1_code = csv_file['Minor1_Code'][idx]
-        minor_1_desc = csv_file['Minor1_Desc'][idx]
-        concentration_code = csv_file['Concentration_Code'][idx]
-        concentration_desc = csv_file['Concentration_Desc'][idx]
-        class_year = csv_file['Class'][idx]
-        city = csv_file['City'][idx]
-        state = csv_file['State'][idx]
-        postal_code = csv_file['Postal_Code'][idx]
-        country = csv_file['Country_Code'][idx]
-        race_ethnicity = csv_file['Race-Ethnicity'][idx]
-        gender = csv_file['Sex'][idx]
-        gpa_cumulative = csv_file['GPA_Cum'][idx]
-        sat_math = csv_file['SAT_Math'][idx]
-        sat_total = csv_file['SAT_Total'][idx]
-        act_score = csv_file['ACT_Score'][idx]
-        math_placement_score = csv_file['Math_Placement'][idx]
-        hs_gpa = csv_file['HS_GPA'][idx]
-        hs_ceeb = csv_file['HS_CEEB'][idx]
-        hs_name = csv_file['HS_Name'][idx]
-        hs_city = csv_file['HS_City'][idx]
-        hs_state = csv_file['HS_State'][idx]
-        cohort = csv_file['Cohort'][idx]
-
-        if (admit_year is None):
-            error_list.append(InvalidDataException('Admit year missing.', 
-                current_row, 2))
-            found_error = True
-
-        if (admit_term is None):
-            error_list.append(InvalidDataException('Admit term missing.', 
-                current_row, 3))
-            found_error = True
-
-        if (admit_type is None):
-            error_list.append(InvalidDataException('Admit type missing.', 
-                current_row, 4))
-            found_error = True
-
-        if (major_1_code is None):
-            error_list.append(InvalidDataException('Major1_Code missing.', 
-                current_row, 9))
-            found_error = True
-
-        if (major_1_desc is None):
-            error_list.append(InvalidDataException('Major1_Desc missing.', 
-                current_row, 10))
-            found_error = True
-
-        # Try to parse the class year if it exists, reporting a failed parse.
-        if (class_year is None):
-            error_list.append(InvalidDataException('Class missing.', 
-                current_row, 17))
-            found_error = True
-        else:
-            try:
-                class_year = ClassEnum.parse_class(class_year)
-            except InvalidClassException:
-                error_list.append(InvalidDataException('Invalid Class', 
-                    current_row, 17))
-                found_error = True
-
-        if (city is None):
-            error_list.append(InvalidDataException('City missing.', 
-                current_row, 18))
-            found_error = True
-
-        if (postal_code is None):
-            error_list.append(InvalidDataException('Postal_Code missing.', 
-                current_row, 19))
-            found_error = True
-
-        if (country is None):
-            error_list.append(InvalidDataException('Country_Code missing.', 
-                current_row, 20))
-            found_error = True
-
-        if (race_ethnicity is None):
-            error_list.append(InvalidDataException('Race-Ethnicity missing.', 
-                current_row, 21))
-            found_error = True
-        
-        if (gender is None):
-            error_list.append(InvalidDataException('Sex missing.', 
-                current_row, 22))
-            found_error = True
-
-        if (gpa_cumulative is None):
-            gpa_cumulative = 0.00
-
-        if (not found_error):
-            new_student = Student(id=unique_id,
-                admit_year=admit_year,
-                admit_term=admit_term,
-                admit_type=admit_type,
-                major_1=major_1_code,
-                major_1_desc=major_1_desc,
-                major_2=major_2_code,
-                major_2_desc=major_2_desc,
-                minor_1=minor_1_code,
-                minor_1_desc=minor_1_desc,
-                concentration_code=concentration_code,
-                concentration_desc=concentration_desc,
-                class_year=class_year,
-                city=city,
-                state=state,
-                country=country,
-                postal_code=postal_code,
-                math_placement_score=math_placement_score,
-                race_ethnicity=race_ethnicity,
-                gender=gender,
-                gpa_cumulative=gpa_cumulative,
-                high_school_gpa=hs_gpa,
-                sat_math=sat_math,
-                sat_total=sat_total,
-                act_score=act_score,
-                high_school_name=hs_name,
-                high_school_city=hs_city,
-                high_school_state=hs_state,
-                high_school_ceeb=hs_ceeb,
-                cohort=cohort
-            )
-            db.session.add(new_student)
-
-
-def __process_errors(errors: list[InvalidDataException]) -> list[dict]:
-    '''
-    Processes the errors that were found and formats them in a `list` of `dict` 
-    objects.
 
-    param: 
-        errors: The `list` of errors to process.
-    
+            with archive.open(member) as member_file:
+                for sheet, chunk in __read_file(member_file, member.filename,
+                    chunk_size, schema):
+                    yield (member.filename if sheet is None
+                        else f'{member.filename}: {sheet}'), chunk
+
+
+def is_data_member(member: ZipInfo) -> bool:
+    '''
+    Returns whether the member of a zip archive is a file that can be read.
+    Folders and the hidden files added by macOS are skipped.
+
+    param:
+        member: The `ZipInfo` of the member.
     return:
-        A `list` of `dict` objects that is in a JSON-like format.
+        A `bool` representing if the member should be read.
     '''
-    return [{
-        'error_message': error.message, 'line_num': error.line_num, 
-        'col_num': error.col_num
-    } for error in errors]
\ No newline at end of file
+    name = path.basename(member.filename)
+    return not (member.is_dir() or member.filename.startswith('__MACOSX/')
+        or name.startswith('.'))
+
+
+def read_xlsx(file, chunk_size: int):
+    '''
+    Reads every sheet of the uploaded workbook in chunks of rows. The workbook
+    is opened in read-only mode, so its rows are streamed from the file rather
+    than all being loaded at once. Empty rows and sheets without any data are
+    skipped.
+
+    param:
+        file: The file object containing the workbook.
+        chunk_size: The number of rows in each chunk.
+    return:
+        An iterator of `(sheet, DataFrame)` tuples.
+    '''
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if (header is None):
+                continue
+            columns = [HEADER_NOTE.sub('', str(name)) if name is not None
+                else f'Unnamed: {col}' for col, name in enumerate(header)]
+
+            values, index = [], []
+            # The header is line 1, so the first row is at index 0 like it is
+            # in a csv file.
+            for row_num, row in enumerate(rows):
+                if (all(value is None or value == '' for value in row)):
+                    continue
+                # Rows may have more or fewer cells than the header.
+                row = row[:len(columns)] + (None,) * (len(columns) - len(row))
+                values.append([__cell_value(value) for value in row])
+                index.append(row_num)
+                if (len(values) == chunk_size):
+                    yield sheet.title, DataFrame(values, index, columns)
+                    values, index = [], []
+            if (len(values) > 0):
+                yield sheet.title, DataFrame(values, index, columns)
+    finally:
+        workbook.close()
+
+
+def __cell_value(value):
+    '''
+    Converts the value of a cell to the value pandas would read from a csv
+    file. Whole numbers are stored as floats in a workbook, so they are turned
+    back into `int`s, and empty strings become `None`.
+
+    param:
+        value: The value of the cell.
+    return:
+        The converted value.
+    '''
+    if (isinstance(value, float) and value.is_integer()):
+        return int(value)
+    elif (value == ''):
+        return None
+    else:
+        return value
+
+
+def __validate_students(csv_file: DataFrame,
+    ctx: UploadContext) -> tuple[DataFrame, list[InvalidDataException]]:
+    '''
+    Validates the students in the data.
+
+    param:
+        csv_file: The `DataFrame` object representing the data.
+        ctx: The `UploadContext` of the upload. The new students are added to
+            its known students.
+    return:
+        A `tuple` containing a `DataFrame` holding one valid row for each new
+        student, and the `list` of errors that were found.
+    '''
+    # Students that are being updated are checked like new students.
+    if (not ctx.update_students):
+        unique_ids = csv_file['Unique_ID']
+        ctx.known_students |= find_existing_students(
+            unique_ids[~unique_ids.isin(ctx.known_students)])
+
+    # Only one valid row is kept for each new student, so students repeated in
+    # the file are never inserted twice.
+    students, errors = validate_students(csv_file, ctx.known_students)
+    ctx.known_students.update(students['Unique_ID'])
+    return students, errors
+
+
+def __validate_mcas_scores(csv_file: DataFrame,
+    ctx: UploadContext) -> tuple[DataFrame, list[InvalidDataException]]:
+    '''
+    Validates the MCAS scores in the data.
+
+    param:
+        csv_file: The `DataFrame` object representing the scores.
+        ctx: The `UploadContext` of the upload. The students that are found
+            are added to its known students.
+    return:
+        A `tuple` containing a `DataFrame` of the valid scores, and the `list`
+        of errors that were found.
+    '''
+    unique_ids = csv_file['Unique_ID']
+    ctx.known_students |= find_existing_students(
+        unique_ids[~unique_ids.isin(ctx.known_students)])
+    return validate_mcas_scores(csv_file, ctx.known_students)
+
+
+def delete_term(term_code: str) -> dict:
+    '''
+    Deletes the Class Data and courses of the term in a single transaction.
+    The data is only given a new version if anything was deleted.
+
+    param:
+        term_code: The numeric term code, e.g. `202140`.
+    return:
+        A `dict` holding the number of courses and Class Data rows that were
+        deleted.
+    '''
+    with write_lock, db.engine.begin() as conn:
+        counts = delete_terms(conn, [str(term_code)])
+        if (counts['class_data'] > 0 or counts['courses'] > 0):
+            DataVersion.bump(conn)
+        return counts
+
+
+def __stage_class_data(class_data: DataFrame, ctx: UploadContext):
+    '''
+    Stages the valid Class Data, along with the key of its course.
+
+    param:
+        class_data: The `DataFrame` holding the valid Class Data rows.
+        ctx: The `UploadContext` of the upload.
+    '''
+    rows = class_data[list(CLASS_DATA_COLUMNS)].rename(
+        columns=CLASS_DATA_COLUMNS)
+    rows['term_code'] = class_data['Numeric_Term_Code'].astype(str)
+    rows['course_num'] = class_data['Course_Number'].astype(str)
+    rows['semester'] = class_data['Semester']
+    rows['year'] = class_data['Year'].astype(int)
+
+    # Rows that are repeated in the file are only staged once, and rows that
+    # were uploaded before are skipped when they are promoted.
+    rows['fingerprint'] = fingerprint_rows(rows)
+    ctx.get_staging().stage_class_data(rows.drop_duplicates('fingerprint'))
+
+
+def __stage_students(students: DataFrame, ctx: UploadContext):
+    '''
+    Stages the new students.
+
+    param:
+        students: The `DataFrame` holding one valid row for each new student.
+        ctx: The `UploadContext` of the upload.
+    '''
+    rows = students[list(STUDENT_COLUMNS)].rename(columns=STUDENT_COLUMNS)
+    ctx.get_staging().stage_students(rows.drop_duplicates('id'))
+
+
+def __stage_mcas_scores(scores: DataFrame, ctx: UploadContext):
+    '''
+    Stages the valid MCAS scores.
+
+    param:
+        scores: The `DataFrame` holding the valid MCAS scores.
+        ctx: The `UploadContext` of the upload.
+    '''
+    rows = scores[list(MCAS_COLUMNS)].rename(columns=MCAS_COLUMNS)
+    ctx.get_staging().stage_mcas_scores(rows.drop_duplicates('student_id'))
+
+
+def find_existing_students(unique_ids) -> set:
+    '''
+    Finds which of the given students are already in the database. Each
+    distinct ID is only looked up once, using chunked `IN (...)` queries.
+
+    param:
+        unique_ids: The Unique_IDs to look up. Missing IDs are ignored.
+    return:
+        A `set` of the Unique_IDs that already exist.
+    '''
+    distinct_ids = pd.unique(pd.Series(unique_ids).dropna())
+    existing_ids = set()
+    for start in range(0, len(distinct_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = distinct_ids[start:start + IN_CLAUSE_CHUNK_SIZE].tolist()
+        existing_ids.update(unique_id for unique_id, in db.session.query(
+            Student.id).filter(Student.id.in_(chunk)))
+    return existing_ids
+
+
+def fingerprint_rows(rows: DataFrame) -> Series:
+    '''
+    Returns a 64-bit hash of the student, course, program and grade of each
+    Class Data row. The course is hashed by its term code, number, semester
+    and year, so the fingerprint does not depend on the ID of the course.
+    Numbers are hashed the same way whether they were read as an `int`, a
+    `float` or a `str`, so the same row always gets the same fingerprint.
+
+    param:
+        rows: A `DataFrame` with the columns of `FINGERPRINT_COLUMNS`.
+    return:
+        A `Series` holding the fingerprint of each row.
+    '''
+    keys = DataFrame({column: __normalize(rows[column])
+        for column in FINGERPRINT_COLUMNS}, index=rows.index)
+
+    # SQLite stores signed 64-bit integers.
+    return pd.util.hash_pandas_object(keys, index=False).astype('int64')
+
+
+def __normalize(column: Series) -> Series:
+    '''
+    Converts each value of the column to a `str`, writing whole numbers without
+    a decimal point.
+
+    param:
+        column: The `Series` to convert.
+    return:
+        A `Series` of `str` values.
+    '''
+    numbers = pd.to_numeric(column, errors='coerce')
+    whole = numbers.notna() & (numbers % 1 == 0)
+    return column.astype(str).mask(whole,
+        numbers[whole].astype('int64').astype(str))
+
+
+def hash_file(data: FileStorage) -> str:
+    '''
+    Returns the SHA-256 hash of the file's contents. The file is read in blocks
+    and then rewound, so it can still be parsed.
+
+    param:
+        data: The `FileStorage` object containing the file.
+    return:
+        A `str` holding the hex digest of the file.
+    '''
+    file_hash = sha256()
+    for block in iter(lambda: data.stream.read(HASH_BLOCK_SIZE), b''):
+        file_hash.update(block)
+    data.stream.seek(0)
+    return file_hash.hexdigest()
+
@@ -21,13 +21,16 @@
 
 
 from . import dash_bp
-from app import app, mail
+from app import app, mail, job_runner
 from flask_mail import Message
-from flask import render_template, request, make_response, send_file
+from flask import (render_template, request, make_response, send_file,
+    url_for)
 from flask_login import login_required, current_user
 from app import admin_required, data_admin_or_higher_required
-from app.blueprints.dashboard.data_upload import upload_csv_file
-from app.models import RoleEnum, User, ClassData, Course, Student, Utils
+from app.blueprints.dashboard.data_upload import (start_upload,
+    upload_csv_file, delete_term, DATA_TYPES)
+from app.models import (RoleEnum, User, ClassData, Course, Student, Utils,
+    IngestionRecord)
 import pandas as pd
 from os import getcwd, path
 
@@ -35,16 +38,12 @@ from os import getcwd, path
 @login_required
 def get_dash():
     name = current_user.first_name + ' ' + current_user.last_name
-    dwf_avg = ClassData.get_avg_dwf()
-    avg_gpa = Student.get_avg_gpa()
-    avg_course_grade = ClassData.get_avg_grade()
-    total_students = len(Student.query.all())
+    kpis = Utils.get_kpis('dwf_avg', 'avg_gpa', 'avg_course_grade',
+        'total_students')
     num_students_per_major = Student.get_num_students_per_major()
     
     return render_template('dashboard/dashboard.html', current_user=current_user,
-        user_name=name, dwf_avg=dwf_avg, avg_gpa=avg_gpa, 
-        avg_course_grade=avg_course_grade, total_students=total_students,
-        num_students_per_major=num_students_per_major)
+        user_name=name, num_students_per_major=num_students_per_major, **kpis)
 
 
 @dash_bp.route('/data', methods = ['GET'])
@@ -59,15 +58,12 @@ def get_data():
 @login_required
 def get_visualizations():
     name = current_user.first_name + ' ' + current_user.last_name
-    dwf_avg = ClassData.get_avg_dwf()
-    avg_gpa = Student.get_avg_gpa()
-    avg_course_grade = ClassData.get_avg_grade()
-    total_students = len(Student.query.all())
+    kpis = Utils.get_kpis('dwf_avg', 'avg_gpa', 'avg_course_grade',
+        'total_students')
     lowest_highest_years = Course.get_highest_lowest_years()
     return render_template('dashboard/visualizations.html', 
-        current_user=current_user, user_name=name, dwf_avg=dwf_avg, 
-        avg_gpa=avg_gpa, avg_course_grade=avg_course_grade, 
-        total_students=total_students, lowest_highest_years = lowest_highest_years)
+        current_user=current_user, user_name=name, 
+        lowest_highest_years = lowest_highest_years, **kpis)
 
 
 @dash_bp.route('/dataadmin', methods = ['GET'])
@@ -81,10 +77,12 @@ def get_data_admin():
     total_users = len(user_query.all())
     total_students = len(Student.query.all())
     total_data_admins = len(User.query.filter(User.role==RoleEnum.DATA_ADMIN).all())
+    ingestion_history = IngestionRecord.get_recent()
     
     return render_template('dashboard/dataadmin.html', current_user=current_user, 
             user_name=name, total_admins=total_admins, total_users=total_users,
-            total_students=total_students, total_data_admins=total_data_admins)
+            total_students=total_students, total_data_admins=total_data_admins,
+            ingestion_history=ingestion_history)
 
 @dash_bp.route('/admin', methods = ['GET'])
 @login_required
@@ -174,11 +172,100 @@ def change_role():
 def upload_data():
     if 'file' in request.files.keys():
         uploaded_file = request.files['file']
-        return upload_csv_file(uploaded_file)
+        if not uploaded_file:
+            return {'message': 'Unable to read file'}, 400
+
+        max_errors = request.form.get('max_errors')
+        if (max_errors is not None):
+            if (not max_errors.isdigit() or int(max_errors) < 1):
+                return {'message': 'Invalid max_errors.'}, 400
+            max_errors = int(max_errors)
+
+        # Existing students are only updated when asked for.
+        update_students = (request.form.get('update_students',
+            'false').lower() == 'true')
+
+        # The terms in the file replace the stored ones when asked for.
+        replace_terms = (request.form.get('replace_terms',
+            'false').lower() == 'true')
+
+        # Class Data is uploaded unless another kind of data is asked for.
+        data_type = request.form.get('data_type', 'class_data')
+        if (data_type not in DATA_TYPES):
+            return {'message': 'Invalid data_type.'}, 400
+
+        # The user is recorded in the upload's ingestion history.
+        user = getattr(current_user, 'email', None)
+
+        # A dry run never writes to the database, so it is validated right away
+        # instead of waiting for a background job.
+        if (request.form.get('dry_run', 'false').lower() == 'true'):
+            return upload_csv_file(uploaded_file, dry_run=True,
+                max_errors=max_errors, update_students=update_students,
+                replace_terms=replace_terms, user=user, data_type=data_type)
+
+        # The file is inserted in the background, the status can be followed
+        # with /upload-status/<job_id>.
+        job = start_upload(uploaded_file, max_errors, update_students,
+            replace_terms, user, data_type)
+        return {'message': 'Upload started.', 'job_id': job.id}, 202
     else:
         return {'message': 'Missing file.'}, 400
 
 
+@dash_bp.route('/upload-status/<job_id>', methods = ['GET'])
+@admin_required
+@login_required
+def get_upload_status(job_id: str):
+    job = job_runner.get(job_id)
+    if (job is None):
+        return {'message': 'Upload not found.'}, 404
+    else:
+        status = job.to_dict()
+        if ('errors' in job.files):
+            status['errors_url'] = url_for('dashboard.get_upload_errors',
+                job_id=job_id)
+        return status, 200
+
+
+@dash_bp.route('/upload-errors/<job_id>', methods = ['GET'])
+@admin_required
+@login_required
+def get_upload_errors(job_id: str):
+    job = job_runner.get(job_id)
+    if (job is None or 'errors' not in job.files):
+        return {'message': 'Upload errors not found.'}, 404
+    else:
+        # The file is streamed, so it is never loaded into memory at once.
+        return send_file(job.files['errors'], mimetype='text/csv',
+            as_attachment=True, download_name='upload_errors.csv')
+
+
+@dash_bp.route('/ingestion-history', methods = ['GET'])
+@login_required
+@data_admin_or_higher_required
+def get_ingestion_history():
+    limit = request.args.get('limit', '20')
+    if (not limit.isdigit() or int(limit) < 1):
+        return {'message': 'Invalid limit.'}, 400
+    return {'uploads': [record.to_dict() for record in
+        IngestionRecord.get_recent(int(limit))]}, 200
+
+
+@dash_bp.route('/terms/<term_code>', methods = ['DELETE'])
+@admin_required
+@login_required
+def delete_term_data(term_code: str):
+    if (not term_code.isdigit()):
+        return {'message': 'Invalid term code.'}, 400
+
+    counts = delete_term(term_code)
+    if (counts['courses'] == 0):
+        return {'message': 'Term not found.'}, 404
+    else:
+        return {'message': 'Success.', 'rows_deleted': counts}, 200
+
+
 @dash_bp.route('/all-data', methods = ['GET'])
 @login_required
 def all_data():
@@ -188,9 +275,7 @@ def all_data():
     else:
         limit = None
 
-    data = ClassData.get_data()
-
-    if (limit is not None and limit > len(data)):
+    if (limit is not None and limit > ClassData.query.count()):
         return {'message': 'Limit out of bounds.'}, 400
     else:
         data = ClassData.get_data(limit)
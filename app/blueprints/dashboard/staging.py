@@ -0,0 +1,423 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil.
+#
+# This file is part of STEM Data Dashboard.
+#
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy import (MetaData, Table, Column, Integer, Text, select, func,
+    exists, and_, or_, true, literal)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from app.models import (Student, ClassData, Course, MCASScore, UploadedFile,
+    UploadedFileTerm, DataVersion)
+from app import db
+
+# The staging tables are temporary, so they are never made by `db.create_all`
+# and each connection only ever sees its own.
+staging_metadata = MetaData()
+
+staging_students = Table('staging_students', staging_metadata,
+    *[Column(col.name, col.type.copy(), primary_key=col.primary_key)
+        for col in Student.__table__.columns],
+    prefixes=['TEMPORARY'])
+
+staging_mcas_scores = Table('staging_mcas_scores', staging_metadata,
+    *[Column(col.name, col.type.copy(), primary_key=col.primary_key)
+        for col in MCASScore.__table__.columns],
+    prefixes=['TEMPORARY'])
+
+staging_class_data = Table('staging_class_data', staging_metadata,
+    Column('fingerprint', Integer(), primary_key=True, autoincrement=False),
+    Column('student_id', Text(), nullable=False),
+    Column('program_level', Text(), nullable=False),
+    Column('subprogram_code', Text(), nullable=False),
+    Column('grade', Text(), nullable=False),
+    Column('term_code', Text(), nullable=False),
+    Column('course_num', Text(), nullable=False),
+    Column('semester', Text(), nullable=False),
+    Column('year', Integer(), nullable=False),
+    prefixes=['TEMPORARY'])
+
+# The columns that make up the natural key of a course.
+COURSE_KEY = ['term_code', 'course_num', 'semester', 'year']
+
+# The values given to new students when the file leaves them out. Students
+# that are updated keep their stored values instead.
+STUDENT_DEFAULTS = {'gpa_cumulative': 0.00}
+
+
+class StagedRows:
+    '''
+    Holds staged rows in memory in place of a `StagingArea`, so the rows of a
+    file validated in another process can be sent back and staged there.
+    '''
+    def __init__(self):
+        self.students = []
+        self.class_data = []
+        self.mcas_scores = []
+
+    def stage_students(self, rows: DataFrame):
+        '''
+        Keeps the students.
+
+        param:
+            `rows`: A `DataFrame` whose columns match the `students` table.
+        '''
+        self.students.append(rows)
+
+    def stage_class_data(self, rows: DataFrame):
+        '''
+        Keeps the Class Data.
+
+        param:
+            `rows`: A `DataFrame` whose columns match the staging table.
+        '''
+        self.class_data.append(rows)
+
+    def stage_mcas_scores(self, rows: DataFrame):
+        '''
+        Keeps the MCAS scores.
+
+        param:
+            `rows`: A `DataFrame` whose columns match the `mcas_scores` table.
+        '''
+        self.mcas_scores.append(rows)
+
+    def term_codes(self) -> set:
+        '''
+        Returns the terms of the kept Class Data.
+
+        return:
+            A `set` of the numeric term codes.
+        '''
+        return set().union(*[rows['term_code'] for rows in self.class_data])
+
+    def stage_into(self, staging: 'StagingArea'):
+        '''
+        Stages the kept rows, merging the rows of every chunk so each table is
+        written in one go.
+
+        param:
+            `staging`: The `StagingArea` to stage the rows in.
+        '''
+        if (len(self.students) > 0):
+            staging.stage_students(pd.concat(self.students))
+        if (len(self.class_data) > 0):
+            staging.stage_class_data(pd.concat(self.class_data))
+        if (len(self.mcas_scores) > 0):
+            staging.stage_mcas_scores(pd.concat(self.mcas_scores))
+
+    def close(self):
+        '''
+        Nothing is held outside of memory, so there is nothing to close.
+        '''
+        pass
+
+
+class StagingArea:
+    '''
+    Holds the rows of an upload in temporary tables on its own connection until
+    they are promoted to the live tables. Staging only writes to the temporary
+    tables, so the database is only locked while the rows are promoted.
+
+    param:
+        `batch_size`: The number of rows to stage at a time.
+    '''
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.conn = db.engine.connect()
+        staging_metadata.create_all(self.conn)
+
+    def stage_students(self, rows: DataFrame):
+        '''
+        Stages the students. A student that was already staged is kept as it
+        is.
+
+        param:
+            `rows`: A `DataFrame` whose columns match the `students` table.
+        '''
+        bulk_insert(sqlite_insert(staging_students).on_conflict_do_nothing(),
+            rows, self.batch_size, self.conn)
+
+    def stage_class_data(self, rows: DataFrame):
+        '''
+        Stages the Class Data. Rows with the same fingerprint as a row that was
+        already staged are skipped.
+
+        param:
+            `rows`: A `DataFrame` whose columns match the staging table.
+        '''
+        bulk_insert(sqlite_insert(staging_class_data).on_conflict_do_nothing(),
+            rows, self.batch_size, self.conn)
+
+    def stage_mcas_scores(self, rows: DataFrame):
+        '''
+        Stages the MCAS scores. A student whose scores were already staged
+        keeps the first scores.
+
+        param:
+            `rows`: A `DataFrame` whose columns match the `mcas_scores` table.
+        '''
+        bulk_insert(sqlite_insert(staging_mcas_scores).on_conflict_do_nothing(),
+            rows, self.batch_size, self.conn)
+
+    def promote(self, files: list[dict], update_students: bool=False,
+        replace_terms: bool=False) -> dict:
+        '''
+        Copies the staged rows into the live tables in a single transaction,
+        using `INSERT ... SELECT` statements. Courses and students that already
+        exist, and Class Data whose fingerprint already exists, are skipped. The
+        CHECK constraints of the live tables are enforced as the rows are
+        copied, so nothing is promoted if any row breaks one.
+
+        New students are given the values of `STUDENT_DEFAULTS` for the ones
+        missing from the file. When `update_students` is set, students that
+        already exist are updated instead of skipped. Only the students whose
+        attributes changed are written, and a value missing from the file keeps
+        the stored value.
+
+        Staged MCAS scores always replace the stored scores of their student,
+        keeping any stored score that the file left out.
+
+        When `replace_terms` is set, the Class Data and courses of every term in
+        the file are deleted first, in the same transaction, so each term is
+        replaced by the file all at once. The data is given a new version in
+        the same transaction.
+
+        param:
+            `files`: A `dict` for each file the rows came from, holding its
+                `file_hash`, `filename` and `num_rows`, which are recorded so
+                the same file is skipped next time. Its `term_codes` may also
+                be given, otherwise every staged term is linked to it.
+            `update_students`: Whether students that already exist should be
+                updated.
+            `replace_terms`: Whether the terms in the file should replace the
+                stored ones.
+        return:
+            A `dict` holding the number of courses, students, Class Data rows
+            and MCAS scores that were added, or for students and MCAS scores,
+            added or updated.
+        raises:
+            `IntegrityError` If a row breaks a constraint of the live tables.
+        '''
+        staged_terms = select(staging_class_data.c.term_code).distinct()
+        with self.conn.begin():
+            if (replace_terms):
+                delete_terms(self.conn, staged_terms)
+
+            counts = {
+                'courses': self.conn.execute(self.__promote_courses()).rowcount,
+                'students':
+                    self.conn.execute(self.__promote_students()).rowcount,
+                'class_data':
+                    self.conn.execute(self.__promote_class_data()).rowcount,
+                'mcas_scores':
+                    self.conn.execute(self.__upsert_mcas_scores()).rowcount
+            }
+            if (update_students):
+                # The new students were added above, so only the students
+                # that already existed are left to update.
+                counts['students'] += self.conn.execute(
+                    self.__upsert_students()).rowcount
+            for file in files:
+                self.__record_file(file, staged_terms)
+            DataVersion.bump(self.conn)
+        return counts
+
+    def close(self):
+        '''
+        Drops the staging tables and closes the connection.
+        '''
+        try:
+            staging_metadata.drop_all(self.conn)
+        finally:
+            self.conn.close()
+
+    def __record_file(self, file: dict, staged_terms):
+        '''
+        Records the file and the terms it held.
+
+        param:
+            `file`: A `dict` holding the `file_hash`, `filename`, `num_rows`
+                and optionally the `term_codes` of the file.
+            `staged_terms`: The `SELECT` of every staged term.
+        '''
+        self.conn.execute(sqlite_insert(UploadedFile.__table__).values(
+            file_hash=file['file_hash'], filename=file['filename'],
+            num_rows=file['num_rows']).on_conflict_do_nothing())
+
+        file_terms = sqlite_insert(UploadedFileTerm.__table__
+            ).on_conflict_do_nothing()
+        if (file.get('term_codes') is None):
+            self.conn.execute(file_terms.from_select(['file_hash', 'term_code'],
+                select(literal(file['file_hash']),
+                    staged_terms.subquery().c.term_code).where(true())))
+        elif (len(file['term_codes']) > 0):
+            self.conn.execute(file_terms, [{'file_hash': file['file_hash'],
+                'term_code': term_code} for term_code in file['term_codes']])
+
+    @staticmethod
+    def __promote_courses():
+        '''
+        Returns the statement that adds the staged courses that do not exist.
+        '''
+        courses = Course.__table__
+        staged = select(*[staging_class_data.c[col] for col in COURSE_KEY]
+            ).distinct().where(~exists().where(and_(*[courses.c[col] ==
+                staging_class_data.c[col] for col in COURSE_KEY])))
+        return courses.insert().from_select(COURSE_KEY, staged)
+
+    @staticmethod
+    def __promote_students():
+        '''
+        Returns the statement that adds the staged students that do not exist,
+        filling in `STUDENT_DEFAULTS`.
+        '''
+        students = Student.__table__
+        columns = [col.name for col in staging_students.columns]
+        staged = select(*[func.coalesce(col, STUDENT_DEFAULTS[col.name]).label(
+            col.name) if col.name in STUDENT_DEFAULTS else col
+            for col in staging_students.columns]).where(~exists().where(
+            students.c.id == staging_students.c.id))
+        return students.insert().from_select(columns, staged)
+
+    @staticmethod
+    def __upsert_students():
+        '''
+        Returns the statement that updates the staged students that already
+        exist and have changed.
+        '''
+        return StagingArea.__upsert(Student.__table__, staging_students, 'id')
+
+    @staticmethod
+    def __upsert_mcas_scores():
+        '''
+        Returns the statement that adds the staged MCAS scores, updating the
+        ones that already exist and have changed.
+        '''
+        return StagingArea.__upsert(MCASScore.__table__, staging_mcas_scores,
+            'student_id')
+
+    @staticmethod
+    def __upsert(live: Table, staged: Table, key: str):
+        '''
+        Returns the statement that copies the staged rows into the live table.
+        Rows whose key already exists are only written if a value changed, and
+        a missing value keeps the stored value.
+
+        param:
+            `live`: The live `Table`.
+            `staged`: The staging `Table` with the same columns.
+            `key`: The name of the primary key column.
+        '''
+        columns = [col.name for col in staged.columns]
+
+        # SQLite needs a WHERE clause to tell the SELECT apart from the ON
+        # CONFLICT clause.
+        statement = sqlite_insert(live).from_select(columns,
+            select(*staged.columns).where(true()))
+        updates = {col: func.coalesce(statement.excluded[col], live.c[col])
+            for col in columns if col != key}
+        return statement.on_conflict_do_update(index_elements=[key],
+            set_=updates, where=or_(*[live.c[col].isnot(value)
+                for col, value in updates.items()]))
+
+    @staticmethod
+    def __promote_class_data():
+        '''
+        Returns the statement that adds the staged Class Data whose fingerprint
+        does not exist, linked to the ID of its course.
+        '''
+        class_data = ClassData.__table__
+        courses = Course.__table__
+
+        # Only the first course is used if a course was ever added twice.
+        course_ids = select(func.min(courses.c.id).label('id'),
+            *[courses.c[col] for col in COURSE_KEY]).group_by(
+                *[courses.c[col] for col in COURSE_KEY]).subquery()
+
+        staged = select(staging_class_data.c.student_id,
+            staging_class_data.c.program_level,
+            staging_class_data.c.subprogram_code, staging_class_data.c.grade,
+            course_ids.c.id, staging_class_data.c.fingerprint).join(course_ids,
+                and_(*[course_ids.c[col] == staging_class_data.c[col]
+                    for col in COURSE_KEY])).where(~exists().where(
+                        class_data.c.fingerprint ==
+                        staging_class_data.c.fingerprint))
+        return class_data.insert().from_select(['student_id', 'program_level',
+            'subprogram_code', 'grade', 'course', 'fingerprint'], staged)
+
+
+def delete_terms(conn, term_codes) -> dict:
+    '''
+    Deletes the Class Data and courses of the terms with set-based `DELETE`
+    statements, which use the indexes on `courses.term_code` and
+    `class_data.course`. The files that held the terms are forgotten, so they
+    can be uploaded again. Students are kept, since they belong to more than one
+    term.
+
+    param:
+        conn: The `Connection` to delete with, inside of a transaction.
+        term_codes: The numeric term codes, either as a `list` or as a
+            `SELECT` of them.
+    return:
+        A `dict` holding the number of courses and Class Data rows that were
+        deleted.
+    '''
+    courses = Course.__table__
+    class_data = ClassData.__table__
+    file_terms = UploadedFileTerm.__table__
+    files = UploadedFile.__table__
+
+    term_course_ids = select(courses.c.id).where(
+        courses.c.term_code.in_(term_codes))
+    term_files = select(file_terms.c.file_hash).where(
+        file_terms.c.term_code.in_(term_codes))
+
+    counts = {
+        'class_data': conn.execute(class_data.delete().where(
+            class_data.c.course.in_(term_course_ids))).rowcount,
+        'courses': conn.execute(courses.delete().where(
+            courses.c.term_code.in_(term_codes))).rowcount
+    }
+    conn.execute(files.delete().where(files.c.file_hash.in_(term_files)))
+    conn.execute(file_terms.delete().where(
+        file_terms.c.file_hash.in_(term_files)))
+    return counts
+
+
+def bulk_insert(statement, rows: DataFrame, batch_size: int, bind=None):
+    '''
+    Runs the INSERT statement for the rows in batches (executemany).
+
+    param:
+        statement: The INSERT statement, e.g. `Table.insert()`.
+        rows: A `DataFrame` whose columns match the columns of the table.
+        batch_size: The number of rows to send in each INSERT.
+        bind: The `Connection` to insert with. Defaults to the current
+            session, so the rows are only saved once the session is committed.
+    '''
+    bind = bind if bind is not None else db.session
+
+    # Missing values must be sent as NULL.
+    rows = rows.astype(object).where(rows.notna(), None)
+    for start in range(0, len(rows), batch_size):
+        batch = rows.iloc[start:start + batch_size].to_dict('records')
+        bind.execute(statement, batch)
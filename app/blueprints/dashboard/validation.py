@@ -0,0 +1,334 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil.
+#
+# This file is part of STEM Data Dashboard.
+#
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+from app.models import ClassEnum, InvalidClassException
+
+VALID_SEMESTERS = ('FA', 'SP', 'SU', 'WI')
+VALID_PROGRAM_LEVELS = ('UNDG', 'GRAD')
+VALID_GRADES = ('A', 'A-', 'B+', 'B', 'B-', 'C+', 'C', 'C-', 'D+', 'D', 'D-',
+    'F', 'W', 'P', 'IP')
+
+# The required Student columns, in the order they are reported, along with the
+# error message and column number reported when they are missing.
+REQUIRED_STUDENT_COLUMNS = (
+    ('Admit_Year', 'Admit year missing.', 2),
+    ('Admit_Term', 'Admit term missing.', 3),
+    ('Admit_Type', 'Admit type missing.', 4),
+    ('Major1_Code', 'Major1_Code missing.', 9),
+    ('Major1_Desc', 'Major1_Desc missing.', 10)
+)
+
+# The MCAS subjects, along with the column numbers of their raw and scaled
+# scores.
+MCAS_SUBJECTS = (('English', 2, 3), ('Math', 5, 6), ('STEM', 8, 9))
+
+# Scaled MCAS scores run from 200 to 280 on the legacy tests, and from 440 to
+# 560 on the next-generation tests.
+MCAS_SCALED_SCORE_RANGE = (200, 560)
+
+# The required Student columns reported after the class of the student.
+REQUIRED_STUDENT_LOCATION_COLUMNS = (
+    ('City', 'City missing.', 18),
+    ('Postal_Code', 'Postal_Code missing.', 19),
+    ('Country_Code', 'Country_Code missing.', 20),
+    ('Race-Ethnicity', 'Race-Ethnicity missing.', 21),
+    ('Sex', 'Sex missing.', 22)
+)
+
+
+class InvalidDataException(Exception):
+    '''
+    An exception to hold an invalid data entry.
+
+    param:
+        `message`: The error message.
+        `line_num`: The line number the error occured on.
+        `col_num`: The column number the error occured on.
+        `sheet`: The name of the sheet the error occured on, if the data came
+            from a workbook.
+    '''
+    def __init__(self, message, line_num, col_num, sheet=None):
+        super().__init__(message)
+        self.message = message
+        self.line_num = line_num
+        self.col_num = col_num
+        self.sheet = sheet
+
+
+    def __repr__(self) -> str:
+        return f'{super().__repr__()} at line num: {self.line_num}'
+
+    def __reduce__(self):
+        # Errors are sent back from the processes that validate files, so all
+        # of the fields must be pickled, not just the message.
+        return (self.__class__, (self.message, self.line_num, self.col_num,
+            self.sheet))
+
+
+def validate_students(csv_file: DataFrame,
+    existing_ids: set) -> tuple[DataFrame, list[InvalidDataException]]:
+    '''
+    Validates the Student columns of the data, one column at a time. Rows for
+    students that already exist, or whose student was already found earlier in
+    the data, are not checked.
+
+    param:
+        `csv_file`: The `DataFrame` object representing the data.
+        `existing_ids`: A `set` of the Unique_IDs already in the database.
+    return:
+        A `tuple` containing a `DataFrame` with one valid row for each new
+        student (with the class parsed into a `ClassEnum`), and the `list` of
+        errors that were found.
+    '''
+    unique_ids = csv_file['Unique_ID']
+    missing_id = __missing(unique_ids)
+    class_years = __map_unique(csv_file['Class'], __parse_class)
+    missing_class = __missing(csv_file['Class'])
+
+    rules = [('Unique ID missing.', 1, missing_id)]
+    rules += [(message, col_num, __missing(csv_file[col]))
+        for col, message, col_num in REQUIRED_STUDENT_COLUMNS]
+    rules.append(('Class missing.', 17, missing_class))
+    rules.append(('Invalid Class', 17, ~missing_class &
+        class_years.isna().to_numpy()))
+    rules += [(message, col_num, __missing(csv_file[col]))
+        for col, message, col_num in REQUIRED_STUDENT_LOCATION_COLUMNS]
+
+    valid = ~np.logical_or.reduce([mask for _, _, mask in rules])
+
+    # A student is only checked until a valid row for them has been found, and
+    # students that already exist are never checked.
+    valid_series = Series(valid, index=csv_file.index)
+    prior_valid = (valid_series.groupby(unique_ids).cumsum() - valid_series)
+    prior_valid = prior_valid.fillna(0).to_numpy() > 0
+    checked = missing_id | (~unique_ids.isin(existing_ids).to_numpy() &
+        ~prior_valid)
+
+    errors = __collect_errors(csv_file, rules, checked)
+
+    students = csv_file[checked & valid].copy()
+    students['Class'] = class_years[checked & valid]
+    return students, errors
+
+
+def validate_class_data(
+    csv_file: DataFrame) -> tuple[DataFrame, list[InvalidDataException]]:
+    '''
+    Validates the Class Data columns of the data, one column at a time.
+
+    param:
+        `csv_file`: The `DataFrame` object representing the data.
+    return:
+        A `tuple` containing a `DataFrame` of the valid rows (with the
+        `Semester` and `Year` of the term added), and the `list` of errors that
+        were found.
+    '''
+    terms = __map_unique(csv_file['Term'], __parse_term)
+    term_status = terms.str[0].to_numpy()
+    missing_term = __missing(csv_file['Term'])
+
+    course_ids = csv_file['Course_Number']
+    missing_course = __missing(course_ids)
+    course_id_len = course_ids.astype('string').str.len()
+    invalid_course = (~missing_course & ((course_id_len < 7) |
+        (course_id_len > 9)).to_numpy(bool, na_value=False))
+
+    program_levels = csv_file['Program_Level']
+    missing_program_level = __missing(program_levels)
+    grades = csv_file['Course_Grade']
+    missing_grade = __missing(grades)
+
+    rules = [
+        ('Missing Term', 5, missing_term),
+        ('Invalid Term', 5, ~missing_term & (term_status == 'split')),
+        ('Invalid Semester', 5, ~missing_term & ((term_status == 'semester')
+            | (term_status == 'both'))),
+        ('Invalid Year', 5, ~missing_term & ((term_status == 'year')
+            | (term_status == 'both'))),
+        ('Numeric term missing.', 6, __missing(csv_file['Numeric_Term_Code'])),
+        ('Course number missing.', 34, missing_course),
+        ('Invalid Course number.', 34, invalid_course),
+        ('Missing Program Level', 7, missing_program_level),
+        ('Invalid Program Level (Must be either UNDG or GRAD)', 7,
+            ~missing_program_level &
+            ~program_levels.isin(VALID_PROGRAM_LEVELS).to_numpy()),
+        ('Missing Subprogram Code', 8,
+            __missing(csv_file['Subprogram_Code'])),
+        ('Missing Course Grade', 35, missing_grade),
+        ('Invalid Course Grade', 35,
+            ~missing_grade & ~grades.isin(VALID_GRADES).to_numpy()),
+        ('Missing Unique_ID', 1, __missing(csv_file['Unique_ID']))
+    ]
+    valid = ~np.logical_or.reduce([mask for _, _, mask in rules])
+    errors = __collect_errors(csv_file, rules, np.ones(len(csv_file), bool))
+
+    class_data = csv_file[valid].copy()
+    class_data['Semester'] = terms[valid].str[1]
+    class_data['Year'] = terms[valid].str[2]
+    return class_data, errors
+
+
+def validate_mcas_scores(csv_file: DataFrame,
+    existing_ids: set) -> tuple[DataFrame, list[InvalidDataException]]:
+    '''
+    Validates MCAS scores, one column at a time. Each row must belong to a
+    student that already exists, and every score that is given must be in
+    range. Scores may be left out, e.g. for a test the student never took.
+
+    param:
+        `csv_file`: The `DataFrame` object representing the scores.
+        `existing_ids`: A `set` of the Unique_IDs already in the database.
+    return:
+        A `tuple` containing a `DataFrame` of the valid rows, and the `list` of
+        errors that were found.
+    '''
+    unique_ids = csv_file['Unique_ID']
+    missing_id = __missing(unique_ids)
+    low, high = MCAS_SCALED_SCORE_RANGE
+
+    rules = [
+        ('Unique ID missing.', 1, missing_id),
+        ('Student not found.', 1, ~missing_id &
+            ~unique_ids.isin(existing_ids).to_numpy())
+    ]
+    for subject, raw_col_num, scaled_col_num in MCAS_SUBJECTS:
+        raw = csv_file[f'{subject}_Raw']
+        scaled = csv_file[f'{subject}_Scaled']
+        rules.append((f'Invalid {subject} raw score.', raw_col_num,
+            (raw < 0).to_numpy(bool, na_value=False)))
+        rules.append((f'Invalid {subject} scaled score.', scaled_col_num,
+            ((scaled < low) | (scaled > high)).to_numpy(bool, na_value=False)))
+
+    valid = ~np.logical_or.reduce([mask for _, _, mask in rules])
+    errors = __collect_errors(csv_file, rules, np.ones(len(csv_file), bool))
+    return csv_file[valid], errors
+
+
+def __missing(column: Series) -> np.ndarray:
+    '''
+    Returns a boolean mask of the values in the column that are missing.
+
+    param:
+        `column`: The `Series` to check.
+    return:
+        A boolean `ndarray` that is `True` where the value is missing.
+    '''
+    return column.isna().to_numpy()
+
+
+def __map_unique(column: Series, func) -> Series:
+    '''
+    Applies the function to each distinct value of the column once, and maps
+    the results back onto every row. Missing values map to `None`.
+
+    param:
+        `column`: The `Series` to map.
+        `func`: The function to apply to each distinct value.
+    return:
+        A `Series` holding the result of the function for each row.
+    '''
+    codes, uniques = pd.factorize(column)
+    results = np.empty(len(uniques) + 1, dtype=object)
+    results[:-1] = [func(value) for value in uniques]
+    results[-1] = None
+    return Series(results[codes], index=column.index)
+
+
+def __parse_term(term) -> tuple[str, str, int]:
+    '''
+    Parses a term such as `FA 2021` into its semester and year.
+
+    param:
+        `term`: The term to parse.
+    return:
+        A `tuple` holding the status of the term (`ok`, `split`, `semester`,
+        `year` or `both`), the semester, and the year.
+    '''
+    split_term = str(term).split(' ')
+    if (len(split_term) != 2):
+        return ('split', None, None)
+
+    semester, year = split_term
+    valid_semester = semester in VALID_SEMESTERS
+    try:
+        year = int(year)
+        valid_year = year <= datetime.now().year
+    except ValueError:
+        valid_year = False
+
+    if (valid_semester and valid_year):
+        return ('ok', semester, year)
+    elif (valid_year):
+        return ('semester', None, None)
+    elif (valid_semester):
+        return ('year', None, None)
+    else:
+        return ('both', None, None)
+
+
+def __parse_class(class_str: str):
+    '''
+    Parses the class, returning `None` if it could not be parsed.
+
+    param:
+        `class_str`: The `str` representation of the class.
+    return:
+        The `ClassEnum` object, or `None` if the class was invalid.
+    '''
+    try:
+        return ClassEnum.parse_class(class_str)
+    except InvalidClassException:
+        return None
+
+
+def __collect_errors(csv_file: DataFrame, rules: list[tuple],
+    checked: np.ndarray) -> list[InvalidDataException]:
+    '''
+    Builds the errors for every failed rule, ordered by line number and then
+    by the order of the rules.
+
+    param:
+        `csv_file`: The `DataFrame` the rules were run against.
+        `rules`: A `list` of `(message, col_num, mask)` tuples.
+        `checked`: A boolean mask of the rows to report errors for.
+    return:
+        A `list` of `InvalidDataException` objects.
+    '''
+    rows, rule_nums = [], []
+    for rule_num, (_, _, mask) in enumerate(rules):
+        failed = np.flatnonzero(mask & checked)
+        rows.append(failed)
+        rule_nums.append(np.full(len(failed), rule_num))
+
+    rows = np.concatenate(rows)
+    rule_nums = np.concatenate(rule_nums)
+    order = np.lexsort((rule_nums, rows))
+
+    # The first line of the file is the header.
+    line_nums = csv_file.index.to_numpy()[rows[order]] + 2
+    return [InvalidDataException(rules[rule_num][0], int(line_num),
+        rules[rule_num][1])
+        for line_num, rule_num in zip(line_nums, rule_nums[order])]
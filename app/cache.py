@@ -0,0 +1,295 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil.
+#
+# This file is part of STEM Data Dashboard.
+#
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+from collections import OrderedDict
+from contextlib import closing
+from copy import deepcopy
+from functools import wraps
+from threading import Lock
+from time import time
+from os import path, makedirs
+from flask import g, has_request_context
+from sqlalchemy.exc import SQLAlchemyError
+import pickle
+import sqlite3
+import logging as logger
+
+
+class ResultCache:
+    '''
+    Holds the results of the analytics methods, keyed on the version of the
+    data they were computed from. Uploads change the data version, so results
+    computed before them are never returned again, and are evicted once the
+    cache is full, least recently used first.
+
+    Results are also written to a `FileStore` when there is one, so the other
+    worker processes of the app can use them instead of computing their own.
+    '''
+    def __init__(self, app=None, max_size: int=None):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.max_size = max_size or 256
+        self.store = None
+        self.hits = 0
+        self.misses = 0
+
+        if (app is not None):
+            self.init_app(app, max_size)
+
+    def init_app(self, app, max_size: int=None):
+        '''
+        Sets up the cache for the app. The number of results that are kept
+        comes from the `ANALYTICS_CACHE_SIZE` config value unless it is given.
+
+        The results are shared through the file named by `ANALYTICS_CACHE_FILE`,
+        which is kept in the instance folder by default. Setting it to `None`
+        keeps the results in this process only.
+
+        param:
+            `app`: The `Flask` app.
+            `max_size`: The max number of results to keep.
+        '''
+        self.max_size = max_size or app.config.get('ANALYTICS_CACHE_SIZE',
+            256)
+        file_path = app.config.get('ANALYTICS_CACHE_FILE',
+            path.join(app.instance_path, 'analytics-cache.db'))
+        if (file_path):
+            try:
+                self.store = FileStore(file_path, app.config.get(
+                    'ANALYTICS_CACHE_FILE_SIZE', 1024), self.__current_version)
+            except (sqlite3.Error, OSError):
+                logger.exception('Unable to open the analytics cache at %s.',
+                    file_path)
+        app.extensions.setdefault('result_cache', self)
+
+    def get(self, version: str, key: str):
+        '''
+        Returns the result stored under the key for the data version, marking
+        it as recently used. Results that are only in the `FileStore` are
+        copied into this process.
+
+        param:
+            `version`: The data version the result was computed from.
+            `key`: The key of the result.
+        return:
+            The result, or `None` if it is not stored.
+        '''
+        with self.lock:
+            if ((version, key) in self.entries):
+                self.hits += 1
+                self.entries.move_to_end((version, key))
+                return self.entries[(version, key)]
+
+        value = self.store.get(version, key) if self.store else None
+        if (value is None):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__remember(version, key, value)
+        return value
+
+    def set(self, version: str, key: str, value):
+        '''
+        Stores the result under the key for the data version, evicting the
+        least recently used results once there are more than `max_size`.
+
+        param:
+            `version`: The data version the result was computed from.
+            `key`: The key of the result.
+            `value`: The result.
+        '''
+        self.__remember(version, key, value)
+        if (self.store):
+            self.store.set(version, key, value)
+
+    def clear(self):
+        '''
+        Removes every stored result, including those in the `FileStore`.
+        '''
+        with self.lock:
+            self.entries.clear()
+        if (self.store):
+            self.store.clear()
+
+    def cached(self, func):
+        '''
+        A decorator that stores the results of an analytics method, keyed on
+        its name, its arguments and the current data version. The method is
+        called as normal while the data has no version yet.
+
+        A copy of the stored result is returned each time, so callers are free
+        to change it.
+
+        param:
+            `func`: The method to cache.
+        return:
+            The wrapped method.
+        '''
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            version = self.__data_version()
+            if (version is None):
+                return func(*args, **kwargs)
+
+            key = (f'{func.__module__}.{func.__qualname__}{args!r}'
+                f'{sorted(kwargs.items())!r}')
+            value = self.get(version, key)
+            if (value is None):
+                value = func(*args, **kwargs)
+                self.set(version, key, value)
+            return deepcopy(value)
+        return wrapper
+
+    def __remember(self, version: str, key: str, value):
+        '''
+        Stores the result in this process only.
+        '''
+        with self.lock:
+            self.entries[(version, key)] = value
+            self.entries.move_to_end((version, key))
+            while (len(self.entries) > self.max_size):
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def __current_version() -> str:
+        '''
+        Returns the current data version, looked up again even during a
+        request, so the `FileStore` never keeps a version that was replaced.
+        '''
+        from app.models import DataVersion
+        return DataVersion.get_version()
+
+    def __data_version(self) -> str:
+        '''
+        Returns the current data version, which is only looked up once for
+        each request.
+
+        return:
+            A `str` holding the version, or `None` if there is none yet.
+        '''
+        from app.models import DataVersion
+        if (not has_request_context()):
+            return DataVersion.get_version()
+
+        if ('data_version' not in g):
+            g.data_version = DataVersion.get_version()
+        return g.data_version
+
+
+class FileStore:
+    '''
+    Stores pickled results in an SQLite file on local disk, so every worker
+    process on the machine shares them, and they outlive a restart. Only the
+    results of the newest data version are kept.
+
+    The store is only a cache, so any error reading or writing it is logged and
+    treated as a miss.
+
+    param:
+        `file_path`: The path to the SQLite file.
+        `max_size`: The max number of results to keep.
+        `get_version`: A function that returns the current data version. When
+            it is not given, the version of each result that is stored is
+            taken to be the newest.
+    '''
+    def __init__(self, file_path: str, max_size: int=1024,
+        get_version=None):
+        self.file_path = file_path
+        self.max_size = max_size
+        self.get_version = get_version
+        makedirs(path.dirname(path.abspath(file_path)), exist_ok=True)
+        with closing(self.__connect()) as conn, conn:
+            # WAL lets the workers read while one of them writes.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results (version TEXT '
+                'NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, stored_at '
+                'REAL NOT NULL, PRIMARY KEY (version, key))')
+
+    def get(self, version: str, key: str):
+        '''
+        Returns the result stored under the key for the data version.
+
+        param:
+            `version`: The data version the result was computed from.
+            `key`: The key of the result.
+        return:
+            The result, or `None` if it is not stored.
+        '''
+        try:
+            with closing(self.__connect()) as conn:
+                row = conn.execute('SELECT value FROM results WHERE '
+                    'version = ? AND key = ?', (version, key)).fetchone()
+            return pickle.loads(row[0]) if row else None
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError):
+            logger.exception('Unable to read the analytics cache.')
+            return None
+
+    def set(self, version: str, key: str, value):
+        '''
+        Stores the result under the key for the data version. Results of
+        versions other than the current one are removed, along with the oldest
+        results once there are more than `max_size`.
+
+        The current version is looked up once the file is locked for writing.
+        A worker that stored results of a newer version has already released
+        the lock, so its version is the one that is found and its results are
+        kept, while a result computed from a replaced version is dropped.
+
+        param:
+            `version`: The data version the result was computed from.
+            `key`: The key of the result.
+            `value`: The result.
+        '''
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            with closing(self.__connect()) as conn, conn:
+                conn.execute('BEGIN IMMEDIATE')
+                current = (self.get_version() if self.get_version
+                    else version)
+                if (version == current):
+                    conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, '
+                        '?, ?)', (version, key, data, time()))
+                conn.execute('DELETE FROM results WHERE version != ?',
+                    (current,))
+                conn.execute('DELETE FROM results WHERE rowid IN (SELECT rowid '
+                    'FROM results ORDER BY stored_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_size,))
+        except (sqlite3.Error, SQLAlchemyError, pickle.PicklingError,
+            TypeError):
+            logger.exception('Unable to write to the analytics cache.')
+
+    def clear(self):
+        '''
+        Removes every stored result.
+        '''
+        try:
+            with closing(self.__connect()) as conn, conn:
+                conn.execute('DELETE FROM results')
+        except sqlite3.Error:
+            logger.exception('Unable to clear the analytics cache.')
+
+    def __connect(self) -> sqlite3.Connection:
+        '''
+        Opens a new connection to the file, waiting for up to 5 seconds when
+        another process is writing to it.
+        '''
+        return sqlite3.connect(self.file_path, timeout=5)
@@ -0,0 +1,161 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil.
+#
+# This file is part of STEM Data Dashboard.
+#
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+import click
+from os import path, scandir
+from time import sleep
+from flask import current_app
+from flask.cli import AppGroup
+from werkzeug.datastructures import FileStorage
+from app.jobs import JobRunner
+
+
+data_cli = AppGroup('data', help='Load data files from disk.')
+terms_cli = AppGroup('terms', help='Delete or replace the data of a term.')
+
+
+@terms_cli.command('delete')
+@click.argument('term_code')
+def delete_term_command(term_code: str):
+    '''
+    Deletes the Class Data and courses of TERM_CODE, e.g. 202140.
+    '''
+    from app.blueprints.dashboard.data_upload import delete_term
+    counts = delete_term(term_code)
+    if (counts['courses'] == 0):
+        raise click.ClickException(f'Term {term_code} not found.')
+    click.echo(f"Deleted {counts['class_data']} Class Data rows and "
+        f"{counts['courses']} courses.")
+
+
+@terms_cli.command('replace')
+@click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--update-students', is_flag=True,
+    help='Update the students that already exist.')
+def replace_terms_command(file_path: str, update_students: bool):
+    '''
+    Replaces the data of every term in FILE_PATH with the file, all at once.
+    '''
+    from app.blueprints.dashboard.data_upload import upload_csv_file
+    with open(file_path, 'rb') as file:
+        result, status = upload_csv_file(
+            FileStorage(file, path.basename(file_path)),
+            update_students=update_students, replace_terms=True)
+    if (status != 200):
+        raise click.ClickException(result['message'])
+    counts = result['rows_written']
+    click.echo(f"Wrote {counts['class_data']} Class Data rows, "
+        f"{counts['courses']} courses and {counts['students']} students.")
+
+
+@data_cli.command('import')
+@click.argument('file_paths', nargs=-1, required=True,
+    type=click.Path(exists=True))
+@click.option('--workers', default=1, show_default=True,
+    type=click.IntRange(min=1), help='The number of files to read at once.')
+@click.option('--batch', is_flag=True,
+    help='Validate the files in a pool of --workers processes, then write '
+        'them all in one transaction.')
+@click.option('--dry-run', is_flag=True,
+    help='Only validate the files.')
+@click.option('--max-errors', type=click.IntRange(min=1),
+    help='Stop reading a file after this many errors.')
+@click.option('--update-students', is_flag=True,
+    help='Update the students that already exist.')
+@click.option('--replace-terms', is_flag=True,
+    help='Replace the data of every term in each file.')
+@click.option('--data-type', default='class_data', show_default=True,
+    type=click.Choice(['class_data', 'mcas_scores']),
+    help='The kind of data in the files.')
+def import_command(file_paths: tuple, workers: int, batch: bool,
+    dry_run: bool, max_errors: int, update_students: bool,
+    replace_terms: bool, data_type: str):
+    '''
+    Imports the CSV, XLSX, gzip and zip files in FILE_PATHS, which may also be
+    folders of them. Each file is validated on its own thread and written in
+    its own transaction, so a file with errors never stops the others. With
+    --batch the files are imported all at once instead.
+    '''
+    from app.blueprints.dashboard.data_upload import (upload_file,
+        upload_batch)
+    file_paths = __find_data_files(file_paths)
+    options = {'dry_run': dry_run, 'max_errors': max_errors,
+        'update_students': update_students, 'replace_terms': replace_terms,
+        'data_type': data_type}
+
+    if (batch):
+        runner = JobRunner(current_app._get_current_object(), 1)
+        jobs = {f'{len(file_paths)} files': runner.submit(upload_batch,
+            file_paths, workers, **options)}
+    else:
+        runner = JobRunner(current_app._get_current_object(), workers)
+        jobs = {file_path: runner.submit(upload_file, file_path, **options)
+            for file_path in file_paths}
+
+    failed = []
+    remaining = dict(jobs)
+    while (remaining):
+        sleep(0.5)
+        rows = sum(job.rows_processed for job in jobs.values())
+        click.echo(f'\r{len(jobs) - len(remaining)}/{len(jobs)} files, '
+            f'{rows} rows read', nl=False)
+
+        for file_path, job in list(remaining.items()):
+            if (not job.is_finished()):
+                continue
+            remaining.pop(file_path)
+            click.echo(f"\r{file_path}: {job.result['message']} "
+                f"({job.rows_processed} rows, "
+                f"{job.to_dict()['rows_per_second']} rows/s)")
+            if ('error' in job.result):
+                click.echo(f"  {job.result['error']}")
+            if ('errors' in job.files):
+                click.echo(f"  Errors written to {job.files['errors']}")
+            if (job.status_code != 200):
+                failed.append(file_path)
+    runner.shutdown()
+
+    if (failed):
+        raise click.ClickException(f'{len(failed)} of {len(jobs)} files '
+            'were not imported.')
+
+
+def __find_data_files(file_paths: tuple) -> list[str]:
+    '''
+    Replaces each folder in the paths with the data files inside of it.
+
+    param:
+        file_paths: The paths to files and folders.
+    return:
+        A `list` of the paths to the files, with each folder's files in order
+        of their names.
+    '''
+    from app.blueprints.dashboard.data_upload import DATA_FILE_EXTENSIONS
+    found = []
+    for file_path in file_paths:
+        if (path.isdir(file_path)):
+            found.extend(sorted(entry.path for entry in scandir(file_path)
+                if entry.is_file() and
+                entry.name.lower().endswith(DATA_FILE_EXTENSIONS)))
+        else:
+            found.append(file_path)
+    return found
@@ -0,0 +1,283 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil.
+#
+# This file is part of STEM Data Dashboard.
+#
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+from uuid import uuid4
+from os import remove
+from mmap import PAGESIZE
+from sys import platform
+import logging as logger
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Job:
+    '''
+    A class to hold the progress and result of a background job.
+    '''
+    def __init__(self):
+        self.id = uuid4().hex
+        self.phase = 'queued'
+        self.rows_processed = 0
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.status_code = None
+        self.future = None
+        self.files = {}
+        self.phase_started_at = time()
+        self.phase_seconds = {}
+        self.peak_memory = memory_usage()
+
+    def set_phase(self, phase: str):
+        '''
+        Sets the phase the job is currently in, adding the time spent in the
+        last phase to its total. The memory used by the process is sampled
+        each time, to keep track of its peak.
+
+        param:
+            `phase`: A `str` holding the name of the phase.
+        '''
+        now = time()
+        self.phase_seconds[self.phase] = (self.phase_seconds.get(self.phase,
+            0.0) + now - self.phase_started_at)
+        self.phase = phase
+        self.phase_started_at = now
+        self.peak_memory = max(self.peak_memory, memory_usage())
+
+    def stage_seconds(self) -> dict:
+        '''
+        Returns the time spent in each phase so far, including the current
+        one.
+
+        return:
+            A `dict` mapping the name of each phase to its number of seconds.
+        '''
+        seconds = dict(self.phase_seconds)
+        seconds[self.phase] = (seconds.get(self.phase, 0.0) + time() -
+            self.phase_started_at)
+        return {phase: round(total, 4) for phase, total in seconds.items()}
+
+    def add_rows(self, num_rows: int):
+        '''
+        Adds to the number of rows the job has processed.
+
+        param:
+            `num_rows`: The number of rows that were processed.
+        '''
+        self.rows_processed += num_rows
+
+    def add_file(self, name: str, file_path: str):
+        '''
+        Keeps a file made by the job, such as a report, until the job is
+        forgotten.
+
+        param:
+            `name`: The name the file is found by.
+            `file_path`: The path to the file.
+        '''
+        self.files[name] = file_path
+
+    def remove_files(self):
+        '''
+        Removes every file made by the job.
+        '''
+        for file_path in self.files.values():
+            try:
+                remove(file_path)
+            except OSError:
+                logger.warning('Unable to remove job file %s.', file_path)
+        self.files = {}
+
+    def is_finished(self) -> bool:
+        '''
+        Returns whether or not the job has finished.
+
+        return:
+            A `bool` representing if the job has finished.
+        '''
+        return self.finished_at is not None
+
+    def wait(self, timeout: float=None):
+        '''
+        Blocks until the job has finished.
+
+        param:
+            `timeout`: The max number of seconds to wait.
+        '''
+        self.future.result(timeout)
+
+    def to_dict(self) -> dict:
+        '''
+        Returns the status of the job in a JSON-like format.
+
+        return:
+            A `dict` holding the phase, rows processed, throughput and the
+            result of the job once it has finished.
+        '''
+        elapsed = 0.0
+        if (self.started_at is not None):
+            elapsed = (self.finished_at or time()) - self.started_at
+
+        return {
+            'job_id': self.id,
+            'phase': self.phase,
+            'finished': self.is_finished(),
+            'rows_processed': self.rows_processed,
+            'elapsed_seconds': round(elapsed, 2),
+            'rows_per_second': round(self.rows_processed / elapsed, 2)
+                if elapsed > 0 else 0.0,
+            'stage_seconds': self.stage_seconds(),
+            'peak_memory_mb': round(self.peak_memory / (1 << 20), 1),
+            'status_code': self.status_code,
+            'result': self.result
+        }
+
+
+def memory_usage() -> int:
+    '''
+    Returns the memory the process is using, in bytes. The resident size is
+    read from `/proc` where it exists, otherwise the peak resident size is used.
+
+    return:
+        An `int` holding the number of bytes, or 0 if it cannot be found.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGESIZE
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if (resource is None):
+        return 0
+    # The peak is given in kilobytes on Linux, but in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform == 'darwin' else peak * 1024
+
+
+class JobRunner:
+    '''
+    Runs jobs on a pool of background threads owned by the app, each inside of
+    its own app context.
+
+    Jobs are only held in the memory of the process that started them, so the
+    status and errors of an upload can only be read from that process. The app
+    must be served by a single worker process (see `server_run.sh`), using
+    threads rather than more processes to serve requests at the same time.
+    '''
+    def __init__(self, app=None, max_workers: int=None):
+        self.app = None
+        self.executor = None
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.max_history = 100
+
+        if (app is not None):
+            self.init_app(app, max_workers)
+
+    def init_app(self, app, max_workers: int=None):
+        '''
+        Creates the thread pool for the app. The number of threads comes from
+        the `JOB_WORKERS` config value unless it is given, and the number of
+        finished jobs that are remembered comes from `JOB_HISTORY`. Only the
+        first runner of the app is registered as its extension.
+
+        param:
+            `app`: The `Flask` app.
+            `max_workers`: The number of threads to use.
+        '''
+        self.app = app
+        self.max_history = app.config.get('JOB_HISTORY', 100)
+        self.executor = ThreadPoolExecutor(
+            max_workers or app.config.get('JOB_WORKERS', 4),
+            thread_name_prefix='job')
+        app.extensions.setdefault('job_runner', self)
+
+    def shutdown(self):
+        '''
+        Waits for every queued job to finish, then stops the thread pool.
+        '''
+        self.executor.shutdown(wait=True)
+
+    def submit(self, func, *args, **kwargs) -> Job:
+        '''
+        Queues the function to run in the background. The function is passed
+        the `Job` as its first argument so it can report its progress, and
+        must return a `(body, status_code)` tuple like a route does.
+
+        param:
+            `func`: The function to run.
+        return:
+            The `Job` that was queued.
+        '''
+        job = Job()
+        with self.lock:
+            self.jobs[job.id] = job
+            self.__forget_old_jobs()
+        job.future = self.executor.submit(self.__run, job, func, *args,
+            **kwargs)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        '''
+        Returns the job with the given ID.
+
+        param:
+            `job_id`: The ID of the job.
+        return:
+            The `Job`, or `None` if it does not exist.
+        '''
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def __run(self, job: Job, func, *args, **kwargs):
+        '''
+        Runs the job inside of an app context, saving its result.
+        '''
+        job.started_at = time()
+        try:
+            with self.app.app_context():
+                job.result, job.status_code = func(job, *args, **kwargs)
+            job.set_phase('finished')
+        except Exception as e:
+            logger.exception('Background job %s failed.', job.id)
+            job.result = {'message': 'Job failed.', 'error': str(e)}
+            job.status_code = 500
+            job.set_phase('failed')
+        finally:
+            job.finished_at = time()
+
+    def __forget_old_jobs(self):
+        '''
+        Removes the oldest finished jobs once more than `max_history` jobs are
+        being remembered.
+        '''
+        finished = [job_id for job_id, job in self.jobs.items()
+            if job.is_finished()]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_history)]:
+            self.jobs.pop(job_id).remove_files()
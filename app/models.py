@@ -25,16 +25,48 @@ from flask import current_app
 import logging as logger
 from flask_login import UserMixin
 import enum
-from app import db, app
+import json
+from app import db, app, result_cache
+from app.snapshot import get_snapshot, to_dict, round_average
 import pyotp
 from werkzeug.security import check_password_hash, generate_password_hash
 import sqlalchemy
 from sqlalchemy import (Column, Integer, Text, Float, CheckConstraint, Enum, 
-    ForeignKey)
+    ForeignKey, DateTime, select, func, case)
+from sqlalchemy.orm import joinedload
+from datetime import datetime
+from uuid import uuid4
 from itertools import groupby
 from operator import attrgetter
 from functools import cmp_to_key
 
+# Every grade a Class Data row can hold.
+GRADES = ('A', 'A-', 'B+', 'B', 'B-', 'C+', 'C', 'C-', 'D+', 'D', 'D-', 'F',
+    'W', 'IP', 'P')
+
+# Grades that count towards a course's DWF rate.
+DWF_GRADES = ('D+', 'D', 'D-', 'W', 'F')
+
+# The numeric value of each letter grade, used to average course grades. Grades
+# that are not listed here (W, IP and P) are left out of the average.
+GRADE_TO_NUM = {
+    'A+': 13, 'A': 12, 'A-': 11, 'B+': 10, 'B': 9, 'B-': 8, 'C+': 7,
+    'C': 6, 'C-': 5, 'D+': 4, 'D': 3, 'D-': 2, 'F': 1
+}
+NUM_TO_GRADE = {num: grade for grade, num in GRADE_TO_NUM.items()}
+
+# The Student column averaged by each student KPI.
+STUDENT_KPI_COLUMNS = {
+    'avg_gpa': 'gpa_cumulative',
+    'avg_high_school_gpa': 'high_school_gpa',
+    'avg_math_placement': 'math_placement_score',
+    'avg_sat_total': 'sat_total',
+    'avg_sat_math': 'sat_math',
+    'avg_act': 'act_score'
+}
+KPIS = ('total_students', 'dwf_avg', 'avg_course_grade',
+        *STUDENT_KPI_COLUMNS)
+
 
 class Utils:
     '''
@@ -58,159 +90,124 @@ class Utils:
                                             attrgetter(str(column).split('.')[1]))]
 
     @staticmethod
-    def get_class_by_class_data(column: str, selected_courses: dict) -> dict:
+    @result_cache.cached
+    def get_kpis(*kpis: str) -> dict:
         '''
-        Returns a `dict` with the data requested for each class specified.
-
-        params:
-            `column`: The column to compare each class by.
-            `selected_courses`: A `dict` containing the courses and the semesters
-            to compare each course.
+        Calculates the dashboard KPIs in the database with a single query, 
+        without loading any rows into Python.
 
+        param:
+            `kpis`: The names of the KPIs to calculate, from `KPIS`. Every KPI
+            is calculated when none are given.
         return:
-            A `dict` containing the calculated/found data for each course.
+            A `dict` mapping each KPI name to its value, formatted the same way
+            as the matching `get_avg_*` method.
         '''
+        kpis = kpis or KPIS
+        query = select(*[Utils.__kpi_expression(kpi).label(kpi)
+                         for kpi in kpis])
+        row = db.session.execute(query).one()
 
-        def get_class_data_column(column: str, course: str, semester: str,
-                                  year: int) -> list[str] | float:
-            '''
-            Generates the correct calculated value for the provided column,
-            course, semester, and year.
+        return {kpi: Utils.__format_kpi(kpi, row[kpi]) for kpi in kpis}
 
-            params:
-                `column`: A `str` holding the calculation to perform.
-                Should be either 'grade' or 'avg_dwf_rate'.
-                `course`: A `str` containing the course to get the data for.
-                `semester`: A `str` containing the semester the course ran.
-                `year`: An `int` containing the year the course ran.
-            return:
-                A `list` containing each of the grades for the course in the
-                database or a float representing the average dwf rate for the
-                course.
-            '''
-            course = Course.query.filter(Course.course_num ==
-                    course and Course.semester == semester and Course.year ==
-                                         year).first()
+    @staticmethod
+    def __kpi_expression(kpi: str):
+        '''
+        Builds the scalar subquery that calculates a KPI.
 
-            if (column == 'grade'):
-                class_data_entries = ClassData.query.filter(
-                    ClassData.course_obj == course).all()
-                return [course.grade for course in class_data_entries]
-            else:
-                class_data_entries = ClassData.query.filter(
-                    ClassData.course_obj == course)
-                dwf_grades = class_data_entries.filter(ClassData.grade == 'D' or
-                    ClassData.grade == 'D+' or ClassData.grade == 'D-' or
-                                                       ClassData.grade == 'W' or ClassData.grade == 'F').count()
-                total_grades = class_data_entries.count()
-                return round((dwf_grades / total_grades) * 100, 2) if total_grades > 0 else 0.0
-
-        def get_student_data_column(column: str, course: str, semester: str,
-                                    year: int) -> list | float:
-            '''
-            Generates the correct calculation for the given column, course,
-            semester and year from the Student table.
-            '''
-            course = Course.query.filter(Course.course_num == course and
-                                         Course.semester == semester and Course.year == year).first()
-            class_data_objs = ClassData.query.filter(ClassData.course_obj ==
-                                                     course).all()
-            if (column == 'avg_high_school_gpa'):
-                gpa_list = []
-                for class_data_obj in class_data_objs:
-                    hs_gpa = class_data_obj.student_obj.high_school_gpa
-
-                    # Only get grades that are in the database, since
-                    # high_school_gpa is nullable in the database.
-                    if (hs_gpa is not None):
-                        gpa_list.append(hs_gpa)
-
-                gpa_list_len = len(gpa_list)
-                return round(sum(gpa_list) / gpa_list_len, 2) if gpa_list_len > 0 else 0
-            elif (column == 'avg_gpa'):
-                gpa_list = []
-                for class_data_obj in class_data_objs:
-                    gpa = class_data_obj.student_obj.gpa_cumulative
-
-                    # Only get grades that are in the database, since gpa is
-                    # nullable in the database.
-                    if (gpa is not None):
-                        gpa_list.append(gpa)
-
-                gpa_list_len = len(gpa_list)
-                return round(sum(gpa_list) / gpa_list_len, 2) if gpa_list_len > 0 else 0
-            else:
-                column_list = []
-                for class_data_obj in class_data_objs:
-                    student = class_data_obj.student_obj
-
-                    # Get the column of the Student table we are looking for.
-                    column_val = getattr(student, column)
-
-                    # If the column is a gpa, round it to 2 decimal places.
-                    if (column == 'gpa_cumulative' or column ==
-                            'high_school_gpa'):
-                        column_val = round(column_val, 2)
-
-                    # If the value is not None, add it to the column_list.
-                    if (column_val is not None):
-                        column_list.append(column_val)
-                return column_list
-
-        # Based on what column was selected, find which function to call.
-        if (column == 'grade' or column == 'avg_dwf_rate'):
-            function_to_call = get_class_data_column
+        param:
+            `kpi`: The name of the KPI.
+        return:
+            A scalar subquery returning the unformatted KPI, or `NULL` when
+            there is nothing to average.
+        '''
+        if (kpi == 'total_students'):
+            return select(func.count()).select_from(Student).scalar_subquery()
+        elif (kpi == 'dwf_avg'):
+            is_dwf = case((ClassData.grade.in_(DWF_GRADES), 1), else_=0)
+            return select(func.sum(is_dwf) * 100.0 / func.count()) \
+                .select_from(ClassData).scalar_subquery()
+        elif (kpi == 'avg_course_grade'):
+            # W, IP and P fall through to NULL, which AVG skips.
+            grade_value = case(GRADE_TO_NUM, value=ClassData.grade)
+            return select(func.avg(grade_value)).scalar_subquery()
+        elif (kpi in STUDENT_KPI_COLUMNS):
+            # Students missing a value still count towards the total.
+            column = getattr(Student, STUDENT_KPI_COLUMNS[kpi])
+            return select(func.coalesce(func.sum(column), 0) * 1.0 /
+                          func.count()).select_from(Student).scalar_subquery()
         else:
-            function_to_call = get_student_data_column
-
-        return_data = {}
-        for course_num in selected_courses:
-            term = selected_courses[course_num]
-            split_term = term.split(' ')
-            semester = split_term[0]
-            year = int(split_term[1])
-            return_data[course_num] = function_to_call(
-                column, course_num, semester, year)
-        return return_data
+            raise ValueError(f'Unknown KPI: {kpi}')
 
     @staticmethod
-    def get_avg_for_column(column, semester, year):
+    def __format_kpi(kpi: str, value):
         '''
+        Formats a KPI the way the dashboard displays it.
+
+        param:
+            `kpi`: The name of the KPI.
+            `value`: The unformatted value returned by the database.
+        return:
+            The formatted KPI.
         '''
-        all_class_data_objects = []
+        if (kpi == 'total_students'):
+            return value
+        elif (kpi == 'avg_course_grade'):
+            return NUM_TO_GRADE[round(value)] if value is not None else 'N/A'
+        else:
+            return '%.2f' % value if value is not None else 0.0
 
-        for class_data_obj in ClassData.query.all():
-            course_obj = class_data_obj.course_obj
+    @staticmethod
+    @result_cache.cached
+    def get_class_by_class_data(column: str, selected_courses: dict) -> dict:
+        '''
+        Returns a `dict` with the data requested for each class specified.
 
-            if (course_obj.semester == semester and course_obj.year == year):
-                all_class_data_objects.append(class_data_obj)
+        params:
+            `column`: The column to compare each class by.
+            `selected_courses`: A `dict` containing the courses and the semesters
+            to compare each course.
 
-        if (column != 'dwf_rate'):
-            column_sum = 0
-            column_entry_count = 0
-            for cd in all_class_data_objects:
-                attribute = getattr(cd.student_obj, column)
-                if attribute != 0.0 and attribute != None:
-                    column_sum += attribute
-                    column_entry_count += 1
+        return:
+            A `dict` containing the calculated/found data for each course.
+        '''
 
-            return round((column_sum / column_entry_count), 2) if column_entry_count > 0 else 0
-        else:
-            dwf_count = 0
-            total_num_grades_count = 0
-            for cd in all_class_data_objects:
-                # Access the grade for each ClassData entry
-                grade = cd.grade
+        snapshot = get_snapshot()
+        enrollments = snapshot.enrollments
+        is_dwf = snapshot.is_dwf()
 
-                # If there is a grade, its in ('D', 'D-', 'D+', 'W', 'F'), add
-                # 1 to the count.
-                if grade != None and grade in ('D', 'D-', 'D+', 'W', 'F'):
-                    dwf_count += 1
-                total_num_grades_count += 1
+        return_data = {}
+        for course_num in selected_courses:
+            semester, year = selected_courses[course_num].split(' ')
+            in_course = ((enrollments['course_num'] == course_num) &
+                (enrollments['semester'] == semester) &
+                (enrollments['year'] == int(year)))
 
-            return round(((dwf_count / total_num_grades_count) * 100), 2) if total_num_grades_count > 0 else 0
+            if (column == 'grade'):
+                return_data[course_num] = snapshot.grades(
+                    enrollments[in_course])
+            elif (column == 'avg_dwf_rate'):
+                course_dwf = is_dwf[in_course]
+                return_data[course_num] = round(float(course_dwf.mean()) * 100,
+                    2) if len(course_dwf) > 0 else 0.0
+            elif (column == 'avg_high_school_gpa' or column == 'avg_gpa'):
+                gpa_column = ('high_school_gpa' if
+                    column == 'avg_high_school_gpa' else 'gpa_cumulative')
+                return_data[course_num] = round_average(
+                    enrollments.loc[in_course, gpa_column].mean())
+            else:
+                # Only get the values that are in the database, since most of
+                # the Student columns are nullable.
+                values = enrollments.loc[in_course, column].dropna().tolist()
+
+                # If the column is a gpa, round it to 2 decimal places.
+                if (column == 'gpa_cumulative' or column == 'high_school_gpa'):
+                    values = [round(value, 2) for value in values]
+                return_data[course_num] = values
+        return return_data
 
     @staticmethod
+    @result_cache.cached
     def get_covid_data(column: str) -> dict:
         semesters = ['FA 2019', 'SP 2020', 'FA 2020', 'SP 2021', 'FA 2021']
         return_dict = {}
@@ -243,45 +240,52 @@ class Utils:
             # avg_dwf is going to be a little harder since each grade lives in
             # the ClassData object and not the Student objects
 
-        # Loop over every semester and get the average for that column.
-        for semester in semesters:
-            split_semester = semester.split(' ')
-            semester_abbreviation = split_semester[0]
-            year = int(split_semester[1])
+        snapshot = get_snapshot()
+        if (column_to_query == 'dwf_rate'):
+            averages = {term: average * 100 for term, average in
+                snapshot.term_averages(snapshot.is_dwf()).items()}
+        else:
+            # Leave out the students that are missing the value.
+            values = snapshot.enrollments[column_to_query]
+            averages = snapshot.term_averages(values.where(values.notna() &
+                (values != 0)))
 
-            return_dict[semester] = Utils.get_avg_for_column(column_to_query,
-                                                             semester_abbreviation, year)
+        # Look up the average of every semester.
+        for semester in semesters:
+            return_dict[semester] = round_average(averages.get(semester,
+                float('nan')))
         return return_dict
 
     @staticmethod
+    @result_cache.cached
     def get_bar_chart_data(columnX: str, columnY: str) -> dict:
         match columnX:
             case 'admit_term':
-                columnX = Student.admit_term
+                columnX = 'admit_term'
             case 'admit_year':
-                columnX = Student.admit_year
+                columnX = 'admit_year'
             case 'major_one':
-                columnX = Student.major_1_desc
+                columnX = 'major_1_desc'
             case 'major_two':
-                columnX = Student.major_2_desc
+                columnX = 'major_2_desc'
             case 'minor_one':
-                columnX = Student.minor_1_desc
+                columnX = 'minor_1_desc'
             case 'concentration':
-                columnX = Student.concentration_desc
+                columnX = 'concentration_desc'
             case 'class_year':
-                columnX = Student.class_year
+                columnX = 'class_year'
             case 'city':
-                columnX = Student.city
+                columnX = 'city'
             case 'state':
-                columnX = Student.state
+                columnX = 'state'
             case 'race':
-                columnX = Student.race_ethnicity
+                columnX = 'race_ethnicity'
             case 'gender':
-                columnX = Student.gender
+                columnX = 'gender'
             case 'hs_name':
-                columnX = Student.high_school_name
+                columnX = 'high_school_name'
             case 'hs_state':
-                columnX = Student.high_school_state
+                columnX = 'high_school_state'
 
         match columnY:
             case 'avg_gpa':
@@ -299,41 +303,16 @@ class Utils:
             case 'avg_sat_math':
                 columnY = 'sat_math'
 
-        Xgroups = Utils.group_table_by_column(Student, columnX)
-        data_dict = Utils.get_avg_for_bar_data(Xgroups, columnX, columnY)
-            
-        return data_dict 
+        # Students missing the X value are left out of the chart.
+        students = get_snapshot().students
+        averages = students.groupby(columnX, observed=True)[columnY].mean() \
+            .sort_index()
 
-    @staticmethod
-    def get_avg_for_bar_data(XGroups: list[list], xColumn, yColumn: str):
-        '''
-    
-        '''
-        x_col_str = str(xColumn).split('.')[1]
-        return_dict = {}
-        for group in XGroups:
-            group_key = getattr(group[0], x_col_str)
-            if (group_key == None):
-                try:
-                    del return_dict[None]
-                except KeyError:
-                    continue
-
-            col_sum = 0
-            col_len = 0
-            for student in group:
-                y_col_val = getattr(student, yColumn)
-
-                if (y_col_val is not None):
-                    col_sum += y_col_val
-                    col_len += 1
-
-            avg = col_sum / col_len if (col_len > 0) else 0
-            return_dict[group_key] = round(avg, 2)
-    
-        return return_dict
+        return {group: round_average(average)
+            for group, average in to_dict(averages).items()}
 
     @staticmethod
+    @result_cache.cached
     def get_scatter_plot_data(startYear: int, endYear: int, columnY: str):
         '''
         '''
@@ -353,16 +332,16 @@ class Utils:
             case 'sat_math':
                 columnY = 'sat_math'
 
-        years_list = list(range(startYear, endYear))
+        enrollments = get_snapshot().enrollments
+        in_years = ((enrollments['year'] >= startYear) &
+            (enrollments['year'] < endYear))
+        values = enrollments.loc[in_years, columnY]
+        values = values.astype(object).where(values.notna(), None)
+        year_values = values.groupby(enrollments.loc[in_years, 'year']).agg(
+            list)
 
-        return_dict = {}
-        for year in years_list:
-            cd_list = []
-            for cd in ClassData.query.all():
-                if (cd.course_obj.year == year):
-                    cd_list.append(getattr(cd.student_obj, columnY))
-            return_dict[year] = cd_list
-        return return_dict
+        return {year: year_values.get(year, [])
+            for year in range(startYear, endYear)}
 
     @staticmethod
     def get_all_data() -> list[dict]:
@@ -797,6 +776,7 @@ class Student(db.Model):
     mcas_score_obj = db.relationship('MCASScore', uselist=False)
 
     @staticmethod
+    @result_cache.cached
     def get_avg_gpa_per_semester() -> dict:
         '''
         Generates a dictionary containing the average gpa for each semester in
@@ -805,19 +785,12 @@ class Student(db.Model):
         return:
             A `dict` containing the average gpa for each semester.
         '''
-        semester_groups = Utils.group_table_by_column(
-            ClassData, ClassData.course)
+        snapshot = get_snapshot()
+        avg_gpas = snapshot.term_averages(
+            snapshot.enrollments['gpa_cumulative'])
 
-        return_dict = {}
-        for group in semester_groups:
-            semester = group[0].course_obj.semester
-            year = group[0].course_obj.year
-
-            avg_gpa = sum(
-                [g.student_obj.gpa_cumulative for g in group]) / len(group)
-            term = f'{semester} {year}'
-            return_dict[term] = round(avg_gpa, 2)
-        return return_dict
+        return {term: round_average(avg_gpa)
+            for term, avg_gpa in avg_gpas.items()}
 
     @staticmethod
     def get_avg_gpa() -> str:
@@ -827,24 +800,7 @@ class Student(db.Model):
         return: 
             The average GPA of all students in the database represented by a `str`.
         '''
-        def __sum_gpa() -> int:
-            '''
-            Calculates the sum of all college GPAs in the database.
-
-            return:
-                An `int` holding the sum of all GPAs in the database.
-            '''
-            sum = 0
-            for student in Student.query.all():
-                student_gpa = student.gpa_cumulative
-                if (student_gpa is not None):
-                    sum += student.gpa_cumulative
-            return sum
-
-        total_students = len(Student.query.all())
-        gpa_sum = __sum_gpa()
-
-        return '%.2f' % (gpa_sum / total_students) if total_students > 0 else 0.0
+        return Utils.get_kpis('avg_gpa')['avg_gpa']
 
     @staticmethod
     def get_avg_high_school_gpa() -> str:
@@ -854,23 +810,10 @@ class Student(db.Model):
         return: The average high school GPA of all students in the database 
                 represented by a str.
         '''
-        def __sum_gpa():
-            '''
-            Calculates the sum of all high school GPAs in the database.
-            '''
-            sum = 0
-            for student in Student.query.all():
-                student_hs_gpa = student.high_school_gpa
-                if (student_hs_gpa is not None):
-                    sum += student.high_school_gpa
-            return sum
-
-        total_students = len(Student.query.all())
-        gpa_sum = __sum_gpa()
-
-        return '%.2f' % (gpa_sum / total_students) if total_students > 0 else 0.0
+        return Utils.get_kpis('avg_high_school_gpa')['avg_high_school_gpa']
 
     @staticmethod
+    @result_cache.cached
     def get_num_students_per_major() -> dict:
         '''
         Returns a `dict` containing each majors' number of students, the 
@@ -930,51 +873,19 @@ class Student(db.Model):
         return: 
             The average math placement scores of all students in the database represented by a `str`.
         '''
-        def __sum_math_placement() -> int:
-            '''
-            Calculates the sum of all math placement scores in the database.
-
-            return:
-                An `int` holding the sum of all math placement scores in the database.
-            '''
-            sum = 0
-            for student in Student.query.all():
-                student_math_placement = student.math_placement_score
-                if (student_math_placement is not None):
-                    sum += student.math_placement_score
-            return sum
-
-        total_students = len(Student.query.all())
-        math_score = __sum_math_placement()
-
-        return '%.2f' % (math_score / total_students) if total_students > 0 else 0.0
+        return Utils.get_kpis('avg_math_placement')['avg_math_placement']
 
     @staticmethod
     def get_avg_sat_total() -> str:
         '''
-        Calculates the average math placement scores for all students in the database.
+        Calculates the average total SAT scores for all students in the
+        database.
 
         return: 
-            The average math placement scores of all students in the database represented by a `str`.
+            The average total SAT scores of all students in the database
+            represented by a `str`.
         '''
-        def __sum_math_placement() -> int:
-            '''
-            Calculates the sum of all math placement scores in the database.
-
-            return:
-                An `int` holding the sum of all math placement scores in the database.
-            '''
-            sum = 0
-            for student in Student.query.all():
-                student_math_placement = student.math_placement_score
-                if (student_math_placement is not None):
-                    sum += student.math_placement_score
-            return sum
-
-        total_students = len(Student.query.all())
-        math_score = __sum_math_placement()
-
-        return '%.2f' % (math_score / total_students) if total_students > 0 else 0.0
+        return Utils.get_kpis('avg_sat_total')['avg_sat_total']
 
     @staticmethod
     def get_avg_sat_math() -> str:
@@ -984,51 +895,19 @@ class Student(db.Model):
         return: 
             The average math sat scores of all students in the database represented by a `str`.
         '''
-        def __sum_math() -> int:
-            '''
-            Calculates the sum of all math sat scores in the database.
-
-            return:
-                An `int` holding the sum of all math sat scores in the database.
-            '''
-            sum = 0
-            for student in Student.query.all():
-                student_math_sat = student.sat_math
-                if (student_math_sat is not None):
-                    sum += student.sat_math
-            return sum
-
-        total_students = len(Student.query.all())
-        math_score = __sum_math()
-
-        return '%.2f' % (math_score / total_students) if total_students > 0 else 0.0
+        return Utils.get_kpis('avg_sat_math')['avg_sat_math']
 
     @staticmethod
     def get_avg_act() -> str:
         '''
-        Calculates the average math sat scores for all students in the database.
+        Calculates the average ACT scores for all students in the
+        database.
 
         return: 
-            The average math sat scores of all students in the database represented by a `str`.
+            The average ACT scores of all students in the database
+            represented by a `str`.
         '''
-        def __sum_math() -> int:
-            '''
-            Calculates the sum of all math sat scores in the database.
-
-            return:
-                An `int` holding the sum of all math sat scores in the database.
-            '''
-            sum = 0
-            for student in Student.query.all():
-                student_math_sat = student.sat_math
-                if (student_math_sat is not None):
-                    sum += student.sat_math
-            return sum
-
-        total_students = len(Student.query.all())
-        math_score = __sum_math()
-
-        return '%.2f' % (math_score / total_students) if total_students > 0 else 0.0
+        return Utils.get_kpis('avg_act')['avg_act']
 
 
 class ClassData(db.Model):
@@ -1042,7 +921,10 @@ class ClassData(db.Model):
     subprogram_code = Column(Integer(), nullable=False)
     grade = Column(Text(), CheckConstraint("grade in ('A', 'A-', 'B+', 'B', 'B-', 'C+', 'C', 'C-', 'D+', 'D', 'D-', 'F', 'W', 'IP', 'P')"),
                    nullable=False)
-    course = Column(Integer(), ForeignKey('courses.id'), nullable=False)
+    course = Column(Integer(), ForeignKey('courses.id'), nullable=False,
+        index=True)
+    # A 64-bit hash of the row, used to skip rows that were already uploaded.
+    fingerprint = Column(Integer(), unique=True)
     course_obj = db.relationship('Course', uselist=False)
     student_obj = db.relationship('Student', uselist=False)
 
@@ -1055,15 +937,10 @@ class ClassData(db.Model):
             A `float` reprenting the average DWF rate of all students in the 
             database.
         '''
-        class_data = ClassData.query
-        num_grades = len(class_data.all())
-        num_with_dwf = len(class_data.filter(ClassData.grade =='F' or 
-            ClassData.grade =='W' or ClassData.grade=='D' or 
-            ClassData.grade =='D-' or ClassData.grade=='D+').all())
-
-        return '%.2f' % ((num_with_dwf / num_grades) * 100) if num_grades > 0 else 0.0
+        return Utils.get_kpis('dwf_avg')['dwf_avg']
 
     @classmethod
+    @result_cache.cached
     def get_avg_dwf_per_course(cls) -> list[dict]:
         '''
         Returns a `list` of `dict` objects with the average DWF for each course.
@@ -1072,31 +949,18 @@ class ClassData(db.Model):
             A `list` of `dict` objects with each course's number, the DWF rate, 
             and semester it ran.
         '''
-        dwf_list = []
-        grouped_courses = ClassData.query.order_by(ClassData.course).all()
-        grouped_courses = [list(c) for i, c in groupby(
-            grouped_courses, attrgetter('course_obj'))]
-        # Loop over every group, getting the class and DWF rate for each class.
-        for course_group in grouped_courses:
-            course_obj = course_group[0].course_obj
-            semester = course_obj.semester
-            course_num = course_obj.course_num
-            year = course_obj.year
-
-            # Get the grades, then make a call to get the avg DWF.
-            course_grades = [c.grade for c in course_group]
-            length = len(course_grades)
-            dwf_len = len(list(filter(lambda c: c == 'W' or c == 'D+' or c == 'D'
-                                      or c == 'D-' or c == 'F', course_grades)))
-            avg_dwf = ((dwf_len / length) * 100) if length > 0 else 0.0
-
-            # Add a dict to the list of each class.
-            dwf_list.append({
-                'course_num': course_num,
-                'semester': semester,
-                'year': year,
-                'avg_dwf':  avg_dwf
-            })
+        snapshot = get_snapshot()
+        courses = snapshot.course_averages(snapshot.is_dwf())
+
+        # Add a dict to the list for each class.
+        dwf_list = [{
+            'course_num': course_num,
+            'semester': semester,
+            'year': year,
+            'avg_dwf': avg_dwf * 100
+        } for course_num, semester, year, avg_dwf in zip(
+            courses['course_num'].tolist(), courses['semester'].tolist(),
+            courses['year'].tolist(), courses['average'].tolist())]
 
         # Sort the list, then return it.
         sorted_list = sorted(
@@ -1166,6 +1030,7 @@ class ClassData(db.Model):
         return return_list
 
     @staticmethod
+    @result_cache.cached
     def get_dwf_rate_per_semester():
         '''
         Returns a dictionary with the dwf rate per semester.
@@ -1173,20 +1038,11 @@ class ClassData(db.Model):
         return:
             A `dict` of semesters mapped to each DWF rate.
         '''
-        grouped_class_data = Utils.group_table_by_column(ClassData,
-                                                         ClassData.course)
-        return_dict = {}
-        for course_group in grouped_class_data:
-            # Get the grades, then make a call to get the avg DWF.
-            course_grades = [c.grade for c in course_group]
-            length = len(course_grades)
-            dwf_len = len(list(filter(lambda c: c == 'W' or c == 'D+' or c == 'D'
-                                      or c == 'D-' or c == 'F', course_grades)))
-            term = f'{course_group[0].course_obj.semester} {course_group[0].course_obj.year}'
-            return_dict[term] = round(
-                (dwf_len / length) * 100, 2) if length > 0 else 0
+        snapshot = get_snapshot()
+        dwf_rates = snapshot.term_averages(snapshot.is_dwf())
 
-        return return_dict
+        return {term: round_average(dwf_rate * 100)
+            for term, dwf_rate in dwf_rates.items()}
 
     @staticmethod
     def get_data(limit: int=None) -> list[dict]:
@@ -1203,16 +1059,17 @@ class ClassData(db.Model):
             A `list` of `dict` objects that contain the information about each
             class entry and the data related to it.
         '''
-        class_data = ClassData.query.all()
+        # The course, student and MCAS scores of every entry are loaded in the
+        # same query, rather than with a lazy-load query for each entry.
+        query = ClassData.query.options(joinedload(ClassData.course_obj),
+            joinedload(ClassData.student_obj).joinedload(
+                Student.mcas_score_obj)).order_by(ClassData.dummy_pk)
+        if (limit is not None):
+            query = query.limit(limit)
         return_list = []
 
-        # If the limit is not specified, set it to the max amount.
-        if (limit is None):
-            limit = len(class_data)
-
         # Loop over every ClassData object in the database, within the limit.
-        for i in range(limit):
-            current_class = class_data[i]
+        for current_class in query.all():
             current_student = current_class.student_obj
             current_course = current_class.course_obj
             current_mcas_scores = current_student.mcas_score_obj
@@ -1355,8 +1212,8 @@ class ClassData(db.Model):
                 'grade': current_class.grade,
                 'demographics': format_demographics(),
                 'academic_info': format_academic_info(),
-                'academic_scores': format_academic_scores()
-                # 'mcas_scores': format_mcas_scores()
+                'academic_scores': format_academic_scores(),
+                'mcas_scores': format_mcas_scores()
             }
             return_list.append(current_dict)
         return return_list
@@ -1369,28 +1226,9 @@ class ClassData(db.Model):
         return:
             A `str` representing the average course grade.
         '''
-        all_grades = []
-
-        grade_to_num = {
-            'A+': 13, 'A': 12, 'A-': 11, 'B+': 10, 'B': 9, 'B-': 8, 'C+': 7,
-            'C': 6, 'C-': 5, 'D+': 4, 'D': 3, 'D-': 2, 'F': 1
-        }
-
-        num_to_grade = {
-            13: 'A+', 12: 'A', 11: 'A-', 10: 'B+', 9: 'B', 8: 'B-', 7: 'C+',
-            6: 'C', 5: 'C-', 4: 'D+', 3: 'D', 2: 'D-', 1: 'F'
-        }
-
-        for class_data in ClassData.query.all():
-            if (class_data.grade != 'W' and class_data.grade != 'IP' and
-                    class_data.grade != 'P'):
-                all_grades.append(grade_to_num[class_data.grade])
-
-        if (len(all_grades) != 0):
-            return num_to_grade[round(sum(all_grades) / len(all_grades))]
-        else:
-            return 'N/A'
+        return Utils.get_kpis('avg_course_grade')['avg_course_grade']
 
+    @result_cache.cached
     def get_avg_gpa_per_cohort():
         '''
         Returns a `dict` containing the average student GPA for each class cohort.
@@ -1398,15 +1236,12 @@ class ClassData(db.Model):
         return:
             A `dict` containing the average student gpa per cohort.
         '''
-        grouped_cohorts = Utils.group_table_by_column(
-            Student, Student.class_year)
-        return_dict = {}
-        for group in grouped_cohorts:
-            gpas = [s.gpa_cumulative for s in group]
-            summed_gpa = sum(gpas)
-            return_dict[group[0].class_year.value] = round(
-                summed_gpa / len(gpas), 2) if len(gpas) > 0 else 0
-        return return_dict
+        students = get_snapshot().students
+        avg_gpas = students.groupby('class_year', observed=True)[
+            'gpa_cumulative'].mean().sort_index()
+
+        return {cohort: round_average(avg_gpa)
+            for cohort, avg_gpa in to_dict(avg_gpas).items()}
 
 
 class Course(db.Model):
@@ -1415,7 +1250,7 @@ class Course(db.Model):
     '''
     __tablename__ = 'courses'
     id = Column(Integer(), primary_key=True)
-    term_code = Column(Text(), nullable=False)
+    term_code = Column(Text(), nullable=False, index=True)
     course_num = Column(Text(), CheckConstraint('length(course_num) >= 7 AND length(course_num) <= 9'),
                         nullable=False)
     semester = Column(Text(), CheckConstraint('semester IN ("FA", "SP", "WI", "SU")'),
@@ -1423,6 +1258,7 @@ class Course(db.Model):
     year = Column(Integer(), nullable=False)
 
     @staticmethod
+    @result_cache.cached
     def get_course_semester_mapping() -> dict[str, list]:
         '''
         Returns a mapping of all the semesters each class has data in the 
@@ -1471,6 +1307,7 @@ class Course(db.Model):
 
 
     @staticmethod
+    @result_cache.cached
     def get_list_of_years() -> list:
         '''
         Returns a list of all the years input into the database.
@@ -1518,3 +1355,192 @@ class MCASScore(db.Model):
     stem_raw = Column(Integer())
     stem_scaled = Column(Integer())
     stem_achievement_level = Column(Text())
+
+
+class UploadedFile(db.Model):
+    '''
+    A class to represent a file that was uploaded, identified by the SHA-256
+    hash of its contents.
+    '''
+    __tablename__ = 'uploaded_files'
+    file_hash = Column(Text(), primary_key=True)
+    filename = Column(Text())
+    num_rows = Column(Integer(), nullable=False)
+    uploaded_at = Column(DateTime(), default=datetime.utcnow, nullable=False)
+
+
+class UploadedFileTerm(db.Model):
+    '''
+    A class to link an uploaded file to each term it held, so the file can be
+    uploaded again once a term is deleted.
+    '''
+    __tablename__ = 'uploaded_file_terms'
+    file_hash = Column(Text(), ForeignKey('uploaded_files.file_hash'),
+        primary_key=True)
+    term_code = Column(Text(), primary_key=True, index=True)
+
+
+class IngestionRecord(db.Model):
+    '''
+    A class to record an upload: who made it, how many rows went in and out,
+    and how long each of its stages took, so slow uploads can be spotted.
+    '''
+    __tablename__ = 'ingestion_history'
+    id = Column(Integer(), primary_key=True)
+    file_hash = Column(Text(), index=True)
+    filename = Column(Text())
+    user = Column(Text())
+    started_at = Column(DateTime(), nullable=False, index=True)
+    duration_seconds = Column(Float(), nullable=False)
+    status_code = Column(Integer(), nullable=False)
+    message = Column(Text())
+    rows_in = Column(Integer(), nullable=False, default=0)
+    class_data_written = Column(Integer(), nullable=False, default=0)
+    students_written = Column(Integer(), nullable=False, default=0)
+    courses_written = Column(Integer(), nullable=False, default=0)
+    error_count = Column(Integer(), nullable=False, default=0)
+    stage_seconds = Column(Text())
+    peak_memory_mb = Column(Float())
+
+    def get_stage_seconds(self) -> dict:
+        '''
+        Returns the time spent in each stage of the upload.
+
+        return:
+            A `dict` mapping the name of each stage to its number of seconds.
+        '''
+        return json.loads(self.stage_seconds) if self.stage_seconds else {}
+
+    def to_dict(self) -> dict:
+        '''
+        Returns the record in a JSON-like format.
+
+        return:
+            A `dict` holding every column, with the stage timings decoded.
+        '''
+        record = {col.name: getattr(self, col.name)
+            for col in self.__table__.columns}
+        record['started_at'] = self.started_at.isoformat()
+        record['stage_seconds'] = self.get_stage_seconds()
+        return record
+
+    @staticmethod
+    def get_recent(limit: int=20) -> list:
+        '''
+        Returns the most recent uploads.
+
+        param:
+            `limit`: The number of uploads to return.
+        return:
+            A `list` of `IngestionRecord` objects, newest first.
+        '''
+        return IngestionRecord.query.order_by(
+            IngestionRecord.started_at.desc()).limit(limit).all()
+
+
+class DataVersion(db.Model):
+    '''
+    A class to hold the version of the data, which changes each time an upload
+    or a deletion is committed. Cached analytics results are keyed on it.
+
+    The version is a random token rather than a counter, so a database that is
+    dropped and made again never reuses the version of the old one.
+    '''
+    __tablename__ = 'data_version'
+    id = Column(Integer(), primary_key=True)
+    version = Column(Text(), nullable=False)
+
+    @staticmethod
+    def get_version() -> str:
+        '''
+        Returns the current version of the data.
+
+        return:
+            A `str` holding the version, or `None` if the data has no version
+            yet.
+        '''
+        return db.session.execute(select(DataVersion.version)).scalar()
+
+    @staticmethod
+    def seed():
+        '''
+        Gives the data a version if it has none yet, so the results computed
+        from data stored before versions existed are cached too. Every worker
+        calls this when it starts, so a version that already exists is kept.
+        '''
+        with db.engine.begin() as conn:
+            conn.execute(DataVersion.__table__.insert().prefix_with(
+                'OR IGNORE').values(id=1, version=uuid4().hex))
+
+    @staticmethod
+    def bump(conn):
+        '''
+        Gives the data a new version. This should be called in the same
+        transaction as the change, so the new version is seen along with it.
+
+        param:
+            `conn`: The `Connection` to update with, inside of a transaction.
+        '''
+        data_version = DataVersion.__table__
+        version = uuid4().hex
+        updated = conn.execute(data_version.update().values(
+            version=version)).rowcount
+        if (updated == 0):
+            conn.execute(data_version.insert().values(id=1, version=version))
+
+
+def upgrade_schema():
+    '''
+    Brings the tables of a database made by an older version of the app up to
+    date, since `db.create_all()` only makes the tables that are missing. Each
+    step checks whether it is needed, so this is safe to call on every start.
+    '''
+    columns = [column['name'] for column in
+        sqlalchemy.inspect(db.engine).get_columns('class_data')]
+    if ('fingerprint' not in columns):
+        logger.info('Adding fingerprints to the Class Data.')
+        with db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text('ALTER TABLE class_data ADD COLUMN '
+                'fingerprint INTEGER'))
+            __add_fingerprints(conn)
+            conn.execute(sqlalchemy.text('CREATE UNIQUE INDEX IF NOT EXISTS '
+                'ix_class_data_fingerprint ON class_data (fingerprint)'))
+
+    # The indexes that deleting a term relies on.
+    with db.engine.begin() as conn:
+        conn.execute(sqlalchemy.text('CREATE INDEX IF NOT EXISTS '
+            'ix_class_data_course ON class_data (course)'))
+        conn.execute(sqlalchemy.text('CREATE INDEX IF NOT EXISTS '
+            'ix_courses_term_code ON courses (term_code)'))
+
+
+def __add_fingerprints(conn):
+    '''
+    Fingerprints the Class Data rows that were added before rows had
+    fingerprints. When a row was added more than once, only its first copy is
+    given the fingerprint, since fingerprints are unique.
+
+    param:
+        `conn`: The `Connection` to update with, inside of a transaction.
+    '''
+    import pandas as pd
+    from app.blueprints.dashboard.data_upload import (fingerprint_rows,
+        DEFAULT_CHUNK_SIZE)
+
+    rows = pd.read_sql(select(ClassData.dummy_pk, ClassData.student_id,
+        Course.term_code, Course.course_num, Course.semester, Course.year,
+        ClassData.program_level, ClassData.subprogram_code, ClassData.grade)
+        .join(Course, ClassData.course == Course.id)
+        .where(ClassData.fingerprint.is_(None))
+        .order_by(ClassData.dummy_pk), conn)
+    fingerprints = fingerprint_rows(rows)
+    existing = {fingerprint for fingerprint, in conn.execute(
+        select(ClassData.fingerprint).where(ClassData.fingerprint.isnot(None)))}
+    first = ~fingerprints.duplicated() & ~fingerprints.isin(existing)
+
+    updates = [{'pk': pk, 'fingerprint': fingerprint} for pk, fingerprint in
+        zip(rows.loc[first, 'dummy_pk'].tolist(), fingerprints[first].tolist())]
+    statement = sqlalchemy.text('UPDATE class_data SET fingerprint = '
+        ':fingerprint WHERE dummy_pk = :pk')
+    for start in range(0, len(updates), DEFAULT_CHUNK_SIZE):
+        conn.execute(statement, updates[start:start + DEFAULT_CHUNK_SIZE])
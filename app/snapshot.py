@@ -0,0 +1,370 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil.
+#
+# This file is part of STEM Data Dashboard.
+#
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+from threading import Lock
+from os import path, makedirs, listdir, rename
+from shutil import rmtree
+from tempfile import mkdtemp
+from flask import current_app
+from sqlalchemy import select
+from pandas import DataFrame, Series
+from pandas.api.types import is_categorical_dtype, is_extension_array_dtype
+import numpy as np
+import pandas as pd
+import json
+import logging as logger
+from app import db
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The numeric Student columns that are averaged by the charts, and whether
+# each one holds whole numbers.
+STUDENT_SCORES = {
+    'gpa_cumulative': False,
+    'high_school_gpa': False,
+    'math_placement_score': True,
+    'sat_total': True,
+    'sat_math': True,
+    'act_score': True
+}
+
+# The semesters in the order they run each year.
+SEMESTERS = ('WI', 'SP', 'SU', 'FA')
+
+# The Student columns that the bar charts can group students by.
+STUDENT_GROUPS = ('admit_term', 'admit_year', 'major_1_desc', 'major_2_desc',
+    'minor_1_desc', 'concentration_desc', 'class_year', 'city', 'state',
+    'race_ethnicity', 'gender', 'high_school_name', 'high_school_state')
+
+# The Student columns that the class by class charts list for each course.
+COURSE_GROUPS = ('race_ethnicity', 'gender')
+
+
+class AnalyticsSnapshot:
+    '''
+    Holds the Class Data, joined with its students and courses, as columns in
+    memory, so the charts can be computed with vectorized group-bys instead of
+    walking ORM objects.
+
+    `enrollments` has one row for each Class Data row, in the order they were
+    added, holding the scores of `STUDENT_SCORES` and the groups of
+    `COURSE_GROUPS` of its student. Grades are stored as `int8` codes into
+    `GRADES`, and the text columns as categoricals. Each term is keyed by an
+    integer made from its year and semester, e.g. `20213` for `FA 2021`, so
+    terms sort in the order they ran.
+    `students` has one row for each student.
+
+    A snapshot can be saved as a folder of `.npy` files, which other processes
+    open as read-only memory maps, so every worker shares one copy of it.
+    '''
+    def __init__(self, version: str, enrollments: DataFrame,
+        students: DataFrame):
+        self.version = version
+        self.enrollments = enrollments
+        self.students = students
+
+    @staticmethod
+    def build(version: str=None):
+        '''
+        Loads the snapshot from the database.
+
+        param:
+            `version`: The data version the snapshot is loaded from.
+        return:
+            The `AnalyticsSnapshot`.
+        '''
+        from app.models import ClassData, Course, Student, GRADES
+        conn = db.session.connection()
+
+        student_columns = [getattr(Student, column)
+            for column in tuple(STUDENT_SCORES) + COURSE_GROUPS]
+        enrollments = pd.read_sql(select(ClassData.course, ClassData.grade,
+            Course.course_num, Course.semester, Course.year, *student_columns)
+            .join(Course, ClassData.course == Course.id)
+            .join(Student, ClassData.student_id == Student.id)
+            .order_by(ClassData.dummy_pk), conn)
+        enrollments = enrollments.assign(
+            course=enrollments['course'].astype(np.int32),
+            grade=pd.Categorical(enrollments['grade'],
+                categories=GRADES).codes,
+            term=(enrollments['year'] * 10 + enrollments['semester'].map(
+                SEMESTERS.index)).astype(np.int32),
+            course_num=enrollments['course_num'].astype('category'),
+            semester=enrollments['semester'].astype('category'),
+            year=enrollments['year'].astype(np.int16),
+            **{column: enrollments[column].astype('category')
+                for column in COURSE_GROUPS})
+
+        students = pd.read_sql(select(*[getattr(Student, column)
+            for column in STUDENT_GROUPS + tuple(STUDENT_SCORES)]), conn)
+        students['class_year'] = students['class_year'].map(
+            lambda class_year: class_year.value, na_action='ignore')
+        # Every column is given a fixed type, since an empty table is read
+        # as `object` columns, which can't be memory mapped.
+        students = students.astype({column: 'category'
+            for column in STUDENT_GROUPS if column != 'admit_year'})
+        students['admit_year'] = students['admit_year'].astype(np.int64)
+
+        for frame in (enrollments, students):
+            for score, whole in STUDENT_SCORES.items():
+                frame[score] = frame[score].astype('Int64' if whole
+                    else np.float64)
+
+        return AnalyticsSnapshot(version, enrollments, students)
+
+    def save(self, directory: str):
+        '''
+        Saves the snapshot into the folder, writing one `.npy` file for each
+        array and a `snapshot.json` file describing the columns.
+
+        param:
+            `directory`: The path of the folder, which must exist.
+        '''
+        meta = {'version': self.version, 'frames': {}}
+        for name in ('enrollments', 'students'):
+            frame = getattr(self, name)
+            columns = []
+            for column, values in frame.items():
+                file_path = path.join(directory, f'{name}.{column}')
+                if (is_categorical_dtype(values.dtype)):
+                    np.save(f'{file_path}.npy', values.cat.codes.to_numpy())
+                    columns.append({'name': column, 'type': 'category',
+                        'categories': values.cat.categories.tolist()})
+                elif (is_extension_array_dtype(values.dtype)):
+                    # Nullable integers are saved as their values and a mask
+                    # of the missing ones.
+                    np.save(f'{file_path}.npy', values.to_numpy(
+                        dtype=values.dtype.numpy_dtype, na_value=0))
+                    np.save(f'{file_path}.mask.npy', values.isna().to_numpy())
+                    columns.append({'name': column, 'type': 'integer'})
+                elif (values.dtype != object):
+                    np.save(f'{file_path}.npy', values.to_numpy())
+                    columns.append({'name': column, 'type': 'numpy'})
+                else:
+                    raise ValueError(f'{name}.{column} holds Python objects, '
+                        'which can\'t be memory mapped.')
+            meta['frames'][name] = {'length': len(frame), 'columns': columns}
+
+        with open(path.join(directory, 'snapshot.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    @staticmethod
+    def load(directory: str):
+        '''
+        Opens a snapshot saved by `save`, mapping each array read-only into
+        memory instead of reading it.
+
+        param:
+            `directory`: The path of the folder.
+        return:
+            The `AnalyticsSnapshot`.
+        '''
+        with open(path.join(directory, 'snapshot.json')) as meta_file:
+            meta = json.load(meta_file)
+
+        frames = {}
+        for name, frame in meta['frames'].items():
+            arrays = {}
+            for column in frame['columns']:
+                file_path = path.join(directory, f'{name}.{column["name"]}')
+                values = np.load(f'{file_path}.npy', mmap_mode='r')
+                if (column['type'] == 'category'):
+                    values = pd.Categorical.from_codes(values,
+                        categories=column['categories'])
+                elif (column['type'] == 'integer'):
+                    values = pd.arrays.IntegerArray(values, np.load(
+                        f'{file_path}.mask.npy', mmap_mode='r'))
+                arrays[column['name']] = values
+            frames[name] = DataFrame(arrays, index=pd.RangeIndex(
+                frame['length']), columns=[column['name'] for column in
+                frame['columns']], copy=False)
+
+        return AnalyticsSnapshot(meta['version'], frames['enrollments'],
+            frames['students'])
+
+    def is_dwf(self) -> Series:
+        '''
+        Returns whether each enrollment's grade counts towards the DWF rate.
+
+        return:
+            A `Series` of `bool`, one for each enrollment.
+        '''
+        from app.models import GRADES, DWF_GRADES
+        dwf_codes = [GRADES.index(grade) for grade in DWF_GRADES]
+        return Series(np.isin(self.enrollments['grade'].to_numpy(), dwf_codes),
+            index=self.enrollments.index)
+
+    def term_averages(self, values: Series) -> dict:
+        '''
+        Averages the values of the enrollments in each term.
+
+        param:
+            `values`: A `Series` holding a value for each enrollment.
+        return:
+            A `dict` mapping the name of each term, e.g. `FA 2021`, to its
+            average, in term order. The average is `NaN` when the term has no
+            values.
+        '''
+        averages = values.groupby(self.enrollments['term']).mean()
+        return {f'{SEMESTERS[term % 10]} {term // 10}': average
+            for term, average in to_dict(averages).items()}
+
+    def course_averages(self, values: Series) -> DataFrame:
+        '''
+        Averages the values of the enrollments in each course.
+
+        param:
+            `values`: A `Series` holding a value for each enrollment.
+        return:
+            A `DataFrame` indexed by course ID, holding each course's
+            `course_num`, `semester`, `year` and `average`.
+        '''
+        averages = values.groupby(self.enrollments['course']).mean()
+        courses = self.enrollments.drop_duplicates('course').set_index(
+            'course')
+        return courses.loc[averages.index, ['course_num', 'semester',
+            'year']].assign(average=averages)
+
+    def grades(self, enrollments: DataFrame) -> list[str]:
+        '''
+        Returns the letter grades of the enrollments.
+
+        param:
+            `enrollments`: Rows of `enrollments`.
+        return:
+            A `list` of the letter grades, in order.
+        '''
+        from app.models import GRADES
+        return np.asarray(GRADES)[enrollments['grade'].to_numpy()].tolist()
+
+
+snapshot_lock = Lock()
+latest_snapshot = None
+
+
+def get_snapshot() -> AnalyticsSnapshot:
+    '''
+    Returns the snapshot of the current data version. The first time a version
+    is seen, the snapshot is opened from the folder named by the
+    `ANALYTICS_SNAPSHOT_DIR` config value, and only loaded from the database if
+    no other process has saved it there yet. Setting the config value to `None`
+    keeps each snapshot in the memory of its process.
+
+    The data is loaded on every call while it has no version yet.
+
+    return:
+        The `AnalyticsSnapshot`.
+    '''
+    global latest_snapshot
+    from app.models import DataVersion
+    version = DataVersion.get_version()
+    if (version is None):
+        return AnalyticsSnapshot.build()
+
+    with snapshot_lock:
+        if (latest_snapshot is None or latest_snapshot.version != version):
+            snapshot_dir = current_app.config.get('ANALYTICS_SNAPSHOT_DIR',
+                path.join(current_app.instance_path, 'snapshots'))
+            if (snapshot_dir):
+                latest_snapshot = __share_snapshot(snapshot_dir, version)
+            else:
+                latest_snapshot = AnalyticsSnapshot.build(version)
+        return latest_snapshot
+
+
+def __share_snapshot(snapshot_dir: str, version: str) -> AnalyticsSnapshot:
+    '''
+    Opens the saved snapshot of the version, saving it first if it does not
+    exist. A lock file keeps the other processes from loading the same version
+    at the same time, and the snapshots of older versions are removed.
+
+    param:
+        snapshot_dir: The folder that holds a folder for each version.
+        version: The current data version.
+    return:
+        The `AnalyticsSnapshot`.
+    '''
+    version_dir = path.join(snapshot_dir, version)
+    try:
+        makedirs(snapshot_dir, exist_ok=True)
+        with open(path.join(snapshot_dir, '.lock'), 'w') as lock_file:
+            if (fcntl is not None):
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if (not path.isdir(version_dir)):
+                # Save into a temporary folder, then rename it, so other
+                # processes never open a snapshot that is half written.
+                temp_dir = mkdtemp(prefix='.tmp-', dir=snapshot_dir)
+                try:
+                    AnalyticsSnapshot.build(version).save(temp_dir)
+                    rename(temp_dir, version_dir)
+                except BaseException:
+                    rmtree(temp_dir, ignore_errors=True)
+                    raise
+
+                # Processes that still map an old snapshot keep it until they
+                # let go of it.
+                for name in listdir(snapshot_dir):
+                    if (name != version and not name.startswith('.')):
+                        rmtree(path.join(snapshot_dir, name),
+                            ignore_errors=True)
+
+            try:
+                return AnalyticsSnapshot.load(version_dir)
+            except BaseException:
+                # A snapshot that can't be opened is removed, so the next
+                # process saves it again instead of failing on it too.
+                rmtree(version_dir, ignore_errors=True)
+                raise
+    except (OSError, ValueError, KeyError):
+        logger.exception('Unable to share the analytics snapshot in %s.',
+            snapshot_dir)
+        return AnalyticsSnapshot.build(version)
+
+
+def to_dict(series: Series) -> dict:
+    '''
+    Converts a `Series` into a `dict`, with its keys and values as plain Python
+    objects so it can be returned as JSON.
+
+    param:
+        `series`: The `Series` to convert.
+    return:
+        A `dict` mapping each index label to its value.
+    '''
+    return dict(zip(series.index.tolist(), series.tolist()))
+
+
+def round_average(average) -> float:
+    '''
+    Rounds an average to 2 decimal places the way the charts display it.
+
+    param:
+        `average`: The average, which is `NaN` when there was nothing to
+        average.
+    return:
+        The rounded average, or 0 if there was nothing to average.
+    '''
+    return round(float(average), 2) if not pd.isna(average) else 0
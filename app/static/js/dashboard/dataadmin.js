@@ -44,30 +44,90 @@ uploadButton.addEventListener('click', async () => {
     let file = fileUpload.files[0];
     const data = new FormData();
     data.append('file', file);
+    data.append('data_type', document.getElementById('dataType').value);
     const response = await fetch('/upload', {
         method: 'POST',
         body: data
     });
+    const json = await response.json();
 
-    if (response.status == 200) {
+    if (response.status == 202) {
+        uploadButton.disabled = true;
+        const job = await waitForUpload(json.job_id);
+        uploadButton.disabled = false;
+        uploadButton.textContent = 'Upload Data';
+        showUploadResult(job.status_code, job.result, job.errors_url);
+    } else {
+        showUploadResult(response.status, json);
+    }
+});
+
+/**
+ * Polls the status of the upload until it has finished, showing the progress
+ * on the upload button.
+ *
+ * @param {string} jobId The ID of the upload job.
+ * @returns The final status of the upload. If the status could not be found,
+ *     e.g. the job has expired or the user was logged out, the status code
+ *     and message of that response are returned instead.
+ */
+async function waitForUpload(jobId) {
+    while (true) {
+        const response = await fetch(`/upload-status/${jobId}`);
+        if (!response.ok || response.redirected) {
+            const body = await response.json().catch(() => ({}));
+            return {
+                status_code: response.ok ? 401 : response.status,
+                result: {
+                    message: body.message ||
+                        'Unable to check the status of the upload.'
+                }
+            };
+        }
+
+        const job = await response.json();
+        if (job.finished) {
+            return job;
+        }
+
+        uploadButton.textContent = `${job.phase}... (${job.rows_processed} rows)`;
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+}
+
+/**
+ * Shows either the message or the errors returned by an upload.
+ *
+ * @param {number} status The status code of the upload.
+ * @param {object} result The body returned by the upload.
+ * @param {string} errorsUrl The URL to download every error from, if any.
+ */
+function showUploadResult(status, result, errorsUrl) {
+    if (status == 200) {
         $.alert({
             title: 'Success!',
-            content: 'Data uploaded successfully!',
+            content: result.message,
             type: 'green',
             typeAnimated: true
         });
-    } else {
-        const json = await response.json();
+    } else if (result.errors) {
         $.dialog({
             title: 'Data Upload Failed',
             width: 500,
             type: 'red',
-            content: buildTable(json)
+            content: buildTable(result, errorsUrl)
+        });
+    } else {
+        $.alert({
+            title: 'Data Upload Failed',
+            content: result.message,
+            type: 'red',
+            typeAnimated: true
         });
     }
-});
+}
 
-function buildTable(data) {
+function buildTable(data, errorsUrl) {
     let error_str = '';
     for (const error of data.errors) { 
         error_str += `
@@ -82,6 +142,7 @@ function buildTable(data) {
     let return_str = `
     <div style='overflow-y: auto'>
         <h6>The following errors were found while uploading your data. Please consult the sample data for a guide as to how data should look.</h6>
+        ${buildTruncatedNote(data, errorsUrl)}
         <table class='table table-responsive'>
             <thead>
                 <tr>
@@ -97,4 +158,20 @@ function buildTable(data) {
     </div>
     `
     return return_str;
-}
\ No newline at end of file
+}
+
+/**
+ * Builds the note shown when only the first errors of an upload are listed.
+ *
+ * @param {object} data The body returned by the upload.
+ * @param {string} errorsUrl The URL to download every error from, if any.
+ * @returns The HTML of the note, or an empty string if every error is listed.
+ */
+function buildTruncatedNote(data, errorsUrl) {
+    if (!data.errors_truncated) {
+        return '';
+    }
+
+    const link = errorsUrl ? ` <a href='${errorsUrl}'>Download every error.</a>` : '';
+    return `<p>Showing the first ${data.errors.length} of ${data.error_count} errors.${link}</p>`;
+}
@@ -23,4 +23,6 @@
 
 export env='prod'
 pip3 install gunicorn
-gunicorn --bind 127.0.0.1:5006 --certfile=instance/cert.pem --keyfile=instance/key.pem 'app:init_app()'
\ No newline at end of file
+# Upload jobs are tracked in the memory of the worker that started them, so
+# only one worker process may be used. Add threads to serve more requests.
+gunicorn --workers 1 --threads 4 --bind 127.0.0.1:5006 --certfile=instance/cert.pem --keyfile=instance/key.pem 'app:init_app()'
\ No newline at end of file
@@ -0,0 +1,883 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil.
+#
+# This file is part of STEM Data Dashboard.
+#
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from app.blueprints.dashboard.validation import (validate_students,
+    validate_class_data)
+from app.blueprints.dashboard.data_upload import (upload_csv_file, start_upload,
+    delete_term, upload_batch)
+from app.models import (ClassEnum, Student, ClassData, Course, UploadedFile,
+    UploadedFileTerm, IngestionRecord, MCASScore)
+from app.jobs import Job
+from werkzeug.datastructures import FileStorage
+from os import path
+from io import BytesIO
+from openpyxl import Workbook
+from zipfile import ZipFile, ZIP_DEFLATED
+import gzip
+import pandas as pd
+import pytest
+
+
+def test_validate_good_data(read_data):
+    csv_file = read_data('GOOD DATA.csv')
+
+    students, student_errors = validate_students(csv_file, set())
+    class_data, class_errors = validate_class_data(csv_file)
+
+    assert (len(student_errors) == 0)
+    assert (len(class_errors) == 0)
+
+    # Only one row for each student should be kept.
+    assert (len(students) == csv_file['Unique_ID'].nunique())
+    assert (len(class_data) == len(csv_file))
+    assert (all(isinstance(c, ClassEnum) for c in students['Class']))
+
+
+@pytest.mark.parametrize(
+    'column, value, message, col_num', [
+        ('Term', None, 'Missing Term', 5),
+        ('Term', 'FA2020', 'Invalid Term', 5),
+        ('Term', 'XX 2020', 'Invalid Semester', 5),
+        ('Term', 'FA 3000', 'Invalid Year', 5),
+        ('Course_Number', 'BIO1', 'Invalid Course number.', 34),
+        ('Program_Level', 'HIGH',
+            'Invalid Program Level (Must be either UNDG or GRAD)', 7),
+        ('Course_Grade', 'Z', 'Invalid Course Grade', 35),
+        ('Unique_ID', None, 'Missing Unique_ID', 1)
+])
+def test_validate_class_data_errors(column, value, message, col_num, read_data):
+    csv_file = read_data('GOOD DATA.csv')
+    csv_file.loc[3, column] = value
+
+    class_data, errors = validate_class_data(csv_file)
+
+    assert (len(errors) == 1)
+    assert (errors[0].message == message)
+    assert (errors[0].line_num == 5)
+    assert (errors[0].col_num == col_num)
+    assert (3 not in class_data.index)
+
+
+def test_validate_students_errors(read_data):
+    csv_file = read_data('GOOD DATA.csv')
+    first_id = csv_file['Unique_ID'][0]
+    csv_file.loc[0, 'Class'] = 'XX'
+    csv_file.loc[0, 'City'] = None
+
+    students, errors = validate_students(csv_file, set())
+
+    assert ([(e.message, e.line_num, e.col_num) for e in errors] ==
+        [('Invalid Class', 2, 17), ('City missing.', 2, 18)])
+
+    # The student's next valid row should be used instead.
+    assert (first_id in set(students['Unique_ID']))
+    assert (0 not in students.index)
+
+
+def test_validate_students_skips_existing(read_data):
+    csv_file = read_data('GOOD DATA.csv')
+    first_id = csv_file['Unique_ID'][0]
+    csv_file.loc[csv_file['Unique_ID'] == first_id, 'Sex'] = None
+
+    students, errors = validate_students(csv_file, {first_id})
+
+    assert (len(errors) == 0)
+    assert (first_id not in set(students['Unique_ID']))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_good_data(test_client, data_path, read_data):
+    csv_file = read_data('GOOD DATA.csv')
+
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file), batch_size=7)
+
+    assert (status == 200)
+    assert (Student.query.count() == csv_file['Unique_ID'].nunique())
+    assert (ClassData.query.count() == len(csv_file))
+    assert (Course.query.count() == len(csv_file[['Numeric_Term_Code', 
+        'Course_Number', 'Term']].drop_duplicates()))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_bad_data(test_client, data_path):
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file))
+
+    assert (status == 400)
+    assert (res['message'] == 'Errors while parsing data.')
+    assert (len(res['errors']) > 0)
+
+    # Nothing should be saved when the file has errors.
+    assert (Student.query.count() == 0)
+    assert (ClassData.query.count() == 0)
+    assert (Course.query.count() == 0)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_reuses_courses(test_client, data_path, read_data):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    for city in ('Boston', 'Andover'):
+        # Each upload is a different file, so neither one is skipped.
+        csv_file['City'] = city
+        res, status = upload_csv_file(FileStorage(BytesIO(
+            csv_file.to_csv(index=False).encode()), 'data.csv'))
+        assert (status == 200)
+        num_courses = Course.query.count()
+
+    # The second upload should find every course from the first.
+    csv_file = read_data('GOOD DATA.csv')
+    assert (num_courses == len(csv_file[['Numeric_Term_Code', 'Course_Number',
+        'Term']].drop_duplicates()))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_skips_existing_students(test_client, mocker, data_path):
+    from app.blueprints.dashboard import data_upload
+    mocker.patch.object(data_upload, 'IN_CLAUSE_CHUNK_SIZE', 4)
+
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file))
+    num_students = Student.query.count()
+
+    # Students that already exist are not checked or inserted again.
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    csv_file['Sex'] = None
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        csv_file.to_csv(index=False).encode()), 'data.csv'))
+
+    assert (status == 200)
+    assert (Student.query.count() == num_students)
+    assert (data_upload.find_existing_students(csv_file['Unique_ID']) ==
+        set(csv_file['Unique_ID']))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_reupload_is_skipped(test_client, mocker, data_path, read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    assert (status == 200)
+
+    # The same file should not be read again.
+    read_csv = mocker.spy(pd, 'read_csv')
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+
+    assert (status == 200)
+    assert (res['message'] == 'File has already been uploaded.')
+    assert (read_csv.call_count == 0)
+
+    csv_file = read_data('GOOD DATA.csv')
+    assert (UploadedFile.query.count() == 1)
+    assert (UploadedFile.query.first().num_rows == len(csv_file))
+    assert (ClassData.query.count() == len(csv_file))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_skips_existing_rows(test_client, data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    upload_csv_file(FileStorage(BytesIO(
+        csv_file.iloc[:10].to_csv(index=False).encode()), 'data.csv'))
+
+    # Only the rows that were not in the first file, and only one copy of each
+    # repeated row, should be inserted.
+    corrected = pd.concat([csv_file, csv_file.iloc[:3]])
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        corrected.to_csv(index=False).encode()), 'corrected.csv'),
+        chunk_size=7)
+
+    assert (status == 200)
+    assert (ClassData.query.count() == len(csv_file))
+    assert (UploadedFile.query.count() == 2)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_updates_students(test_client, data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    upload_csv_file(FileStorage(BytesIO(
+        csv_file.to_csv(index=False).encode()), 'fall.csv'))
+
+    # Only the changed students should be written, and missing values should
+    # keep what is stored.
+    first_id, second_id, third_id = csv_file['Unique_ID'].unique()[:3]
+    csv_file.loc[csv_file['Unique_ID'] == first_id, 'GPA_Cum'] = 3.999
+    csv_file.loc[csv_file['Unique_ID'] == first_id, 'Class'] = 'SR'
+    csv_file.loc[csv_file['Unique_ID'] == second_id, 'SAT_Math'] = None
+    csv_file.loc[csv_file['Unique_ID'] == third_id, 'GPA_Cum'] = None
+    sat_math = Student.query.get(second_id).sat_math
+    gpa = Student.query.get(third_id).gpa_cumulative
+
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        csv_file.to_csv(index=False).encode()), 'spring.csv'),
+        update_students=True)
+
+    assert (status == 200)
+    # The second and third students' only changes are missing values, so only
+    # the first student is written.
+    assert (res['rows_written'] == {'courses': 0, 'students': 1,
+        'class_data': 0, 'mcas_scores': 0})
+    assert (Student.query.count() == csv_file['Unique_ID'].nunique())
+    assert (Student.query.get(first_id).gpa_cumulative == 3.999)
+    assert (Student.query.get(first_id).class_year == ClassEnum.SENIOR)
+    assert (Student.query.get(second_id).sat_math == sat_math)
+    assert (gpa > 0)
+    assert (Student.query.get(third_id).gpa_cumulative == gpa)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_update_validates_students(test_client, data_path):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file))
+
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    csv_file['Sex'] = None
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        csv_file.to_csv(index=False).encode()), 'data.csv'),
+        update_students=True)
+
+    # Students that would be updated are checked like new students.
+    assert (status == 400)
+    assert (res['error_summary'] == [{'error_message': 'Sex missing.',
+        'col_num': 22, 'count': len(csv_file), 'first_line': 2,
+        'last_line': len(csv_file) + 1}])
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_in_chunks(test_client, data_path, read_data):
+    def upload(chunk_size: int) -> list[tuple]:
+        with open(data_path('BAD DATA.csv'), 'rb') as file:
+            res, status = upload_csv_file(FileStorage(file),
+                chunk_size=chunk_size)
+        assert (status == 400)
+        return sorted((e['error_message'], e['line_num'], e['col_num'])
+            for e in res['errors'])
+
+    # Reading the file in chunks should find the same errors on the same lines.
+    assert (upload(5) == upload(1000))
+
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file), chunk_size=5)
+
+    csv_file = read_data('GOOD DATA.csv')
+    assert (status == 200)
+    assert (Student.query.count() == csv_file['Unique_ID'].nunique())
+    assert (ClassData.query.count() == len(csv_file))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_dry_run(test_client, data_path):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file), dry_run=True)
+
+    # Nothing should be written, and the file should not be marked as uploaded.
+    assert (status == 200)
+    assert (res['message'] == 'File is valid.')
+    assert (Student.query.count() == 0)
+    assert (ClassData.query.count() == 0)
+    assert (Course.query.count() == 0)
+    assert (UploadedFile.query.count() == 0)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_dry_run_stops_after_max_errors(test_client, data_path, read_data):
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        all_errors, status = upload_csv_file(FileStorage(file), dry_run=True)
+
+    job = Job()
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file), chunk_size=5,
+            job=job, dry_run=True, max_errors=2)
+
+    # Only the first errors are returned, and the rest of the file is not read.
+    assert (status == 400)
+    assert (res['errors'] == all_errors['errors'][:2])
+    assert (job.rows_processed < len(read_data('BAD DATA.csv')))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_keeps_typed_values(test_client, data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'), dtype=str)
+    csv_file.loc[:, 'Postal_Code'] = '01776'
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        csv_file.to_csv(index=False).encode()), 'data.csv'))
+
+    # Codes should be kept as text, so leading zeros are not lost.
+    assert (status == 200)
+    assert ({student.postal_code for student in Student.query} == {'01776'})
+    assert (all(isinstance(course.year, int) for course in Course.query))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+@pytest.mark.parametrize(
+    'column, value, message, col_num', [
+        ('SAT_Math', 'abc', 'SAT_Math must be a whole number.', 25),
+        ('Numeric_Term_Code', '2021FA',
+            'Numeric_Term_Code must be a whole number.', 6),
+        ('Admit_Year', 2019.5, 'Admit_Year must be a whole number.', 2),
+        ('GPA_Cum', 'high', 'GPA_Cum must be a number.', 24)
+])
+def test_upload_invalid_number(test_client, column, value, message, col_num,
+    data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    csv_file[column] = csv_file[column].astype(object)
+    csv_file.loc[20, column] = value
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        csv_file.to_csv(index=False).encode()), 'data.csv'), chunk_size=10)
+
+    # The value is reported on its own line, and the rest of the file is
+    # still read.
+    assert (status == 400)
+    assert (res['message'] == 'Errors while parsing data.')
+    assert ((res['errors'][0]['error_message'], res['errors'][0]['line_num'],
+        res['errors'][0]['col_num']) == (message, 22, col_num))
+    assert (Student.query.count() == 0)
+    assert (ClassData.query.count() == 0)
+
+
+def __to_xlsx(sheets: dict[str, pd.DataFrame]) -> BytesIO:
+    '''
+    Writes each `DataFrame` to a sheet of a workbook, with whole numbers stored
+    as floats and notes added to the headers like in the sample workbook.
+
+    param:
+        sheets: A `dict` mapping the name of each sheet to its data.
+    return:
+        A `BytesIO` object holding the workbook.
+    '''
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for title, csv_file in sheets.items():
+        sheet = workbook.create_sheet(title)
+        sheet.append([f'{col} (REQUIRED)' for col in csv_file.columns])
+        for row in csv_file.itertuples(index=False):
+            sheet.append([float(value) if isinstance(value, int) else value
+                for value in row])
+        # Empty rows should be skipped.
+        sheet.append([None] * len(csv_file.columns))
+
+    file = BytesIO()
+    workbook.save(file)
+    file.seek(0)
+    return file
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_xlsx(test_client, read_data):
+    csv_file = read_data('GOOD DATA.csv')
+    file = __to_xlsx({'Fall': csv_file.iloc[:50], 'Spring': csv_file.iloc[50:]})
+
+    res, status = upload_csv_file(FileStorage(file, 'data.xlsx'), chunk_size=7)
+
+    # The workbook should be stored the same way as the csv file.
+    assert (status == 200)
+    assert (Student.query.count() == csv_file['Unique_ID'].nunique())
+    assert (ClassData.query.count() == len(csv_file))
+    assert (Course.query.count() == len(csv_file[['Numeric_Term_Code', 
+        'Course_Number', 'Term']].drop_duplicates()))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_xlsx_errors(test_client, read_data):
+    csv_file = read_data('GOOD DATA.csv')
+    bad_file = csv_file.iloc[:10].copy()
+    bad_file.loc[3, 'Course_Grade'] = 'Z'
+    file = __to_xlsx({'Fall': csv_file.iloc[10:], 'Spring': bad_file})
+
+    res, status = upload_csv_file(FileStorage(file, 'data.xlsx'))
+
+    # Each error should give its line in the sheet it was found on.
+    assert (status == 400)
+    assert (res['errors'] == [{'error_message': 'Invalid Course Grade',
+        'line_num': 5, 'col_num': 35, 'sheet': 'Spring'}])
+    assert (ClassData.query.count() == 0)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_gzip(test_client, data_path, read_data):
+    csv_file = read_data('GOOD DATA.csv')
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        compressed = BytesIO(gzip.compress(file.read()))
+
+    res, status = upload_csv_file(FileStorage(compressed, 'data.csv.gz'),
+        chunk_size=7)
+
+    assert (status == 200)
+    assert (ClassData.query.count() == len(csv_file))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_zip(test_client, data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    bad_term = csv_file[csv_file['Numeric_Term_Code'] == 202140].copy()
+    bad_term.iloc[2, bad_term.columns.get_loc('Course_Grade')] = 'Z'
+
+    archive = BytesIO()
+    with ZipFile(archive, 'w', ZIP_DEFLATED) as zip_file:
+        for term, rows in csv_file.groupby('Numeric_Term_Code'):
+            zip_file.writestr(f'terms/{term}.csv', rows.to_csv(index=False))
+        zip_file.writestr('__MACOSX/terms/._202140.csv', b'\x00\x05')
+        zip_file.writestr('terms/', b'')
+    archive.seek(0)
+
+    # Every term in the archive should be added as one file.
+    res, status = upload_csv_file(FileStorage(archive, 'terms.zip'))
+    assert (status == 200)
+    assert (ClassData.query.count() == len(csv_file))
+    assert (UploadedFile.query.count() == 1)
+    assert (UploadedFileTerm.query.count() ==
+        csv_file['Numeric_Term_Code'].nunique())
+
+    # Errors should name the file in the archive they were found in.
+    archive = BytesIO()
+    with ZipFile(archive, 'w', ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('202140.csv', bad_term.to_csv(index=False))
+        zip_file.writestr('202140.xlsx', __to_xlsx({'Fall': bad_term}
+            ).getvalue())
+    archive.seek(0)
+
+    res, status = upload_csv_file(FileStorage(archive, 'bad.zip'))
+    assert (status == 400)
+    assert (res['errors'] == [{'error_message': 'Invalid Course Grade',
+        'line_num': 4, 'col_num': 35, 'sheet': '202140.csv'},
+        {'error_message': 'Invalid Course Grade', 'line_num': 4,
+        'col_num': 35, 'sheet': '202140.xlsx: Fall'}])
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_corrupt_archive(test_client):
+    for filename in ('data.zip', 'data.csv.gz'):
+        res, status = upload_csv_file(FileStorage(BytesIO(b'not compressed'),
+            filename))
+
+        assert (status == 400)
+        assert (res['message'] == 'Unable to read file')
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_stages_without_locking(test_client, data_path, read_data):
+    from app import db
+
+    class WritingJob(Job):
+        '''
+        A job that writes to the database from another connection after each
+        chunk, which would time out if the upload held a write lock.
+        '''
+        def add_rows(self, num_rows: int):
+            super().add_rows(num_rows)
+            with db.engine.connect() as conn:
+                conn.execute(Course.__table__.insert(), {'term_code': '201010',
+                    'course_num': f'TST{1000 + self.rows_processed}',
+                    'semester': 'FA', 'year': 2010})
+            # The staged rows are not live until the whole file is promoted.
+            assert (ClassData.query.count() == 0)
+
+    job = WritingJob()
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file), chunk_size=20,
+            job=job)
+
+    csv_file = read_data('GOOD DATA.csv')
+    assert (status == 200)
+    assert (ClassData.query.count() == len(csv_file))
+    assert (Course.query.filter_by(term_code='201010').count() ==
+        -(-len(csv_file) // 20))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_in_background(test_client, data_path, read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        job = start_upload(FileStorage(file, 'GOOD DATA.csv'))
+    job.wait(60)
+
+    csv_file = read_data('GOOD DATA.csv')
+    status = job.to_dict()
+    assert (status['finished'])
+    assert (status['phase'] == 'finished')
+    assert (status['status_code'] == 200)
+    assert (status['rows_processed'] == len(csv_file))
+    assert (ClassData.query.count() == len(csv_file))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_error_report(test_client, data_path):
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        all_errors, status = upload_csv_file(FileStorage(file))
+
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file), error_limit=3)
+
+    # Only the first errors are kept in full, but every error is counted.
+    assert (status == 400)
+    assert (not all_errors['errors_truncated'])
+    assert (res['errors'] == all_errors['errors'][:3])
+    assert (res['errors_truncated'])
+    assert (res['error_count'] == len(all_errors['errors']))
+    assert (res['error_summary'] == all_errors['error_summary'])
+
+    for rule in res['error_summary']:
+        lines = [e['line_num'] for e in all_errors['errors']
+            if (e['error_message'], e['col_num']) ==
+                (rule['error_message'], rule['col_num'])]
+        assert ((rule['count'], rule['first_line'], rule['last_line']) ==
+            (len(lines), lines[0], lines[-1]))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_error_file(test_client, data_path):
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        all_errors, status = upload_csv_file(FileStorage(file))
+
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        job = start_upload(FileStorage(file, 'BAD DATA.csv'))
+    job.wait(60)
+
+    # Every error should be written to the job's error file.
+    errors = pd.read_csv(job.files['errors'])
+    assert ([(e['error_message'], e['line_num'], e['col_num'])
+        for e in all_errors['errors']] ==
+        list(errors[['error_message', 'line_num', 'col_num']].itertuples(
+            index=False, name=None)))
+
+    error_file = job.files['errors']
+    job.remove_files()
+    assert (not path.exists(error_file))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_concurrent_uploads(test_client, data_path, read_data):
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        expected_errors, status = upload_csv_file(FileStorage(file))
+
+    # Each upload should only report its own errors.
+    jobs = []
+    for file_name in ('BAD DATA.csv', 'GOOD DATA.csv', 'BAD DATA.csv'):
+        with open(data_path(file_name), 'rb') as file:
+            jobs.append(start_upload(FileStorage(file, file_name)))
+    for job in jobs:
+        job.wait(60)
+
+    assert ([job.status_code for job in jobs] == [400, 200, 400])
+    assert (jobs[0].result == expected_errors)
+    assert (jobs[2].result == expected_errors)
+    assert (ClassData.query.count() == len(read_data('GOOD DATA.csv')))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_concurrent_uploads_of_same_students(test_client, data_path, read_data):
+    jobs = []
+    for _ in range(3):
+        with open(data_path('GOOD DATA.csv'), 'rb') as file:
+            jobs.append(start_upload(FileStorage(file, 'GOOD DATA.csv')))
+    for job in jobs:
+        job.wait(60)
+
+    # Only the first upload to write should insert the students.
+    csv_file = read_data('GOOD DATA.csv')
+    assert ([job.status_code for job in jobs] == [200, 200, 200])
+    assert (Student.query.count() == csv_file['Unique_ID'].nunique())
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_delete_term(test_client, data_path, read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    csv_file = read_data('GOOD DATA.csv')
+    term = csv_file[csv_file['Numeric_Term_Code'] == 202140]
+
+    counts = delete_term('202140')
+
+    assert (counts['class_data'] == len(term))
+    assert (ClassData.query.count() == len(csv_file) - len(term))
+    assert (Course.query.filter_by(term_code='202140').count() == 0)
+    assert (Student.query.count() == csv_file['Unique_ID'].nunique())
+
+    # The file held the term, so it can be uploaded again.
+    assert (UploadedFile.query.count() == 0)
+    assert (UploadedFileTerm.query.count() == 0)
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+
+    assert (status == 200)
+    assert (res['rows_written']['class_data'] == len(term))
+    assert (ClassData.query.count() == len(csv_file))
+    assert (delete_term('201540') == {'class_data': 0, 'courses': 0})
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_replaces_terms(test_client, data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    upload_csv_file(FileStorage(BytesIO(
+        csv_file.to_csv(index=False).encode()), 'all.csv'))
+
+    # The corrected term drops two rows and changes a grade.
+    corrected = csv_file[csv_file['Numeric_Term_Code'] == 202140].iloc[2:]
+    corrected = corrected.copy()
+    corrected.iloc[0, corrected.columns.get_loc('Course_Grade')] = 'W'
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        corrected.to_csv(index=False).encode()), 'correction.csv'),
+        replace_terms=True)
+
+    assert (status == 200)
+    assert (res['rows_written']['class_data'] == len(corrected))
+    assert (ClassData.query.count() == len(csv_file) - 2)
+    term_rows = ClassData.query.join(Course).filter(
+        Course.term_code == '202140').all()
+    assert (len(term_rows) == len(corrected))
+    assert (sum(row.grade == 'W' for row in term_rows) ==
+        (corrected['Course_Grade'] == 'W').sum())
+
+    # The first file also held the term, so it is forgotten.
+    assert ({file.filename for file in UploadedFile.query.all()} ==
+        {'correction.csv'})
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_replace_terms_keeps_data_on_errors(test_client, data_path):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    num_rows = ClassData.query.count()
+
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file, 'BAD DATA.csv'),
+            replace_terms=True)
+
+    assert (status == 400)
+    assert (ClassData.query.count() == num_rows)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_import_command(test_client, data_path, read_data):
+    from tests.conftest import app
+    csv_file = read_data('GOOD DATA.csv')
+
+    result = app.test_cli_runner().invoke(args=['data', 'import',
+        '--workers', '2', data_path('GOOD DATA.csv'),
+        data_path('BAD DATA.csv')])
+
+    # The bad file should not stop the good one from being imported.
+    assert (result.exit_code == 1)
+    assert ('1 of 2 files were not imported.' in result.output)
+    assert ('Errors written to' in result.output)
+    assert (ClassData.query.count() == len(csv_file))
+    assert (UploadedFile.query.count() == 1)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_batch(test_client, tmp_path, data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    terms = list(csv_file.groupby('Numeric_Term_Code'))
+    file_paths = []
+    for term, rows in terms[:4]:
+        rows.to_csv(tmp_path / f'{term}.csv', index=False)
+        file_paths.append(str(tmp_path / f'{term}.csv'))
+    with ZipFile(tmp_path / 'rest.zip', 'w') as zip_file:
+        for term, rows in terms[4:]:
+            zip_file.writestr(f'{term}.csv', rows.to_csv(index=False))
+    file_paths.append(str(tmp_path / 'rest.zip'))
+
+    res, status = upload_batch(Job(), file_paths, workers=2)
+
+    assert (status == 200)
+    assert (res['rows_written']['class_data'] == len(csv_file))
+    assert (ClassData.query.count() == len(csv_file))
+    assert (Student.query.count() == csv_file['Unique_ID'].nunique())
+    assert (UploadedFile.query.count() == len(file_paths))
+    assert (UploadedFile.query.get(UploadedFileTerm.query.filter_by(
+        term_code=str(terms[-1][0])).one().file_hash).filename == 'rest.zip')
+
+    # Each file should be skipped once it has been uploaded.
+    res, status = upload_batch(Job(), file_paths[:2], workers=2)
+    assert (status == 200)
+    assert (res['files_skipped'] == [f'{term}.csv' for term, _ in terms[:2]])
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_batch_errors(test_client, tmp_path, data_path):
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    csv_file.iloc[:50].to_csv(tmp_path / 'good.csv', index=False)
+    bad_file = csv_file.iloc[50:].copy()
+    bad_file.iloc[3, bad_file.columns.get_loc('Course_Grade')] = 'Z'
+    bad_file.to_csv(tmp_path / 'bad.csv', index=False)
+
+    job = Job()
+    res, status = upload_batch(job, [str(tmp_path / 'good.csv'),
+        str(tmp_path / 'bad.csv')], workers=2)
+
+    # Nothing should be written when any file has errors.
+    assert (status == 400)
+    assert (res['errors'] == [{'error_message': 'Invalid Course Grade',
+        'line_num': 5, 'col_num': 35, 'sheet': 'bad.csv'}])
+    assert ('errors' in job.files)
+    assert (ClassData.query.count() == 0)
+    assert (UploadedFile.query.count() == 0)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_batch_error_limit(test_client, tmp_path, mocker, data_path):
+    mocker.patch.dict(test_client.application.config,
+        {'UPLOAD_ERROR_LIMIT': 2})
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    file_paths = []
+    for name, rows in (('first.csv', csv_file.iloc[:50].copy()),
+        ('second.csv', csv_file.iloc[50:].copy())):
+        rows.iloc[2:5, rows.columns.get_loc('Course_Grade')] = 'Z'
+        rows.to_csv(tmp_path / name, index=False)
+        file_paths.append(str(tmp_path / name))
+
+    job = Job()
+    res, status = upload_batch(job, file_paths, workers=2)
+
+    # Only the first errors are kept in full, but every error is counted and
+    # written to the error file.
+    assert (status == 400)
+    assert (res['errors'] == [{'error_message': 'Invalid Course Grade',
+        'line_num': line_num, 'col_num': 35, 'sheet': 'first.csv'}
+        for line_num in (4, 5)])
+    assert (res['errors_truncated'])
+    assert (res['error_count'] == 6)
+    assert (res['error_summary'] == [{'error_message': 'Invalid Course Grade',
+        'col_num': 35, 'count': 3, 'first_line': 4, 'last_line': 6,
+        'sheet': sheet} for sheet in ('first.csv', 'second.csv')])
+
+    errors = pd.read_csv(job.files['errors'])
+    assert (list(errors['sheet']) == ['first.csv'] * 3 + ['second.csv'] * 3)
+    assert (list(errors['line_num']) == [4, 5, 6] * 2)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_is_recorded(test_client, data_path, read_data):
+    csv_file = read_data('GOOD DATA.csv')
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'),
+            user='admin@merrimack.edu')
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        res, status = upload_csv_file(FileStorage(file, 'BAD DATA.csv'))
+    # Dry runs never write to the database, so they are not recorded.
+    with open(data_path('BAD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'BAD DATA.csv'), dry_run=True)
+
+    bad, good = IngestionRecord.get_recent()
+    assert (good.filename == 'GOOD DATA.csv')
+    assert (good.user == 'admin@merrimack.edu')
+    assert (good.file_hash == UploadedFile.query.one().file_hash)
+    assert (good.status_code == 200)
+    assert (good.rows_in == len(csv_file))
+    assert (good.class_data_written == len(csv_file))
+    assert (good.students_written == csv_file['Unique_ID'].nunique())
+    assert (good.peak_memory_mb > 0)
+    assert ({'parsing', 'validating', 'staging', 'committing'} <=
+        set(good.get_stage_seconds()))
+
+    assert (IngestionRecord.query.count() == 2)
+    assert (bad.status_code == 400)
+    assert (bad.error_count == res['error_count'])
+    assert (bad.class_data_written == 0)
+    assert (bad.to_dict()['stage_seconds'] == bad.get_stage_seconds())
+
+
+def __mcas_scores(unique_ids: list) -> pd.DataFrame:
+    '''
+    Returns valid MCAS scores for each of the students.
+
+    param:
+        unique_ids: The Unique_IDs of the students.
+    return:
+        A `DataFrame` holding the scores.
+    '''
+    return pd.DataFrame({'Unique_ID': unique_ids, 'English_Raw': 50,
+        'English_Scaled': 250, 'English_Achievement_Level': 'Proficient',
+        'Math_Raw': 40, 'Math_Scaled': 510,
+        'Math_Achievement_Level': 'Meeting Expectations', 'STEM_Raw': None,
+        'STEM_Scaled': None, 'STEM_Achievement_Level': None})
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_mcas_scores(test_client, data_path, read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    unique_ids = list(read_data('GOOD DATA.csv')['Unique_ID'].unique())
+
+    scores = __mcas_scores(unique_ids)
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        scores.to_csv(index=False).encode()), 'mcas.csv'), chunk_size=7,
+        data_type='mcas_scores')
+
+    assert (status == 200)
+    assert (res['rows_written']['mcas_scores'] == len(unique_ids))
+    assert (MCASScore.query.count() == len(unique_ids))
+    score = MCASScore.query.get(unique_ids[0])
+    assert ((score.english_scaled, score.math_achievement_level,
+        score.stem_raw) == (250, 'Meeting Expectations', None))
+
+    # A later file should update the scores it gives, and keep the rest.
+    scores = scores.iloc[:1].assign(English_Scaled=260, Math_Scaled=None)
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        scores.to_csv(index=False).encode()), 'mcas-retake.csv'),
+        data_type='mcas_scores')
+
+    assert (res['rows_written']['mcas_scores'] == 1)
+    score = MCASScore.query.get(unique_ids[0])
+    assert ((score.english_scaled, score.math_scaled) == (260, 510))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upload_mcas_scores_errors(test_client, data_path, read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    unique_ids = list(read_data('GOOD DATA.csv')['Unique_ID'].unique())
+
+    scores = __mcas_scores(unique_ids[:3] + ['UNKNOWN'])
+    scores.loc[1, 'Math_Scaled'] = 600
+    scores.loc[2, 'STEM_Raw'] = -1
+    res, status = upload_csv_file(FileStorage(BytesIO(
+        scores.to_csv(index=False).encode()), 'mcas.csv'),
+        data_type='mcas_scores')
+
+    assert (status == 400)
+    assert (res['errors'] == [
+        {'error_message': 'Invalid Math scaled score.', 'line_num': 3,
+            'col_num': 6},
+        {'error_message': 'Invalid STEM raw score.', 'line_num': 4,
+            'col_num': 8},
+        {'error_message': 'Student not found.', 'line_num': 5, 'col_num': 1}])
+    assert (MCASScore.query.count() == 0)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_get_data_loads_mcas_scores_at_once(test_client, statements, data_path,
+    read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    csv_file = read_data('GOOD DATA.csv')
+    upload_csv_file(FileStorage(BytesIO(__mcas_scores(
+        [csv_file['Unique_ID'][0]]).to_csv(index=False).encode()), 'mcas.csv'),
+        data_type='mcas_scores')
+
+    statements.clear()
+    data = ClassData.get_data()
+
+    assert (len(statements) == 1)
+    assert (len(data) == len(csv_file))
+    assert (next(row for row in data if row['student_id'] ==
+        csv_file['Unique_ID'][0])['mcas_scores']['english_scaled'] == 250)
+    assert (sum(row['mcas_scores'] is None for row in data) ==
+        (csv_file['Unique_ID'] != csv_file['Unique_ID'][0]).sum())
+    assert (len(ClassData.get_data(5)) == 5)
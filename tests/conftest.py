@@ -29,8 +29,16 @@ import sys, os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 import pytest
+import pandas as pd
+from sqlalchemy import event
 from app import init_app, db
-from app.models import RoleEnum, User
+from app.models import RoleEnum, User, DataVersion
+import app as stem_app
+
+# Analytics results and snapshots are only kept in memory, so the tests never
+# write them into the instance folder.
+stem_app.app.config['ANALYTICS_CACHE_FILE'] = None
+stem_app.app.config['ANALYTICS_SNAPSHOT_DIR'] = None
 
 app = init_app()
 app.testing = True
@@ -66,6 +74,7 @@ def test_client(request, mocker):
                 return user
 
             db.create_all()
+            DataVersion.seed()
             if (fill_data):
                 '''
                 Local and Google users with the Viewer role.
@@ -114,4 +123,45 @@ def test_client(request, mocker):
                 
             yield test_client
             db.session.close()
-            db.drop_all()
\ No newline at end of file
+            db.drop_all()
+
+
+@pytest.fixture
+def statements():
+    '''
+    Records the SQL statements run during the test, other than the lookups of
+    the data version. The `list` can be cleared to count the statements of one
+    part of the test.
+    '''
+    statements = []
+    def record(conn, cursor, statement, *args):
+        if ('data_version' not in statement):
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', record)
+
+
+@pytest.fixture
+def data_path():
+    '''
+    Returns a function that gives the path of the specified file in the data/
+    directory.
+    '''
+    def data_path(file_name: str) -> str:
+        return os.path.normpath(os.path.join(os.path.dirname(__file__),
+            '../data', file_name))
+    return data_path
+
+
+@pytest.fixture
+def read_data(data_path):
+    '''
+    Returns a function that reads the specified file from the data/ directory
+    into a `DataFrame`, with all missing values replaced with `None`.
+    '''
+    def read_data(file_name: str) -> pd.DataFrame:
+        csv_file = pd.read_csv(data_path(file_name))
+        return csv_file.astype(object).where(csv_file.notna(), None)
+    return read_data
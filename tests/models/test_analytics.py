@@ -0,0 +1,295 @@
+# Copyright (c) 2022 Jared Rathbun and Katie O'Neil. 
+#
+# This file is part of STEM Data Dashboard.
+# 
+# STEM Data Dashboard is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free 
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# STEM Data Dashboard is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or 
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more 
+# details.
+#
+# You should have received a copy of the GNU General Public License along with 
+# STEM Data Dashboard. If not, see <https://www.gnu.org/licenses/>.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from app.blueprints.dashboard.data_upload import upload_csv_file, delete_term
+from app.models import (Student, ClassData, Course, Utils, DataVersion,
+    DWF_GRADES, GRADE_TO_NUM, NUM_TO_GRADE)
+from app.cache import ResultCache, FileStore
+from app.snapshot import get_snapshot, AnalyticsSnapshot
+from app import db
+from werkzeug.datastructures import FileStorage
+from os import listdir
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_get_kpis(test_client, statements, data_path, read_data):
+    assert (Utils.get_kpis() == {'total_students': 0, 'dwf_avg': 0.0,
+        'avg_course_grade': 'N/A', 'avg_gpa': 0.0, 'avg_high_school_gpa': 0.0,
+        'avg_math_placement': 0.0, 'avg_sat_total': 0.0, 'avg_sat_math': 0.0,
+        'avg_act': 0.0})
+
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    csv_file = read_data('GOOD DATA.csv')
+    students = csv_file.drop_duplicates('Unique_ID')
+    grades = csv_file['Course_Grade']
+    grade_values = grades.map(GRADE_TO_NUM).dropna()
+
+    statements.clear()
+    kpis = Utils.get_kpis()
+
+    # Besides looking up the data version, the KPIs take a single query.
+    assert (len(statements) == 1)
+    assert (kpis['total_students'] == len(students))
+    assert (kpis['dwf_avg'] == '%.2f' % (grades.isin(DWF_GRADES).mean() * 100))
+    assert (kpis['avg_course_grade'] ==
+        NUM_TO_GRADE[round(grade_values.mean())])
+    assert (kpis['avg_gpa'] ==
+        '%.2f' % (students['GPA_Cum'].sum() / len(students)))
+    assert (kpis['avg_act'] ==
+        '%.2f' % (students['ACT_Score'].sum() / len(students)))
+    assert (ClassData.get_avg_dwf() == kpis['dwf_avg'])
+    assert (Student.get_avg_high_school_gpa() == kpis['avg_high_school_gpa'])
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_analytics_are_cached_until_upload(test_client, statements, data_path):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    version = DataVersion.get_version()
+    assert (version is not None)
+
+    statements.clear()
+    years = Course.get_list_of_years()
+    assert (len(statements) > 0)
+    statements.clear()
+
+    cached_years = Course.get_list_of_years()
+    assert (cached_years == years and len(statements) == 0)
+    cached_years.append(0)
+    assert (Course.get_list_of_years() == years)
+
+    # Deleting a term that is not stored keeps the version.
+    delete_term('201540')
+    assert (DataVersion.get_version() == version)
+
+    delete_term(Course.query.first().term_code)
+    assert (DataVersion.get_version() != version)
+    statements.clear()
+    Course.get_list_of_years()
+    assert (len(statements) > 0)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_data_version_is_seeded(test_client, statements):
+    # Data stored before versions existed is given one, so it is cached.
+    DataVersion.query.delete()
+    db.session.commit()
+    DataVersion.seed()
+    version = DataVersion.get_version()
+    assert (version is not None)
+    DataVersion.seed()
+    assert (DataVersion.get_version() == version)
+
+    statements.clear()
+    Course.get_list_of_years()
+    Course.get_list_of_years()
+    assert (len(statements) == 1)
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(max_size=2)
+    cache.set('v1', 'a', 1)
+    cache.set('v1', 'b', 2)
+    assert (cache.get('v1', 'a') == 1)
+    cache.set('v1', 'c', 3)
+    assert (cache.get('v1', 'b') is None)
+    assert (cache.get('v1', 'a') == 1 and cache.get('v1', 'c') == 3)
+    assert (cache.get('v2', 'a') is None)
+
+
+def test_result_cache_is_shared_through_file(tmp_path):
+    file_path = str(tmp_path / 'cache' / 'analytics-cache.db')
+    worker1, worker2 = ResultCache(), ResultCache()
+    worker1.store = FileStore(file_path)
+    worker2.store = FileStore(file_path)
+
+    worker1.set('v1', 'years', [2020, 2021])
+    assert (worker2.get('v1', 'years') == [2020, 2021])
+    assert (ResultCache().get('v1', 'years') is None)
+
+    # Only the newest version is kept in the file.
+    worker2.set('v2', 'years', [2022])
+    assert (worker1.store.get('v1', 'years') is None)
+    assert (worker1.get('v2', 'years') == [2022])
+
+    store = FileStore(file_path, max_size=1)
+    store.set('v2', 'majors', {'Math': 1})
+    assert (store.get('v2', 'years') is None)
+    assert (store.get('v2', 'majors') == {'Math': 1})
+
+
+def test_file_store_keeps_current_version(tmp_path):
+    file_path = str(tmp_path / 'analytics-cache.db')
+    current = {'version': 'v2'}
+    store = FileStore(file_path, get_version=lambda: current['version'])
+    store.set('v2', 'years', [2022])
+
+    # A worker that computed a result before the upload must not remove the
+    # results of the new version.
+    store.set('v1', 'years', [2020, 2021])
+    assert (store.get('v1', 'years') is None)
+    assert (store.get('v2', 'years') == [2022])
+
+    current['version'] = 'v3'
+    store.set('v3', 'years', [2023])
+    assert (store.get('v2', 'years') is None)
+
+    # Errors are only logged, since the store is a cache.
+    store.file_path = str(tmp_path)
+    store.clear()
+    assert (store.get('v3', 'years') is None)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_charts_use_snapshot(test_client, statements, data_path, read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    csv_file = read_data('GOOD DATA.csv')
+    snapshot = get_snapshot()
+    assert (len(snapshot.enrollments) == len(csv_file))
+    assert (snapshot.enrollments['grade'].dtype == 'int8')
+    assert (sorted(snapshot.grades(snapshot.enrollments)) ==
+        sorted(csv_file['Course_Grade']))
+
+    statements.clear()
+    assert (get_snapshot() is snapshot)
+    covid_dwf = Utils.get_covid_data('avg_dwf_rate')
+    dwf_per_semester = ClassData.get_dwf_rate_per_semester()
+    bar_data = Utils.get_bar_chart_data('gender', 'avg_gpa')
+    assert (len(statements) == 0)
+
+    for term in ('FA 2019', 'FA 2020', 'SP 2021', 'FA 2021'):
+        term_grades = csv_file.loc[csv_file['Term'] == term, 'Course_Grade']
+        dwf_rate = round(term_grades.isin(DWF_GRADES).mean() * 100, 2)
+        assert (covid_dwf[term] == dwf_per_semester[term] == dwf_rate)
+
+    # Missing GPAs are stored as 0.
+    students = csv_file.drop_duplicates('Unique_ID').fillna({'GPA_Cum': 0})
+    gpas = students.groupby('Sex')['GPA_Cum'].mean()
+    assert (bar_data == {sex: round(gpa, 2) for sex, gpa in gpas.items()})
+
+    term = csv_file['Term'][0]
+    course_num = csv_file['Course_Number'][0]
+    grades = Utils.get_class_by_class_data('grade', {course_num: term})
+    assert (sorted(grades[course_num]) == sorted(csv_file.loc[
+        (csv_file['Term'] == term) & (csv_file['Course_Number'] == course_num),
+        'Course_Grade']))
+
+    term_code = csv_file['Numeric_Term_Code'][0]
+    delete_term(term_code)
+    assert (get_snapshot() is not snapshot)
+    assert (len(get_snapshot().enrollments) ==
+        (csv_file['Numeric_Term_Code'] != term_code).sum())
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+@pytest.mark.parametrize(
+    'column, csv_column', [
+        ('race_ethnicity', 'Race-Ethnicity'),
+        ('gender', 'Sex')
+])
+def test_class_by_class_student_column(test_client, column, csv_column,
+    data_path, read_data):
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    csv_file = read_data('GOOD DATA.csv')
+    courses = csv_file.drop_duplicates('Course_Number')[:2]
+
+    res = test_client.post('/class-by-class-comparisons', json={
+        'column': column, 'selectedCourses': dict(zip(courses['Course_Number'],
+            courses['Term']))})
+
+    assert (res.status_code == 200)
+    for course_num, term in zip(courses['Course_Number'], courses['Term']):
+        in_course = ((csv_file['Course_Number'] == course_num) &
+            (csv_file['Term'] == term))
+        assert (sorted(res.json[course_num]) ==
+            sorted(csv_file.loc[in_course, csv_column].dropna()))
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_snapshot_is_shared_through_files(test_client, statements, mocker,
+    tmp_path, data_path):
+    from flask import current_app
+    mocker.patch.dict(current_app.config,
+        {'ANALYTICS_SNAPSHOT_DIR': str(tmp_path)})
+    with open(data_path('GOOD DATA.csv'), 'rb') as file:
+        upload_csv_file(FileStorage(file, 'GOOD DATA.csv'))
+    version = DataVersion.get_version()
+    snapshot = get_snapshot()
+    assert (sorted(listdir(tmp_path)) == ['.lock', version])
+
+    # A new worker maps the saved snapshot instead of loading the data.
+    mocker.patch('app.snapshot.latest_snapshot', None)
+    statements.clear()
+    shared = get_snapshot()
+    assert (len(statements) == 0 and shared is not snapshot)
+    assert (not shared.enrollments['gpa_cumulative'].to_numpy().flags.writeable)
+    built = AnalyticsSnapshot.build(version)
+    pd.testing.assert_frame_equal(shared.enrollments, built.enrollments)
+    pd.testing.assert_frame_equal(shared.students, built.students)
+
+    # Only the snapshot of the newest version is kept.
+    delete_term(Course.query.first().term_code)
+    get_snapshot()
+    assert (sorted(listdir(tmp_path)) == ['.lock', DataVersion.get_version()])
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_empty_snapshot_is_shared_through_files(test_client, statements,
+    mocker, tmp_path):
+    from flask import current_app
+    mocker.patch.dict(current_app.config,
+        {'ANALYTICS_SNAPSHOT_DIR': str(tmp_path)})
+    mocker.patch('app.snapshot.latest_snapshot', None)
+    build = mocker.spy(AnalyticsSnapshot, 'build')
+    version = DataVersion.get_version()
+    snapshot = get_snapshot()
+    assert (len(snapshot.enrollments) == 0 and len(snapshot.students) == 0)
+    assert (build.call_count == 1)
+    assert (sorted(listdir(tmp_path)) == ['.lock', version])
+
+    # The empty snapshot is mapped like any other, instead of being loaded
+    # again by each worker.
+    mocker.patch('app.snapshot.latest_snapshot', None)
+    statements.clear()
+    shared = get_snapshot()
+    assert (len(statements) == 0 and build.call_count == 1)
+    pd.testing.assert_frame_equal(shared.enrollments, snapshot.enrollments)
+    pd.testing.assert_frame_equal(shared.students, snapshot.students)
+
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_broken_snapshot_is_removed(test_client, mocker, tmp_path):
+    from flask import current_app
+    mocker.patch.dict(current_app.config,
+        {'ANALYTICS_SNAPSHOT_DIR': str(tmp_path)})
+    mocker.patch('app.snapshot.latest_snapshot', None)
+    mocker.patch.object(AnalyticsSnapshot, 'load',
+        side_effect=ValueError('Broken snapshot'))
+
+    # The snapshot is loaded from the database instead, and the folder is
+    # removed so the next process saves it again.
+    assert (len(get_snapshot().enrollments) == 0)
+    assert (listdir(tmp_path) == ['.lock'])
@@ -39,4 +39,48 @@ def test_parse_class(class_str, expected):
         assert (expected == res)
     except InvalidClassException as ex:
         assert (class_str == 'XX')
-        assert (expected == ClassEnum.FRESHMAN)
\ No newline at end of file
+        assert (expected == ClassEnum.FRESHMAN)
+
+@pytest.mark.parametrize('test_client', [[False]], indirect=True)
+def test_upgrade_schema_adds_fingerprints(test_client, data_path):
+    from app.blueprints.dashboard.data_upload import upload_csv_file
+    from werkzeug.datastructures import FileStorage
+    from io import BytesIO
+    import pandas as pd
+
+    csv_file = pd.read_csv(data_path('GOOD DATA.csv'))
+    upload_csv_file(FileStorage(BytesIO(csv_file.to_csv(index=False)
+        .encode()), 'data.csv'))
+    fingerprints = dict(db.session.query(ClassData.dummy_pk,
+        ClassData.fingerprint))
+
+    # Remake the table the way older versions of the app made it, with a row
+    # that was uploaded twice.
+    columns = 'student_id, program_level, subprogram_code, grade, course'
+    for statement in ('CREATE TABLE old_class_data (dummy_pk INTEGER PRIMARY '
+            'KEY, student_id INTEGER, program_level TEXT, subprogram_code '
+            'INTEGER, grade TEXT, course INTEGER)',
+            f'INSERT INTO old_class_data SELECT dummy_pk, {columns} FROM '
+            'class_data', 'DROP TABLE class_data',
+            'ALTER TABLE old_class_data RENAME TO class_data',
+            f'INSERT INTO class_data ({columns}) SELECT {columns} FROM '
+            'class_data WHERE dummy_pk = 1'):
+        db.session.execute(sqlalchemy.text(statement))
+    db.session.commit()
+
+    upgrade_schema()
+    upgrade_schema()
+
+    assert (ClassData.query.count() == len(csv_file) + 1)
+    assert (dict(db.session.query(ClassData.dummy_pk, ClassData.fingerprint)
+        .filter(ClassData.dummy_pk <= len(csv_file))) == fingerprints)
+    assert (ClassData.query.filter(ClassData.fingerprint.is_(None)).count()
+        == 1)
+    assert ({'ix_class_data_fingerprint', 'ix_class_data_course'} <=
+        {index['name'] for index in
+        sqlalchemy.inspect(db.engine).get_indexes('class_data')})
+
+    # Rows that were uploaded before the upgrade are now skipped.
+    upload_csv_file(FileStorage(BytesIO(csv_file.iloc[:10].to_csv(index=False)
+        .encode()), 'again.csv'))
+    assert (ClassData.query.count() == len(csv_file) + 1)